@@ -0,0 +1,98 @@
+import os
+import ast
+import numpy as np
+
+# ====================================================================
+# Archivo de configuración y ajustes por ejecución
+# ====================================================================
+#
+# La configuración por defecto sigue siendo la sección "CONFIGURACIÓN CLAVE"
+# de normalize_tiffs.py. Un archivo TOML o YAML (--config) y los ajustes de
+# la línea de comandos (--set clave=valor, se aplican después) la
+# sobrescriben sin editar el script, p. ej. para lanzar muchos trabajos
+# pequeños en el clúster con rutas distintas:
+#
+#   input_dir_tiff = "/datos/raw"          # experimento.toml
+#   output_dir_final = "/datos/normalized"
+#   show_napari_preview = false
+#   n_workers = 8
+#   [CHANNEL_COLORS]
+#   C00 = "blue"
+#
+#   python normalize_tiffs.py --config experimento.toml --set chunk_z=32
+#
+# Instalado con "pip install ." (pyproject.toml), el mismo CLI es el comando
+# normalize-tiffs (p. ej. normalize-tiffs --config experimento.toml).
+#
+# Las claves son los nombres de las variables de configuración; una clave
+# desconocida es un error (para no ignorar erratas en silencio).
+
+CONFIG_EXTENSIONS = (".toml", ".yaml", ".yml")
+
+
+def load_config_file(path):
+    """Lee un archivo de configuración TOML o YAML -> dict."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".toml":
+        try:
+            import tomllib  # Python >= 3.11
+        except ImportError:
+            import tomli as tomllib
+        with open(path, "rb") as f:
+            config = tomllib.load(f)
+    elif extension in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError("Para leer configuraciones YAML se necesita PyYAML (pip install pyyaml).")
+        with open(path) as f:
+            config = yaml.safe_load(f) or {}
+    else:
+        raise ValueError(f"Formato de configuración no soportado: {path} (opciones: {', '.join(CONFIG_EXTENSIONS)})")
+    if not isinstance(config, dict):
+        raise ValueError(f"La configuración {path} debe ser una tabla clave = valor.")
+    return config
+
+
+def parse_value(text):
+    """Valor de --set: literal de Python (números, True, None, tuplas...) o, si no lo es, texto."""
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def parse_overrides(items):
+    """["clave=valor", ...] -> {clave: valor}."""
+    overrides = {}
+    for item in items or ():
+        key, sep, value = item.partition("=")
+        if not sep or not key.strip():
+            raise ValueError(f"Ajuste no válido (se espera clave=valor): {item!r}")
+        overrides[key.strip()] = parse_value(value.strip())
+    return overrides
+
+
+def coerce_value(key, value, default):
+    """Adapta un valor leído al tipo de la variable por defecto (tuplas, dtype, ...)."""
+    if key == "save_dtype":
+        return np.dtype(value).type
+    if isinstance(default, tuple) and isinstance(value, list):
+        return tuple(value)
+    if isinstance(value, str) and value.lower() in ("none", "null") and not isinstance(default, str):
+        return None  # TOML no tiene null
+    return value
+
+
+def apply_config(namespace, config, keys):
+    """
+    Aplica config sobre namespace (p. ej. globals() del script), solo con las
+    claves permitidas. Devuelve el dict de valores aplicados.
+    """
+    unknown = sorted(set(config) - set(keys))
+    if unknown:
+        raise ValueError(f"Claves de configuración desconocidas: {', '.join(unknown)} "
+                         f"(opciones: {', '.join(keys)})")
+    applied = {key: coerce_value(key, value, namespace.get(key)) for key, value in config.items()}
+    namespace.update(applied)
+    return applied
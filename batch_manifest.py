@@ -0,0 +1,160 @@
+import os
+import json
+import hashlib
+
+# ====================================================================
+# Manifiesto de ejecución (lotes incrementales y reanudables)
+# ====================================================================
+#
+# En el directorio de salida se guarda _manifest.json con, por cada grupo
+# terminado: la huella de sus entradas (tamaño + mtime, u opcionalmente un
+# hash del contenido), los parámetros de procesamiento y el tamaño de cada
+# archivo de salida. Un grupo solo se registra cuando todas sus salidas y
+# su _metadata.json están completos, así que un lote interrumpido se retoma
+# desde el primer grupo sin registrar, y una salida a medio escribir (o
+# modificada/borrada después) hace que el grupo se vuelva a procesar.
+#
+# En un clúster cada worker escribe un manifiesto parcial
+# _manifest.<worker>.json con solo sus grupos; load_manifest(...,
+# include_partials=True) ve la unión y merge_manifests los combina en
+# _manifest.json al final (ver cluster_shards.py).
+
+MANIFEST_FILE_NAME = "_manifest.json"
+MANIFEST_VERSION = 1
+
+_HASH_BLOCK = 2**20
+
+
+def content_hash(file_path):
+    """Hash BLAKE2b del contenido del archivo (lectura por bloques de 1 MB)."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_fingerprint(file_path, use_hash=False):
+    """Huella de un archivo de entrada: tamaño y mtime, o hash del contenido."""
+    stat = os.stat(file_path)
+    fingerprint = {"size": stat.st_size}
+    if use_hash:
+        fingerprint["blake2b"] = content_hash(file_path)
+    else:
+        fingerprint["mtime_ns"] = stat.st_mtime_ns
+    return fingerprint
+
+
+def group_inputs(input_dir, files_list, use_hash=False):
+    """Huellas de todas las entradas de un grupo: {archivo: huella}."""
+    return {
+        file_name: file_fingerprint(os.path.join(input_dir, file_name), use_hash)
+        for file_name in sorted({file_name for file_name, _ in files_list})
+    }
+
+
+def partial_manifest_name(worker_id):
+    """Nombre del manifiesto parcial de un worker."""
+    return f"_manifest.{worker_id}.json"
+
+
+def _read_manifest(path):
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def _manifest_paths(output_dir, include_partials, file_name=MANIFEST_FILE_NAME):
+    """Manifiesto principal y parciales existentes, del más antiguo al más reciente."""
+    paths = [os.path.join(output_dir, file_name)]
+    if include_partials and os.path.isdir(output_dir):
+        prefix, suffix = MANIFEST_FILE_NAME.rsplit(".", 1)
+        paths += [entry.path for entry in os.scandir(output_dir)
+                  if entry.name != MANIFEST_FILE_NAME
+                  and entry.name.startswith(f"{prefix}.") and entry.name.endswith(f".{suffix}")]
+    existing = [path for path in paths if os.path.exists(path)]
+    return sorted(existing, key=os.path.getmtime)
+
+
+def load_manifest(output_dir, include_partials=False, file_name=MANIFEST_FILE_NAME):
+    """
+    Carga el manifiesto del directorio de salida (vacío si no existe o es ilegible).
+    Con include_partials=True se combinan también los manifiestos parciales de
+    los workers (si un grupo aparece en varios, gana el archivo más reciente).
+    file_name permite cargar un manifiesto parcial concreto.
+    """
+    manifest = {"version": MANIFEST_VERSION, "groups": {}}
+    for path in _manifest_paths(output_dir, include_partials, file_name):
+        loaded = _read_manifest(path)
+        if loaded is not None:
+            manifest["groups"].update(loaded["groups"])
+    return manifest
+
+
+def save_manifest(output_dir, manifest, file_name=MANIFEST_FILE_NAME):
+    """Guarda el manifiesto de forma atómica (archivo temporal + os.replace)."""
+    path = os.path.join(output_dir, file_name)
+    tmp_path = f"{path}.partial"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def merge_manifests(output_dir):
+    """Combina los manifiestos parciales en _manifest.json y los borra. Devuelve el manifiesto combinado."""
+    paths = _manifest_paths(output_dir, include_partials=True)
+    manifest = load_manifest(output_dir, include_partials=True)
+    save_manifest(output_dir, manifest)
+    for path in paths:
+        if os.path.basename(path) != MANIFEST_FILE_NAME:
+            os.remove(path)
+    return manifest
+
+
+def output_size(path):
+    """Tamaño de una salida: archivo, o suma de los archivos de un directorio (OME-Zarr)."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def outputs_intact(output_dir, outputs):
+    """True si todas las salidas registradas existen con el tamaño registrado."""
+    for file_name, size in outputs.items():
+        path = os.path.join(output_dir, file_name)
+        if not os.path.exists(path) or output_size(path) != size:
+            return False
+    return True
+
+
+def group_is_current(manifest, base_name, inputs, params, output_dir):
+    """True si el grupo ya se procesó con las mismas entradas y parámetros y sus salidas siguen intactas."""
+    entry = manifest["groups"].get(base_name)
+    if entry is None:
+        return False
+    return (
+        entry.get("inputs") == inputs
+        and entry.get("params") == params
+        and outputs_intact(output_dir, entry.get("outputs", {}))
+    )
+
+
+def record_group(manifest, base_name, inputs, params, output_dir, output_files):
+    """Registra un grupo terminado con el tamaño actual de sus salidas."""
+    manifest["groups"][base_name] = {
+        "inputs": inputs,
+        "params": params,
+        "outputs": {
+            file_name: output_size(os.path.join(output_dir, file_name))
+            for file_name in output_files
+        },
+    }
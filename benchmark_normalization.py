@@ -0,0 +1,119 @@
+import sys
+import time
+import tracemalloc
+import argparse
+import numpy as np
+from multiprocessing import get_context
+from skimage import img_as_float
+
+from normalization_kernels import normalize_float32, to_output_dtype, release_work_buffer
+
+try:
+    import resource  # Solo POSIX (pico de RSS del proceso)
+except ImportError:
+    resource = None
+
+# ====================================================================
+# Benchmark: camino float64 original vs núcleo float32 in-place
+# ====================================================================
+#
+# Cada caso se ejecuta en un proceso nuevo para que el pico de RSS no
+# arrastre memoria de casos anteriores. Se mide también el pico de
+# asignaciones de NumPy con tracemalloc (portable, incluye Windows).
+
+SIZES = {
+    "small": (16, 256, 256),
+    "medium": (64, 512, 512),
+    "large": (128, 1024, 1024),
+}
+
+
+def original_path(data, save_dtype=np.uint16):
+    """Réplica del bucle original de process_tiff_batch (sin CLAHE)."""
+    data_float = img_as_float(data)
+    min_val = data_float.min()
+    max_val = data_float.max()
+    data_norm = (data_float - min_val) / (max_val - min_val + 1e-8)
+    data_norm = np.nan_to_num(data_norm)
+    return (data_norm * np.iinfo(save_dtype).max).astype(save_dtype)
+
+
+def kernel_path(data, save_dtype=np.uint16):
+    """Núcleo float32 con buffer reutilizado y ufuncs in-place."""
+    data_norm = normalize_float32(data)
+    return to_output_dtype(data_norm, save_dtype)
+
+
+METHODS = {"original": original_path, "float32": kernel_path}
+
+
+def synthetic_stack(shape, seed=0):
+    """Stack 3D uint16 sintético (fondo + ruido + algunos píxeles saturados)."""
+    rng = np.random.default_rng(seed)
+    data = rng.normal(800, 150, size=shape).clip(0, 65535).astype(np.uint16)
+    hot = rng.integers(0, data.size, size=max(1, data.size // 100000))
+    data.flat[hot] = 65535
+    return data
+
+
+def _run_case(method, shape, repeats, queue):
+    data = synthetic_stack(shape)
+    func = METHODS[method]
+    func(data)  # calentamiento (reserva del buffer de trabajo)
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(data)
+        times.append(time.perf_counter() - start)
+
+    # El buffer de trabajo cuenta en el pico: se libera antes de medir
+    release_work_buffer()
+    tracemalloc.start()
+    func(data)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    peak_rss = None
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            peak_rss *= 1024  # Linux devuelve KiB
+    queue.put((min(times), traced_peak, peak_rss))
+
+
+def run_case(method, shape, repeats=3):
+    """Ejecuta un caso en un proceso aislado y devuelve (tiempo, pico tracemalloc, pico RSS)."""
+    ctx = get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_case, args=(method, shape, repeats, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de normalización Min/Max (float64 vs float32 in-place).")
+    parser.add_argument("--sizes", nargs="+", default=["small", "medium"], choices=sorted(SIZES))
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    # Comprobación rápida de equivalencia (diferencia máxima en unidades uint16)
+    check = synthetic_stack(SIZES["small"])
+    max_diff = np.abs(original_path(check).astype(np.int32) - kernel_path(check).astype(np.int32)).max()
+    print(f"Diferencia máxima original vs float32: {max_diff} (uint16)\n")
+
+    header = f"{'tamaño':<8} {'método':<9} {'forma':<18} {'tiempo (s)':>10} {'pico alloc (MB)':>16} {'pico RSS (MB)':>14}"
+    print(header)
+    print("-" * len(header))
+    for size in args.sizes:
+        shape = SIZES[size]
+        for method in METHODS:
+            wall, traced_peak, peak_rss = run_case(method, shape, args.repeats)
+            rss = f"{peak_rss / 1024**2:14.1f}" if peak_rss is not None else f"{'n/d':>14}"
+            print(f"{size:<8} {method:<9} {str(shape):<18} {wall:10.3f} {traced_peak / 1024**2:16.1f} {rss}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import numpy as np
+from multiprocessing import get_context
+from tifffile import imwrite, TiffFile
+
+# ====================================================================
+# Benchmark reproducible del pipeline completo (process_tiff_batch)
+# ====================================================================
+#
+# Genera stacks sintéticos tipo meristemo de raíz (C00 núcleos, C01 paredes
+# celulares saturadas, C02 núcleos EdU dispersos) con la convención de
+# nombres de la macro de Fiji, ejecuta process_tiff_batch sobre ellos y
+# extrae del informe de ejecución (_run_report.json) el tiempo de cada
+# etapa: lectura, normalización, CLAHE, conversión y escritura.
+#
+# Cada tamaño se ejecuta en un proceso nuevo (pico de RSS aislado). Los
+# resultados se guardan en benchmark_results/<fecha>.json y se comparan con
+# una ejecución anterior (--baseline, por defecto la última con las mismas
+# opciones): si el rendimiento total empeora más que --threshold, el script
+# termina con código 1.
+
+SIZES = {
+    "slice2d": (1024, 1024),
+    "small": (16, 256, 256),
+    "medium": (64, 512, 512),
+    "large": (128, 1024, 1024),
+    "xlarge": (200, 2048, 2048),
+    "4k": (200, 4096, 4096),
+}
+
+CHANNELS = ("C00", "C01", "C02")
+
+# Etapas del informe de ejecución que se reportan (nombre mostrado -> etapas)
+STAGES = {
+    "read": ("read",),
+    "normalize": ("img_as_float", "normalize", "stats_pass"),
+    "clahe": ("clahe",),
+    "cast": ("convert",),
+    "write": ("write",),
+}
+
+RESULTS_DIR = "benchmark_results"
+
+
+def synthetic_plane(z, shape_yx, channel, seed=0):
+    """
+    Plano uint16 sintético: rejilla deformada de células (paredes brillantes
+    en C01), un núcleo por célula (C00) y una fracción de núcleos EdU (C02),
+    más fondo y ruido. Se genera plano a plano para no cargar el volumen.
+    """
+    rng = np.random.default_rng((seed, z, CHANNELS.index(channel)))
+    y, x = np.ogrid[:shape_yx[0], :shape_yx[1]]
+    y = y.astype(np.float32)
+    x = x.astype(np.float32)
+    cell = 24.0
+    # Deformación suave para que las células no sean un tablero perfecto
+    warp_y = 4 * np.sin(x / 53 + z / 17)
+    warp_x = 4 * np.cos(y / 47 + z / 23)
+    phase_y = np.sin(np.pi * (y + warp_y) / cell)
+    phase_x = np.sin(np.pi * (x + warp_x) / cell)
+
+    if channel == "C01":
+        walls = np.exp(-np.minimum(np.abs(phase_y), np.abs(phase_x)) * 12)
+        signal = 4000 + 61000 * walls
+    else:
+        nuclei = np.clip(np.abs(phase_y) * np.abs(phase_x) - 0.6, 0, None) / 0.4
+        if channel == "C02":
+            # Solo una de cada ~7 células en fase S
+            cell_id = np.floor((y + warp_y) / cell) * 131 + np.floor((x + warp_x) / cell) * 17
+            nuclei = nuclei * ((cell_id % 7) == 0)
+        signal = 300 + 20000 * nuclei * (0.7 + 0.3 * np.cos(z / 9))
+
+    noise = rng.normal(0, 120, size=shape_yx).astype(np.float32)
+    return np.clip(signal + noise, 0, 65535).astype(np.uint16)
+
+
+def write_synthetic_group(input_dir, base_name, shape, seed=0):
+    """Escribe <base>_C00.tif ... <base>_C02.tif plano a plano (se reutilizan si ya existen)."""
+    os.makedirs(input_dir, exist_ok=True)
+    for channel in CHANNELS:
+        path = os.path.join(input_dir, f"{base_name}_{channel}.tif")
+        if os.path.exists(path):
+            with TiffFile(path) as tif:
+                if tuple(tif.series[0].shape) == tuple(shape):
+                    continue
+        if len(shape) == 2:
+            imwrite(f"{path}.partial", synthetic_plane(0, shape, channel, seed))
+        else:
+            planes = (synthetic_plane(z, shape[1:], channel, seed) for z in range(shape[0]))
+            imwrite(f"{path}.partial", planes, shape=shape, dtype=np.uint16)
+        os.replace(f"{path}.partial", path)
+
+
+def _run_pipeline(input_dir, output_dir, options, queue):
+    # Importación dentro del proceso hijo: el pico de RSS solo incluye este caso
+    import normalize_tiffs
+
+    start = time.perf_counter()
+    normalize_tiffs.process_tiff_batch(
+        input_dir, output_dir, normalize_tiffs.CHANNEL_COLORS, True, options["enhance_contrast"], np.uint16,
+        False, n_workers=options["n_workers"], streaming=options["streaming"], chunk_z=options["chunk_z"],
+        float32_kernel=options["float32_kernel"], clahe_backend=options["clahe_backend"],
+        output_format=options["output_format"], pipelined_io=options["pipelined_io"], incremental=False,
+        run_report=True
+    )
+    wall = time.perf_counter() - start
+    with open(os.path.join(output_dir, "_run_report.json")) as f:
+        queue.put((wall, json.load(f)["summary"]))
+
+
+def run_pipeline(input_dir, output_dir, options):
+    """Ejecuta el lote en un proceso aislado; devuelve (tiempo total, resumen por etapa)."""
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    ctx = get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_pipeline, args=(input_dir, output_dir, options, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def stage_metrics(summary, n_voxels, n_bytes):
+    """Resumen del informe -> tiempo, MB/s y Mvox/s por etapa del benchmark (sobre el volumen de entrada)."""
+    by_stage = {s["stage"]: s for s in summary}
+    metrics = {}
+    for name, stages in STAGES.items():
+        wall = sum(by_stage[s]["wall_s"] for s in stages if s in by_stage)
+        if wall > 0:
+            metrics[name] = {"wall_s": wall, "mb_s": n_bytes / wall / 2**20, "mvox_s": n_voxels / wall / 1e6}
+    peaks = [s["peak_rss_mb"] for s in summary if s.get("peak_rss_mb") is not None]
+    return metrics, (max(peaks) if peaks else None)
+
+
+def benchmark_size(size, work_dir, options, repeats, seed):
+    shape = SIZES[size]
+    input_dir = os.path.join(work_dir, "input", size)
+    output_dir = os.path.join(work_dir, "output", size)
+    write_synthetic_group(input_dir, f"bench_{size}", shape, seed)
+
+    n_voxels = int(np.prod(shape)) * len(CHANNELS)
+    n_bytes = n_voxels * np.dtype(np.uint16).itemsize
+    best = None
+    for _ in range(repeats):
+        wall, summary = run_pipeline(input_dir, output_dir, options)
+        if best is None or wall < best[0]:
+            best = (wall, summary)
+    wall, summary = best
+    stages, peak_rss_mb = stage_metrics(summary, n_voxels, n_bytes)
+    return {
+        "shape": list(shape),
+        "channels": len(CHANNELS),
+        "total": {"wall_s": wall, "mb_s": n_bytes / wall / 2**20, "mvox_s": n_voxels / wall / 1e6},
+        "stages": stages,
+        "peak_rss_mb": peak_rss_mb,
+    }
+
+
+def environment():
+    """Datos del equipo y del código para poder comparar ejecuciones."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "git_commit": commit,
+    }
+
+
+def find_baseline(results_dir, options, exclude=None):
+    """Última ejecución guardada con las mismas opciones (o None)."""
+    if not os.path.isdir(results_dir):
+        return None
+    for name in sorted(os.listdir(results_dir), reverse=True):
+        path = os.path.join(results_dir, name)
+        if not name.endswith(".json") or path == exclude:
+            continue
+        with open(path) as f:
+            previous = json.load(f)
+        if previous.get("options") == options:
+            return path
+    return None
+
+
+def compare(results, baseline, threshold):
+    """Compara el rendimiento total por tamaño; devuelve la lista de regresiones."""
+    regressions = []
+    for size, record in results["sizes"].items():
+        previous = baseline["sizes"].get(size)
+        if previous is None:
+            continue
+        ratio = record["total"]["mvox_s"] / previous["total"]["mvox_s"]
+        status = "REGRESIÓN" if ratio < 1 - threshold else "OK"
+        print(f"[{status}] {size:<8} {previous['total']['mvox_s']:8.2f} -> {record['total']['mvox_s']:8.2f} Mvox/s "
+              f"({100 * (ratio - 1):+.1f}%)")
+        for stage, metrics in record["stages"].items():
+            if stage in previous["stages"]:
+                stage_ratio = metrics["mvox_s"] / previous["stages"][stage]["mvox_s"]
+                print(f"           {stage:<10} {100 * (stage_ratio - 1):+.1f}%")
+        if ratio < 1 - threshold:
+            regressions.append((size, ratio))
+    return regressions
+
+
+def print_results(results):
+    header = (f"{'tamaño':<8} {'etapa':<10} {'forma':<18} {'tiempo (s)':>10} {'MB/s':>9} {'Mvox/s':>9} "
+              f"{'pico RSS (MB)':>14}")
+    print(header)
+    print("-" * len(header))
+    for size, record in results["sizes"].items():
+        rows = [("total", record["total"])] + list(record["stages"].items())
+        for stage, metrics in rows:
+            peak = record["peak_rss_mb"] if stage == "total" and record["peak_rss_mb"] is not None else None
+            peak = f"{peak:14.0f}" if peak is not None else f"{'':>14}"
+            print(f"{size:<8} {stage:<10} {str(tuple(record['shape'])):<18} {metrics['wall_s']:10.3f} "
+                  f"{metrics['mb_s']:9.1f} {metrics['mvox_s']:9.2f} {peak}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline completo sobre stacks sintéticos C00/C01/C02.")
+    parser.add_argument("--sizes", nargs="+", default=["slice2d", "small", "medium"], choices=list(SIZES))
+    parser.add_argument("--repeats", type=int, default=1, help="Repeticiones por tamaño (se toma la mejor).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=os.path.join(RESULTS_DIR, "data"),
+                        help="Carpeta para los stacks sintéticos (se reutilizan) y las salidas.")
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    parser.add_argument("--baseline", help="JSON de una ejecución anterior (por defecto la última con las mismas opciones).")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Pérdida de rendimiento total tolerada antes de fallar (0.10 = 10%%).")
+    parser.add_argument("--no-save", action="store_true", help="No guardar los resultados.")
+    # Opciones del pipeline
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--chunk-z", type=int, default=16)
+    parser.add_argument("--no-clahe", action="store_true")
+    parser.add_argument("--clahe-backend", help="Por defecto fast (fast_slices con --streaming).")
+    parser.add_argument("--float64", action="store_true", help="Camino float64 original en lugar del núcleo float32.")
+    parser.add_argument("--output-format", default="tiff")
+    parser.add_argument("--pipelined-io", action="store_true", help="Lectura, cálculo y escritura solapados en hilos.")
+    args = parser.parse_args()
+
+    options = {
+        "n_workers": args.workers,
+        "streaming": args.streaming,
+        "chunk_z": args.chunk_z,
+        "enhance_contrast": not args.no_clahe,
+        "clahe_backend": args.clahe_backend or ("fast_slices" if args.streaming else "fast"),
+        "float32_kernel": not args.float64,
+        "output_format": args.output_format,
+        "pipelined_io": args.pipelined_io,
+    }
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": environment(),
+        "options": options,
+        "sizes": {},
+    }
+    for size in args.sizes:
+        print(f"▶ {size} {SIZES[size]} x {len(CHANNELS)} canales")
+        results["sizes"][size] = benchmark_size(size, args.work_dir, options, args.repeats, args.seed)
+    print()
+    print_results(results)
+
+    saved_path = None
+    if not args.no_save:
+        os.makedirs(args.results_dir, exist_ok=True)
+        saved_path = os.path.join(args.results_dir, f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+        with open(saved_path, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"\nResultados guardados en {saved_path}")
+
+    baseline_path = args.baseline or find_baseline(args.results_dir, options, exclude=saved_path)
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        print(f"\nComparación con {baseline_path} (umbral {100 * args.threshold:.0f}%):")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"❌ {len(regressions)} tamaños por debajo del umbral.")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import socket
+import hashlib
+import threading
+
+# ====================================================================
+# Reparto de grupos entre nodos de un clúster
+# ====================================================================
+#
+# Dos formas de repartir el lote entre procesos independientes que
+# comparten el directorio de salida (sistema de archivos compartido):
+#
+#   - Shards estáticos (n_shards, shard_index): los grupos se ordenan por
+#     nombre y el shard i se queda con los grupos i, i + N, i + 2N... Es
+#     determinista (p. ej. un array job de SLURM con shard_index =
+#     $SLURM_ARRAY_TASK_ID) y no necesita ninguna coordinación.
+#
+#   - Cola de trabajo (work_queue): cada worker recorre los grupos pendientes
+#     y "reclama" cada uno creando <salida>/_claims/<grupo>.<clave>.claim con
+#     O_CREAT | O_EXCL (atómico también en NFS): solo un worker lo consigue y
+#     los demás pasan al siguiente. Al terminar, el claim se renombra a
+#     .done. Los workers rápidos procesan más grupos y no hace falta
+#     coordinador. La clave es un hash de las entradas del grupo y de los
+#     parámetros, así que si cambian (nuevo lote) el grupo se vuelve a
+#     repartir. Con claim_stale_s, un claim que no se ha renovado en ese
+#     tiempo (worker caído) puede ser reclamado por otro; mientras procesa,
+#     cada worker renueva sus claims activos. Un .done de una ejecución
+#     anterior no bloquea un grupo que hay que rehacer (p. ej. se borró su
+#     salida): si redo_done lo confirma, se elimina y el grupo se reclama.
+#
+# Cada worker guarda su propio manifiesto parcial (_manifest.<worker>.json)
+# e informe (_run_report.<worker>.json) para no pisarse; al final
+# "--merge" los combina en _manifest.json y genera la hoja de contactos.
+#
+# Con shared_normalization, el rango común necesita las estadísticas de todo
+# el lote; para que cada nodo no lea el experimento entero, se calculan antes
+# en una pasada repartida y los workers solo las combinan:
+#   python normalize_tiffs.py --stats-only --shard $i/N      (array job 1)
+#   python normalize_tiffs.py --shard $i/N                   (array job 2)
+#   python normalize_tiffs.py --merge
+#
+# Prueba local: varios procesos en la misma máquina con la misma salida,
+#   python normalize_tiffs.py --work-queue --set n_workers=1 &   (x N)
+#   python normalize_tiffs.py --merge
+
+CLAIMS_DIR_NAME = "_claims"
+
+
+def default_worker_id():
+    """Identificador del worker: <host>-<pid> (único entre nodos)."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def parse_shard(text):
+    """"i/N" -> (i, N), con 0 <= i < N."""
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard no válido: {text!r} (se espera i/N, p. ej. 0/8)")
+    if not 0 <= index < count:
+        raise ValueError(f"Shard no válido: {text!r} (i debe estar entre 0 y N-1)")
+    return index, count
+
+
+def shard_groups(file_groups, shard_index, n_shards):
+    """Subconjunto determinista de file_groups: grupos ordenados por nombre, uno de cada n_shards."""
+    names = sorted(file_groups)[shard_index::n_shards]
+    return {base_name: file_groups[base_name] for base_name in names}
+
+
+def claim_key(inputs, params):
+    """Clave de una unidad de trabajo: hash de las huellas de entrada del grupo y de los parámetros."""
+    text = json.dumps([inputs, params], sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+
+class WorkClaims:
+    """
+    Cola de trabajo sin coordinador basada en archivos de claim exclusivos.
+    redo_done(base_name, done_path) -> True si un grupo ya marcado como
+    terminado debe procesarse de nuevo.
+    """
+
+    def __init__(self, claims_dir, worker_id, stale_after_s=None, redo_done=None):
+        self.claims_dir = claims_dir
+        self.worker_id = worker_id
+        self.stale_after_s = stale_after_s
+        self.redo_done = redo_done
+        self._active = {}  # grupo -> ruta del claim en curso
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        os.makedirs(claims_dir, exist_ok=True)
+        self._heartbeat = None
+        if stale_after_s:
+            self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+            self._heartbeat.start()
+
+    def _path(self, base_name, key, suffix):
+        return os.path.join(self.claims_dir, f"{base_name}.{key}.{suffix}")
+
+    def claim(self, base_name, key):
+        """Intenta reclamar el grupo; True si este worker debe procesarlo."""
+        done_path = self._path(base_name, key, "done")
+        if os.path.exists(done_path):
+            if self.redo_done is None or not self.redo_done(base_name, done_path):
+                return False
+            try:
+                os.remove(done_path)  # el O_EXCL de abajo decide quién lo rehace
+            except FileNotFoundError:
+                pass
+        path = self._path(base_name, key, "claim")
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._take_over_stale(path):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"worker": self.worker_id, "claimed_at": time.time()}, f)
+            with self._lock:
+                self._active[base_name] = path
+            return True
+        return False
+
+    def _take_over_stale(self, path):
+        # Un claim abandonado se aparta con un rename (solo un worker lo consigue)
+        if not self.stale_after_s:
+            return False
+        try:
+            if time.time() - os.path.getmtime(path) < self.stale_after_s:
+                return False
+            os.rename(path, f"{path}.stale-{self.worker_id}")
+        except OSError:
+            return False
+        return True
+
+    def finish(self, base_name):
+        """Marca el grupo como terminado (claim -> done)."""
+        with self._lock:
+            path = self._active.pop(base_name, None)
+        if path is not None:
+            os.replace(path, f"{path[:-len('claim')]}done")
+
+    def _renew(self):
+        while not self._stop.wait(self.stale_after_s / 3):
+            with self._lock:
+                paths = list(self._active.values())
+            for path in paths:
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+
+    def claim_groups(self, file_groups, keys):
+        """
+        Recorre file_groups y devuelve (grupo, archivos) de cada grupo que este
+        worker consigue reclamar. Es perezoso: cada grupo se reclama solo
+        cuando se pide el siguiente (p. ej. al quedar libre un proceso local).
+        """
+        for base_name, files_list in file_groups.items():
+            if self.claim(base_name, keys[base_name]):
+                yield base_name, files_list
+
+    def close(self):
+        """Detiene la renovación y libera los claims sin terminar (otro worker podrá procesarlos)."""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        with self._lock:
+            paths = list(self._active.values())
+            self._active.clear()
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,317 @@
+import math
+import numbers
+import numpy as np
+from functools import partial
+from skimage.util import img_as_uint
+
+# ====================================================================
+# CLAHE vectorizado (histogramas por tesela en bloque + interpolación
+# multilineal con operaciones de NumPy)
+# ====================================================================
+#
+# Sigue el esquema de skimage.exposure.equalize_adapthist (Zuiderveld,
+# Graphics Gems IV), pero sin los bucles de Python por tesela:
+#   - los histogramas de todas las teselas salen de un único np.bincount
+#     (por bloques de filas para acotar la memoria),
+#   - el recorte y la redistribución se hacen a la vez para todas las teselas,
+#   - la interpolación bi/trilineal reutiliza un único índice plano por
+#     bloque de teselas y acumula en float32.
+# Con per_slice=True cada plano Z se ecualiza como una imagen 2D
+# independiente (equivalente a aplicar CLAHE 2D slice por slice).
+
+NR_OF_GRAY = 2**14  # niveles de gris internos (igual que skimage)
+
+# Vóxeles procesados por bloque de teselas en bincount/interpolación
+# (acota los temporales y mantiene las tablas del bloque en caché)
+_CHUNK_VOXELS = 2**18
+# Vóxeles por bloque al reescalar a niveles de gris
+_VOXELS_PER_CHUNK = 2**22
+
+
+def _to_gray_levels(image, n_batch):
+    """
+    Reescala cada lote a [0, NR_OF_GRAY - 1] (redondeado) exactamente como
+    skimage (img_as_uint + rescale_intensity en float64), pero por bloques
+    para no crear temporales float64 del tamaño del stack.
+    """
+    data = image.reshape((n_batch, -1))
+    if np.issubdtype(image.dtype, np.floating):
+        data = np.nan_to_num(data)
+    # img_as_uint es monótona: min/max del resultado = img_as_uint(min/max)
+    imin = img_as_uint(data.min(axis=1)).astype(np.float64)
+    imax = img_as_uint(data.max(axis=1)).astype(np.float64)
+
+    chunk = max(1, _VOXELS_PER_CHUNK)
+    levels = np.empty(data.shape, dtype=np.uint16)
+    for b in range(n_batch):
+        span = imax[b] - imin[b]
+        for start in range(0, data.shape[1], chunk):
+            values = img_as_uint(data[b, start:start + chunk]).astype(np.float64)
+            if span > 0:
+                np.clip(values, imin[b], imax[b], out=values)
+                values = (values - imin[b]) / span * (NR_OF_GRAY - 1)
+            else:
+                # Imagen constante: skimage recorta directamente al rango de salida
+                np.clip(values, 0, NR_OF_GRAY - 1, out=values)
+            levels[b, start:start + chunk] = np.round(values)
+    return levels.reshape(image.shape)
+
+
+def _blocks(array, n_batch, n_tiles, kernel_size):
+    """(B, n1*k1, n2*k2, ...) -> (B * n1 * n2 ..., k1 * k2 ...) contiguo."""
+    ndim = len(kernel_size)
+    shape = [n_batch]
+    for n, k in zip(n_tiles, kernel_size):
+        shape += [n, k]
+    order = [0] + [1 + 2 * d for d in range(ndim)] + [2 + 2 * d for d in range(ndim)]
+    blocks = array.reshape(shape).transpose(order)
+    return np.ascontiguousarray(blocks).reshape((n_batch * math.prod(n_tiles), math.prod(kernel_size)))
+
+
+def _unblocks(blocks, n_batch, n_tiles, kernel_size):
+    """Inversa de _blocks."""
+    ndim = len(kernel_size)
+    blocks = blocks.reshape([n_batch] + list(n_tiles) + list(kernel_size))
+    order = [0]
+    for d in range(ndim):
+        order += [1 + d, 1 + ndim + d]
+    return blocks.transpose(order).reshape([n_batch] + [n * k for n, k in zip(n_tiles, kernel_size)])
+
+
+def tile_histograms(blocks, nbins):
+    """Histogramas de todas las teselas (filas de blocks) con np.bincount en bloque."""
+    n_rows = blocks.shape[0]
+    rows_per_chunk = max(1, _CHUNK_VOXELS // blocks.shape[1])
+    hist = np.empty((n_rows, nbins), dtype=np.int64)
+    for start in range(0, n_rows, rows_per_chunk):
+        stop = min(start + rows_per_chunk, n_rows)
+        offsets = (np.arange(stop - start, dtype=np.intp) * nbins)[:, None]
+        idx = blocks[start:stop].astype(np.intp)
+        idx += offsets
+        counts = np.bincount(idx.ravel(), minlength=(stop - start) * nbins)
+        hist[start:stop] = counts.reshape((stop - start, nbins))
+    return hist
+
+
+def clip_histograms(hist, clip_limit):
+    """
+    Recorta todos los histogramas a clip_limit y redistribuye el exceso
+    (misma estrategia que skimage.exposure._adapthist.clip_histogram, pero
+    vectorizada sobre las teselas).
+    """
+    nbins = hist.shape[1]
+    n_excess = np.maximum(hist - clip_limit, 0).sum(axis=1)
+    np.minimum(hist, clip_limit, out=hist)
+
+    # Reparto uniforme del exceso
+    bin_incr = n_excess // nbins
+    upper = (clip_limit - bin_incr)[:, None]
+    low_mask = hist < upper
+    n_excess -= low_mask.sum(axis=1) * bin_incr
+    hist += low_mask * bin_incr[:, None]
+
+    mid_mask = (hist >= upper) & (hist < clip_limit)
+    n_excess += (hist * mid_mask).sum(axis=1) - mid_mask.sum(axis=1) * clip_limit
+    hist[mid_mask] = clip_limit
+
+    # Reparto del resto: +1 a los bins bajo el límite con paso uniforme.
+    # Emula el bucle de skimage (índice inicial creciente y reinicio mientras
+    # haya progreso), avanzando todas las teselas pendientes a la vez.
+    positions = np.arange(nbins)[None, :]
+    rows = np.nonzero(n_excess > 0)[0]
+    start_index = np.zeros(rows.size, dtype=np.int64)
+    prev_excess = n_excess[rows].copy()
+    while rows.size:
+        sub = hist[rows]
+        under = sub < clip_limit
+        step = np.maximum(1, under.sum(axis=1) // n_excess[rows])[:, None]
+        offset = positions - start_index[:, None]
+        selected = under & (offset >= 0) & (offset % step == 0)
+        hist[rows] = sub + selected
+        n_excess[rows] -= selected.sum(axis=1)
+
+        start_index += 1
+        pending = n_excess[rows] > 0
+        wrapped = start_index == nbins
+        # Vuelta completa sin progreso: se abandona (igual que skimage)
+        stalled = wrapped & (n_excess[rows] == prev_excess)
+        prev_excess = np.where(wrapped, n_excess[rows], prev_excess)
+        start_index[wrapped] = 0
+
+        keep = pending & ~stalled
+        rows, start_index, prev_excess = rows[keep], start_index[keep], prev_excess[keep]
+    return hist
+
+
+def map_histograms(hist, n_pixels):
+    """Tablas de ecualización (suma acumulada, truncada) para todas las teselas."""
+    maps = np.cumsum(hist, axis=-1).astype(np.float64)
+    maps *= (NR_OF_GRAY - 1) / n_pixels
+    np.minimum(maps, NR_OF_GRAY - 1, out=maps)
+    np.floor(maps, out=maps)  # skimage trunca las tablas a enteros
+    return maps
+
+
+def _interpolation_weights(kernel_size):
+    """Pesos (1 - t, t) por dimensión dentro de un bloque, en orden C."""
+    weights = []
+    for k in kernel_size:
+        t = np.arange(k) / k
+        weights.append((1 - t, t))
+    return weights
+
+
+def _clahe(levels, n_batch, kernel_size, clip_limit, nbins):
+    """CLAHE sobre levels (B, ...) ya reescalado a NR_OF_GRAY niveles."""
+    spatial = levels.shape[1:]
+    ndim = len(spatial)
+
+    # Relleno (reflect) para tener múltiplos de kernel_size y media tesela delante
+    pad_start = [k // 2 for k in kernel_size]
+    pad_end = [(k - s % k) % k + int(np.ceil(k / 2.0)) for k, s in zip(kernel_size, spatial)]
+
+    # Niveles -> bins (uint8 si caben) antes de rellenar: menos memoria
+    bin_size = 1 + NR_OF_GRAY // nbins
+    bin_dtype = np.uint8 if nbins <= 256 else np.uint16
+    bins = (levels // bin_size).astype(bin_dtype)
+    bins = np.pad(bins, [[0, 0]] + [[a, b] for a, b in zip(pad_start, pad_end)], mode="reflect")
+    padded = bins.shape[1:]
+
+    # 1. Histogramas de las regiones contextuales
+    ns_hist = [int(s / k) - 1 for s, k in zip(padded, kernel_size)]
+    hist_slices = (slice(None),) + tuple(slice(k // 2, k // 2 + n * k) for k, n in zip(kernel_size, ns_hist))
+    hist = tile_histograms(_blocks(bins[hist_slices], n_batch, ns_hist, kernel_size), nbins)
+
+    kernel_elements = math.prod(kernel_size)
+    if clip_limit > 0.0:
+        clim = int(np.clip(clip_limit * kernel_elements, 1, None))
+    else:
+        clim = kernel_elements  # sin recorte (AHE)
+
+    hist = clip_histograms(hist, clim)
+    maps = map_histograms(hist, kernel_elements).reshape([n_batch] + ns_hist + [nbins])
+    # Duplicar las tablas de borde en cada dimensión espacial
+    map_array = np.pad(maps, [[0, 0]] + [[1, 1]] * ndim + [[0, 0]], mode="edge")
+
+    # 2. Interpolación multilineal entre las 2^ndim teselas vecinas
+    ns_proc = [int(s / k) for s, k in zip(padded, kernel_size)]
+    blocks = _blocks(bins, n_batch, ns_proc, kernel_size)
+    del bins
+    n_rows = blocks.shape[0]
+    weights = _interpolation_weights(kernel_size)
+
+    edges = []
+    for edge in np.ndindex(*([2] * ndim)):
+        edge_maps = map_array[(slice(None),) + tuple(slice(e, e + n) for e, n in zip(edge, ns_proc))]
+        # Las tablas son enteros < 2**14: float32 es exacto y ocupa la mitad
+        edge_maps = np.ascontiguousarray(edge_maps, dtype=np.float32).reshape(-1)
+        coeff = weights[0][edge[0]]
+        for d in range(1, ndim):
+            coeff = np.multiply.outer(coeff, weights[d][edge[d]])
+        edges.append((edge_maps, coeff.reshape(-1)))
+
+    rows_per_chunk = max(1, _CHUNK_VOXELS // blocks.shape[1])
+    result = np.zeros(blocks.shape, dtype=np.float32)
+    for start in range(0, n_rows, rows_per_chunk):
+        stop = min(start + rows_per_chunk, n_rows)
+        # Índice (tesela, bin) local al bloque de filas, calculado una sola vez;
+        # las tablas del bloque caben en caché durante los np.take
+        idx = blocks[start:stop].astype(np.intp)
+        idx += (np.arange(stop - start, dtype=np.intp) * nbins)[:, None]
+        table = slice(start * nbins, stop * nbins)
+        mapped = np.empty(idx.shape, dtype=np.float32)
+        product = np.empty(idx.shape, dtype=np.float64)
+        out = result[start:stop]
+        for edge_maps, coeff in edges:
+            np.take(edge_maps[table], idx, out=mapped)
+            # Producto en float64 y suma en float32, en el mismo orden que skimage
+            np.multiply(mapped, coeff, out=product)
+            np.copyto(mapped, product, casting="unsafe")
+            out += mapped
+    del blocks
+
+    # skimage convierte el resultado interpolado a entero (truncando)
+    np.trunc(result, out=result)
+    result = _unblocks(result, n_batch, ns_proc, kernel_size)
+    unpad = (slice(None),) + tuple(slice(a, s - b) for a, b, s in zip(pad_start, pad_end, padded))
+    return result[unpad]
+
+
+def _rescale_batches(result, n_batch):
+    """Reescala cada lote a [0, 1] (rescale_intensity de skimage), in-place."""
+    flat = result.reshape((n_batch, -1))
+    rmin = flat.min(axis=1)[:, None]
+    rmax = flat.max(axis=1)[:, None]
+    flat -= rmin
+    span = rmax - rmin
+    np.divide(flat, span, out=flat, where=span > 0)
+    # Lotes constantes: rescale_intensity recorta al rango de salida [0, 1]
+    constant = (span == 0)[:, 0]
+    if constant.any():
+        flat[constant] = np.clip(flat[constant] + rmin[constant], 0, 1)
+    return result
+
+
+def equalize_adapthist_fast(image, kernel_size=None, clip_limit=0.01, nbins=256, per_slice=False):
+    """
+    CLAHE vectorizado, compatible con skimage.exposure.equalize_adapthist.
+    Con per_slice=True y una imagen 3D, cada plano Z se ecualiza por separado
+    (teselas 2D); si no, se usan teselas 3D reales. Devuelve float32 en [0, 1].
+    """
+    image = np.asarray(image)
+    if per_slice and image.ndim == 3:
+        n_batch = image.shape[0]
+        spatial = image.shape[1:]
+    else:
+        n_batch = 1
+        spatial = image.shape
+
+    if kernel_size is None:
+        kernel_size = tuple(max(s // 8, 1) for s in spatial)
+    elif isinstance(kernel_size, numbers.Number):
+        kernel_size = (kernel_size,) * len(spatial)
+    elif len(kernel_size) != len(spatial):
+        raise ValueError(f"Valor incorrecto de `kernel_size`: {kernel_size}")
+    kernel_size = [int(k) for k in kernel_size]
+
+    levels = _to_gray_levels(image, n_batch).reshape((n_batch,) + tuple(spatial))
+    result = _clahe(levels, n_batch, kernel_size, clip_limit, nbins)
+    result = np.ascontiguousarray(result)
+    return _rescale_batches(result, n_batch).reshape(image.shape)
+
+
+def _equalize_skimage(image, **kwargs):
+    """CLAHE original de skimage (importación tardía: skimage.exposure tarda en cargar)."""
+    from skimage import exposure
+
+    return exposure.equalize_adapthist(image, **kwargs)
+
+
+def _equalize_slices_skimage(image, **kwargs):
+    """CLAHE de skimage aplicado plano a plano (referencia del modo per_slice)."""
+    from skimage import exposure
+
+    if image.ndim != 3:
+        return exposure.equalize_adapthist(image, **kwargs)
+    return np.stack([exposure.equalize_adapthist(plane, **kwargs) for plane in image])
+
+
+# Motores de CLAHE disponibles (nombre -> función imagen -> float en [0, 1])
+CLAHE_BACKENDS = {
+    "skimage": _equalize_skimage,
+    "skimage_slices": _equalize_slices_skimage,
+    "fast": equalize_adapthist_fast,
+    "fast_slices": partial(equalize_adapthist_fast, per_slice=True),
+}
+
+# Motores que ecualizan cada plano por separado: aplicados bloque a bloque en
+# Z (modo streaming) dan exactamente el mismo resultado que sobre el stack entero
+PER_SLICE_BACKENDS = ("skimage_slices", "fast_slices")
+
+
+def get_clahe_backend(name):
+    """Devuelve la función CLAHE registrada con ese nombre."""
+    try:
+        return CLAHE_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Motor de CLAHE desconocido: {name!r} (opciones: {', '.join(CLAHE_BACKENDS)})")
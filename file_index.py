@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import time
+import socket
+
+# ====================================================================
+# Índice de archivos de entrada (agrupación por nombre base y canal)
+# ====================================================================
+#
+# La macro de Fiji guarda un TIFF por canal con el nombre
+# "<nombre base>_C00.tif", "<nombre base>_C01.tif"... Un único recorrido con
+# os.scandir y una expresión regular compilada reparte cada archivo en su
+# grupo (el canal es siempre el último "_C<dígitos>" antes de la extensión,
+# así que un nombre base que contenga "_C" no se rompe). Los TIFF sin canal
+# forman un grupo "SINGLECHANNEL" con su nombre sin extensión.
+#
+# El índice {base: {canal: [archivo, tamaño, mtime_ns]}} se guarda en
+# <salida>/_file_index.json. Si la fecha de modificación del directorio de
+# entrada no ha cambiado (no se han añadido, borrado ni renombrado archivos),
+# la siguiente ejecución lo reutiliza sin volver a listar el directorio.
+#
+# Antes de procesar se marcan los grupos incompletos: les falta algún canal
+# de expected_channels (por defecto, todos los canales vistos en el lote) o
+# alguno de sus archivos está vacío (copia a medias). Escribir un archivo no
+# cambia la fecha del directorio, así que el tamaño de los archivos vacíos
+# del índice se vuelve a comprobar en cada ejecución.
+
+FILE_INDEX_NAME = "_file_index.json"
+FILE_INDEX_VERSION = 1
+
+TIFF_NAME_RE = re.compile(r"^(?P<base>.+)_(?P<channel>C\d+)\.tiff?$", re.IGNORECASE)
+TIFF_EXT_RE = re.compile(r"\.tiff?$", re.IGNORECASE)
+
+# Margen de resolución de la fecha de modificación del directorio (p. ej. 2 s
+# en FAT, 1 s en algunos NFS): un índice guardado antes no se da por válido
+_MTIME_RESOLUTION_NS = 2 * 10**9
+
+
+def scan_tiff_dir(input_dir):
+    """
+    Recorre input_dir una vez -> {base: {canal: [archivo, tamaño, mtime_ns]}}.
+    En Windows el tamaño y la fecha vienen con el listado; en Linux/macOS
+    cuestan un stat por archivo.
+    """
+    groups = {}
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if not TIFF_EXT_RE.search(entry.name) or not entry.is_file():
+                continue
+            match = TIFF_NAME_RE.match(entry.name)
+            if match:
+                base_name, channel_name = match.group("base"), match.group("channel").upper()
+            else:
+                base_name, channel_name = os.path.splitext(entry.name)[0], "SINGLECHANNEL"
+            stat = entry.stat()
+            groups.setdefault(base_name, {})[channel_name] = [entry.name, stat.st_size, stat.st_mtime_ns]
+    return groups
+
+
+def load_file_index(input_dir, index_dir=None):
+    """
+    Índice de input_dir: el guardado en index_dir si el directorio no ha
+    cambiado desde entonces, o uno nuevo (que se guarda si hay index_dir).
+    """
+    dir_mtime_ns = os.stat(input_dir).st_mtime_ns
+    path = os.path.join(index_dir, FILE_INDEX_NAME) if index_dir else None
+    if path:
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+        if (cached.get("version") == FILE_INDEX_VERSION
+                and cached.get("input_dir") == os.path.abspath(input_dir)
+                and cached.get("dir_mtime_ns") == dir_mtime_ns
+                and cached.get("scanned_at_ns", 0) - dir_mtime_ns > _MTIME_RESOLUTION_NS):
+            return cached["groups"]
+
+    scanned_at_ns = time.time_ns()
+    groups = scan_tiff_dir(input_dir)
+    if path:
+        index = {"version": FILE_INDEX_VERSION, "input_dir": os.path.abspath(input_dir),
+                 "dir_mtime_ns": dir_mtime_ns, "scanned_at_ns": scanned_at_ns, "groups": groups}
+        # Temporal por proceso: varios workers del clúster pueden compartir la salida
+        tmp_path = f"{path}.{socket.gethostname()}-{os.getpid()}.partial"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    return groups
+
+
+def index_file_groups(groups):
+    """Índice -> {base: [(archivo, canal), ...]} (formato de file_groups), ordenado por nombre base."""
+    return {base_name: [(channels[channel_name][0], channel_name) for channel_name in sorted(channels)]
+            for base_name, channels in sorted(groups.items())}
+
+
+def _refresh_empty(input_dir, channels):
+    # El índice puede ser de cuando el archivo aún se estaba copiando
+    for entry in channels.values():
+        if entry[1] == 0:
+            try:
+                stat = os.stat(os.path.join(input_dir, entry[0]))
+            except OSError:
+                continue
+            entry[1], entry[2] = stat.st_size, stat.st_mtime_ns
+
+
+def incomplete_groups(groups, expected_channels=None, input_dir=None):
+    """
+    {base: motivo} de los grupos a los que les falta algún canal esperado o
+    que tienen archivos vacíos. Sin expected_channels se esperan todos los
+    canales vistos en el lote (sin contar los grupos SINGLECHANNEL). Con
+    input_dir, los archivos vacíos según el índice se vuelven a comprobar.
+    """
+    if expected_channels is None:
+        expected_channels = {channel_name for channels in groups.values() for channel_name in channels
+                             if channel_name != "SINGLECHANNEL"}
+    expected_channels = set(expected_channels)
+    incomplete = {}
+    for base_name, channels in groups.items():
+        if channels.keys() >= expected_channels and all(size for _, size, _ in channels.values()):
+            continue  # caso habitual: grupo completo
+        if channels.keys() == {"SINGLECHANNEL"}:
+            continue
+        if input_dir is not None:
+            _refresh_empty(input_dir, channels)
+        missing = sorted(expected_channels - channels.keys())
+        empty = sorted(file_name for file_name, size, _ in channels.values() if size == 0)
+        reasons = []
+        if missing:
+            reasons.append(f"faltan {', '.join(missing)}")
+        if empty:
+            reasons.append(f"vacíos: {', '.join(empty)}")
+        if reasons:
+            incomplete[base_name] = "; ".join(reasons)
+    return incomplete
@@ -0,0 +1,173 @@
+import queue
+import threading
+
+# ====================================================================
+# Pipeline de E/S asíncrona: lectura, cálculo y escritura solapados
+# ====================================================================
+#
+# En el modo secuencial cada canal se lee, se normaliza y se escribe antes
+# de empezar el siguiente, así que el disco está parado mientras se calcula
+# y la CPU mientras se lee o se escribe. Aquí cada etapa tiene sus propios
+# hilos conectados por colas acotadas:
+#
+#   tareas -> [lectores] -> cola -> [cálculo] -> cola -> [escritores] -> resultados
+#
+# Mientras un stack se normaliza, el siguiente ya se está leyendo y el
+# anterior escribiendo. La lectura/escritura de tifffile y los núcleos de
+# NumPy liberan el GIL, por lo que los hilos se solapan de verdad.
+#
+# Contrapresión: las colas tienen tamaño máximo (queue_size), de modo que
+# si el cálculo o la escritura van más lentos los lectores se bloquean en
+# lugar de acumular stacks en memoria. Además, con max_bytes se limita la
+# memoria de los stacks en vuelo (desde que empieza su lectura hasta que
+# termina su escritura); siempre se permite al menos uno para no bloquearse.
+
+
+class MemoryBudget:
+    """Presupuesto de bytes compartido entre hilos (None = sin límite)."""
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, cost):
+        """Reserva cost bytes, esperando si no caben (salvo que no haya nada en vuelo)."""
+        with self._condition:
+            while self.max_bytes and self.in_use and self.in_use + cost > self.max_bytes:
+                self._condition.wait()
+            self.in_use += cost
+
+    def release(self, cost):
+        with self._condition:
+            self.in_use -= cost
+            self._condition.notify_all()
+
+    def disable(self):
+        """Quita el límite y despierta a los que esperan (p. ej. al abortar el pipeline)."""
+        with self._condition:
+            self.max_bytes = None
+            self._condition.notify_all()
+
+
+# Marcas de fin de cola y de error, y tiempo máximo de espera en las colas (para poder abortar)
+_STOP = object()
+_FAILED = object()
+_POLL_S = 0.1
+
+
+def run_io_pipeline(tasks, read, compute, write, n_readers=2, n_compute=1, n_writers=2,
+                    queue_size=2, max_bytes=None, cost=None):
+    """
+    Ejecuta read(task) -> compute(task, datos) -> write(task, resultado) para
+    cada tarea, con cada etapa en sus propios hilos. Es un generador que
+    devuelve (task, salida de write) en orden de finalización, en el hilo
+    que lo recorre (el principal), de modo que el código que cierra cada
+    grupo no necesita ser seguro entre hilos.
+    cost(task) estima los bytes de la tarea para el presupuesto max_bytes.
+    compute recibe los datos en una lista de un elemento y puede vaciarla
+    para soltar la referencia cuanto antes (p. ej. el stack crudo).
+    Si una etapa falla, el resto se detiene y la excepción se propaga al que
+    recorre el generador.
+    """
+    tasks = list(tasks)
+    budget = MemoryBudget(max_bytes)
+    failed = threading.Event()
+    lock = threading.Lock()
+
+    task_queue = queue.Queue()
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    done_queue = queue.Queue()
+    for task in tasks:
+        task_queue.put((task, cost(task) if cost else 0, None))
+
+    def read_stage(task, task_cost, _):
+        budget.acquire(task_cost)
+        try:
+            return [read(task)]
+        except BaseException:
+            budget.release(task_cost)
+            raise
+
+    def compute_stage(task, _, payload):
+        return compute(task, payload)
+
+    def write_stage(task, task_cost, result):
+        try:
+            return write(task, result)
+        finally:
+            budget.release(task_cost)
+
+    def put(target, item):
+        while not failed.is_set():
+            try:
+                target.put(item, timeout=_POLL_S)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(source):
+        while not failed.is_set():
+            try:
+                return source.get(timeout=_POLL_S)
+            except queue.Empty:
+                if source is task_queue:
+                    return _STOP  # la cola de tareas está completa desde el principio
+        return _STOP
+
+    def worker(stage, source, target, n_stage, n_downstream, finished):
+        # Cada hilo procesa hasta el _STOP de su cola; el último de la etapa
+        # en terminar pasa un _STOP a cada hilo de la etapa siguiente
+        try:
+            while True:
+                item = get(source)
+                if item is _STOP:
+                    break
+                task, task_cost, payload = item
+                item = None
+                try:
+                    output = stage(task, task_cost, payload)
+                except BaseException as exc:
+                    failed.set()
+                    done_queue.put((_FAILED, exc, None))
+                    return
+                payload = None
+                if not put(target, (task, task_cost, output)):
+                    return
+                output = None
+        finally:
+            with lock:
+                finished.append(None)
+                last = len(finished) == n_stage
+            if last:
+                for _ in range(n_downstream):
+                    put(target, _STOP)
+
+    stages = [(read_stage, task_queue, read_queue, n_readers, n_compute),
+              (compute_stage, read_queue, write_queue, n_compute, n_writers),
+              (write_stage, write_queue, done_queue, n_writers, 1)]
+    threads = []
+    for stage, source, target, n_stage, n_downstream in stages:
+        finished = []
+        threads += [threading.Thread(target=worker, args=(stage, source, target, n_stage, n_downstream, finished),
+                                     daemon=True) for _ in range(n_stage)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = done_queue.get()
+            if item is _STOP:
+                break
+            if item[0] is _FAILED:
+                raise item[1]
+            task, _, output = item
+            yield task, output
+    finally:
+        # Al salir (fin, error o generador abandonado) se detienen los hilos
+        failed.set()
+        budget.disable()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,129 @@
+import queue
+import threading
+import numpy as np
+
+from output_writers import open_metadata_output
+
+# ====================================================================
+# QC con Napari sin bloquear el lote
+# ====================================================================
+#
+# El modo original abre un napari.Viewer() por grupo y llama a napari.run(),
+# que bloquea el lote hasta cerrar la ventana y mantiene en memoria los
+# arrays a resolución completa. En el modo "live" el lote corre en un hilo
+# aparte y un único visor recibe cada grupo terminado como pirámide
+# multiescala perezosa (dask) abierta desde los archivos de salida, con los
+# mismos colormaps que la previsualización original. Solo se conservan las
+# capas de los últimos LIVE_GROUPS_KEPT grupos.
+
+# Cada cuánto revisa el visor si hay grupos nuevos (ms)
+POLL_INTERVAL_MS = 500
+# Grupos que se conservan en el visor; las capas de los anteriores se eliminan
+# (y con ellas sus archivos abiertos) para que un lote largo no las acumule
+LIVE_GROUPS_KEPT = 3
+
+
+def napari_colormap(color_str, color_vectors):
+    """Colormap explícito a partir del nombre de color (igual que la previsualización original)."""
+    if color_str.lower() in ('gray', 'gris'):
+        return 'gray'
+    from napari.utils.colormaps import Colormap
+
+    color_vector = color_vectors.get(color_str.lower(), color_vectors['gray'])
+    colors = np.array([[0, 0, 0, 0], color_vector])
+    return Colormap(colors, name=f"{color_str}_direct")
+
+
+def lazy_pyramid(array, max_levels=4, min_size=256):
+    """
+    Pirámide multiescala perezosa: el nivel 0 es la salida abierta desde disco
+    y cada nivel siguiente submuestrea Y/X por 2 (sin leer nada hasta que
+    napari lo pide). Z se mantiene para no perder planos en la vista 3D.
+    """
+    import dask.array as da
+
+    levels = [da.from_array(array, chunks="auto")]
+    while len(levels) < max_levels and min(levels[-1].shape[-2:]) // 2 >= min_size:
+        levels.append(levels[-1][..., ::2, ::2])
+    return levels
+
+
+def add_group_layers(viewer, output_dir, base_name, metadata_list, color_vectors, save_dtype,
+                     keep_groups=LIVE_GROUPS_KEPT):
+    """
+    Añade al visor las capas de un grupo ya guardado, oculta las de los grupos
+    anteriores y elimina las que quedan fuera de los últimos keep_groups.
+    """
+    groups = list(dict.fromkeys(layer.metadata.get("qc_group") for layer in viewer.layers))
+    expired = set(groups[:max(len(groups) - keep_groups + 1, 0)])
+    for layer in list(viewer.layers):
+        if layer.metadata.get("qc_group") in expired:
+            viewer.layers.remove(layer)
+        else:
+            layer.visible = False
+
+    for metadata in metadata_list:
+        levels = lazy_pyramid(open_metadata_output(output_dir, metadata))
+
+        # Límites de contraste desde el nivel más pequeño (barato)
+        vmin, vmax = (int(v) for v in (levels[-1].min().compute(), levels[-1].max().compute()))
+        contrast_limits = [vmin, vmax] if vmin != vmax else [0, np.iinfo(save_dtype).max]
+
+        viewer.add_image(levels if len(levels) > 1 else levels[0],
+                         multiscale=len(levels) > 1,
+                         name=f"{base_name}: {metadata['original_channel_id']} (Norm)",
+                         colormap=napari_colormap(metadata["colormap"], color_vectors),
+                         contrast_limits=contrast_limits,
+                         blending='additive',
+                         metadata={"qc_group": base_name})
+    viewer.reset_view()
+
+
+def run_batch_with_live_qc(run_batch, output_dir, color_vectors, save_dtype, title="QC en vivo"):
+    """
+    Ejecuta run_batch(on_group_done) en un hilo y muestra cada grupo terminado
+    en un único visor de Napari mientras el lote sigue procesando. Al cerrar
+    el visor se espera a que termine el lote; los errores del lote se relanzan.
+    """
+    import napari
+    from qtpy.QtCore import QTimer
+
+    finished_groups = queue.Queue()
+    errors = []
+
+    def target():
+        try:
+            run_batch(lambda base_name, metadata_list: finished_groups.put((base_name, metadata_list)))
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            finished_groups.put(None)  # marca de fin del lote
+
+    viewer = napari.Viewer()
+    viewer.title = f"{title}: procesando..."
+
+    def poll():
+        while True:
+            try:
+                item = finished_groups.get_nowait()
+            except queue.Empty:
+                return
+            if item is None:
+                timer.stop()
+                viewer.title = f"{title}: lote terminado"
+                return
+            base_name, metadata_list = item
+            add_group_layers(viewer, output_dir, base_name, metadata_list, color_vectors, save_dtype)
+            viewer.title = f"{title}: {base_name}"
+
+    timer = QTimer()
+    timer.timeout.connect(poll)
+    timer.start(POLL_INTERVAL_MS)
+
+    batch_thread = threading.Thread(target=target, name="lote-normalizacion")
+    batch_thread.start()
+    napari.run()
+    # El visor se cerró: el lote continúa hasta terminar
+    batch_thread.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,91 @@
+import os
+import numpy as np
+
+# ====================================================================
+# Lectura directa de hyperstacks ND2 (sustituye a la macro de Fiji)
+# ====================================================================
+#
+# La macro nd2_to_tiff_2.0 abre cada .nd2 con Bio-Formats, separa los
+# canales y guarda <base>_C00.tif, <base>_C01.tif, <base>_C02.tif. Aquí se
+# leen los canales directamente con el paquete `nd2` (lectura perezosa con
+# dask), de forma que la normalización recibe los arrays sin escribir TIFF
+# intermedios. Los nombres de canal (C00, C01, ...) son los mismos que
+# produce la macro, así que CHANNEL_COLORS y CANAL_PARED_SATURADO aplican igual.
+
+ND2_EXTENSION = ".nd2"
+
+
+def _open_nd2(file_path):
+    try:
+        import nd2
+    except ImportError:
+        raise ImportError("Para leer archivos .nd2 directamente instala el paquete 'nd2' (pip install nd2).")
+    return nd2.ND2File(file_path)
+
+
+def is_nd2(file_path):
+    return file_path.lower().endswith(ND2_EXTENSION)
+
+
+def channel_names(n_channels):
+    """Nombres de canal con la convención de la macro de Fiji (C00, C01, ...)."""
+    if n_channels is None:
+        return ["SINGLECHANNEL"]
+    return [f"C{c:02d}" for c in range(n_channels)]
+
+
+def channel_index(channel_name):
+    """'C01' -> 1; 'SINGLECHANNEL' -> None."""
+    if channel_name == "SINGLECHANNEL":
+        return None
+    return int(channel_name.lstrip("C"))
+
+
+def group_nd2_files(input_dir):
+    """
+    Agrupa los .nd2 de input_dir como lo haría la macro: nombre base (sin
+    .nd2) -> [(archivo, canal), ...]. Solo lee la cabecera de cada archivo.
+    """
+    file_groups = {}
+    for f in sorted(os.listdir(input_dir)):
+        if not is_nd2(f):
+            continue
+        with _open_nd2(os.path.join(input_dir, f)) as nd2_file:
+            n_channels = nd2_file.sizes.get("C")
+        base_name = f[:-len(ND2_EXTENSION)]
+        file_groups[base_name] = [(f, name) for name in channel_names(n_channels)]
+    return file_groups
+
+
+def _channel_dask(nd2_file, channel_name):
+    """Array dask perezoso del canal (resto de ejes en el orden del archivo, p. ej. T, Z, Y, X)."""
+    data = nd2_file.to_dask()
+    axes = list(nd2_file.sizes)
+    index = channel_index(channel_name)
+    if index is not None and "C" in axes:
+        data = data[(slice(None),) * axes.index("C") + (index,)]
+    return data
+
+
+def nd2_channel_info(file_path, channel_name):
+    """(forma, dtype) de un canal sin leer los píxeles."""
+    with _open_nd2(file_path) as nd2_file:
+        data = _channel_dask(nd2_file, channel_name)
+        return tuple(data.shape), np.dtype(data.dtype)
+
+
+def read_nd2_channel(file_path, channel_name):
+    """Lee un canal completo como array de NumPy (solo ese canal pasa a memoria)."""
+    with _open_nd2(file_path) as nd2_file:
+        return np.asarray(_channel_dask(nd2_file, channel_name).compute())
+
+
+def iter_nd2_zchunks(file_path, channel_name, chunk_z):
+    """Itera sobre un canal en bloques de chunk_z planos (primer eje no espacial)."""
+    with _open_nd2(file_path) as nd2_file:
+        data = _channel_dask(nd2_file, channel_name)
+        if data.ndim < 3:
+            yield np.asarray(data.compute())
+            return
+        for z in range(0, data.shape[0], chunk_z):
+            yield np.asarray(data[z:z + chunk_z].compute())
@@ -0,0 +1,239 @@
+import threading
+import numpy as np
+from skimage import img_as_float
+
+# ====================================================================
+# Núcleos de normalización en float32 (sin copias intermedias)
+# ====================================================================
+#
+# El camino original hace img_as_float (float64) -> (x - min) / (max - min)
+# -> nan_to_num -> * max(dtype) -> astype, y cada paso crea un array nuevo
+# del tamaño del stack. Aquí se trabaja sobre un único buffer float32 que se
+# reutiliza entre canales del mismo tamaño, con ufuncs in-place (out=).
+
+# Buffers de trabajo reutilizables: uno por hilo (el modo de E/S en paralelo
+# normaliza en varios hilos a la vez); se reemplaza si cambia la forma. Al ser
+# locales del hilo, se liberan cuando el hilo termina (p. ej. los hilos de
+# cálculo de cada pipeline de io_pipeline.py).
+_WORK_BUFFER = threading.local()
+
+
+def get_work_buffer(shape):
+    """Devuelve un buffer float32 reutilizable (propio del hilo actual) con la forma pedida."""
+    shape = tuple(shape)
+    buf = getattr(_WORK_BUFFER, "buf", None)
+    if buf is None or buf.shape != shape:
+        _WORK_BUFFER.buf = None  # liberar el anterior antes de reservar el nuevo
+        buf = _WORK_BUFFER.buf = np.empty(shape, dtype=np.float32)
+    return buf
+
+
+def release_work_buffer():
+    """Libera el buffer de trabajo del hilo actual (p. ej. al terminar un lote)."""
+    _WORK_BUFFER.buf = None
+
+
+def data_range(data):
+    """
+    Min/Max de los datos crudos. Para enteros se calcula sin convertir a float;
+    para floats se ignoran NaN/Inf (equivalente a sanitizar antes).
+    """
+    if np.issubdtype(data.dtype, np.floating):
+        finite = np.isfinite(data)
+        if not finite.all():
+            if not finite.any():
+                return 0.0, 0.0
+            return data[finite].min(), data[finite].max()
+    return data.min(), data.max()
+
+
+def normalize_float32(data, normalize=True, out=None, value_range=None):
+    """
+    Convierte data a float32 en [0, 1] escribiendo en out (o en el buffer de
+    trabajo compartido). Equivale a img_as_float + Min/Max + nan_to_num.
+    value_range=(min, max) en unidades crudas fija el rango (p. ej. global al
+    procesar por bloques); si no, se calcula sobre data.
+    """
+    if out is None:
+        out = get_work_buffer(data.shape)
+
+    if np.issubdtype(data.dtype, np.unsignedinteger) or data.dtype == np.bool_:
+        # Escala de img_as_float para enteros sin signo: x / max(dtype)
+        dtype_max = 1 if data.dtype == np.bool_ else np.iinfo(data.dtype).max
+        if normalize:
+            min_val, max_val = value_range if value_range is not None else data_range(data)
+            # (x/M - min/M) / ((max - min)/M + 1e-8) == (x - min) / ((max - min) + 1e-8*M)
+            scale = 1.0 / ((float(max_val) - float(min_val)) + 1e-8 * dtype_max)
+            np.subtract(data, np.float32(min_val), out=out, casting="unsafe")
+            np.multiply(out, np.float32(scale), out=out)
+        else:
+            np.multiply(data, np.float32(1.0 / dtype_max), out=out, casting="unsafe")
+        return out
+
+    if np.issubdtype(data.dtype, np.floating):
+        np.copyto(out, data, casting="unsafe")
+        # Sanitización in-place (NaN/Inf -> 0) antes del Min/Max
+        np.nan_to_num(out, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+        if normalize:
+            min_val, max_val = value_range if value_range is not None else (out.min(), out.max())
+            np.subtract(out, np.float32(min_val), out=out)
+            np.multiply(out, np.float32(1.0 / ((float(max_val) - float(min_val)) + 1e-8)), out=out)
+        return out
+
+    # Enteros con signo u otros tipos: se respeta la semántica de img_as_float
+    np.copyto(out, img_as_float(data), casting="unsafe")
+    if normalize:
+        if value_range is None:
+            min_val, max_val = out.min(), out.max()
+        else:
+            min_val, max_val = img_as_float(np.asarray(value_range, dtype=data.dtype))
+        np.subtract(out, np.float32(min_val), out=out)
+        np.multiply(out, np.float32(1.0 / ((float(max_val) - float(min_val)) + 1e-8)), out=out)
+    np.nan_to_num(out, copy=False)
+    return out
+
+
+def to_output_dtype(data_norm, save_dtype, out=None):
+    """
+    Escala un array float en [0, 1] al rango de save_dtype y lo convierte
+    (truncando, igual que astype). data_norm se modifica in-place.
+    """
+    np.multiply(data_norm, data_norm.dtype.type(np.iinfo(save_dtype).max), out=data_norm)
+    if out is None:
+        out = np.empty(data_norm.shape, dtype=save_dtype)
+    np.copyto(out, data_norm, casting="unsafe")
+    return out
+
+
+# ====================================================================
+# Normalización por percentiles con histograma entero exacto + LUT
+# ====================================================================
+#
+# Para datos uint8/uint16 (los que produce la macro de Fiji o el ND2) el
+# histograma completo cabe en 256/65536 contadores: se construye con
+# np.bincount en una sola pasada (por bloques, sin convertir a float ni
+# ordenar) y de su suma acumulada salen los percentiles exactos, iguales a
+# los de np.percentile. Después cada intensidad posible se mapea una sola vez
+# en una tabla (LUT) y el stack se transforma con un único np.take.
+
+# Voxels por bloque de np.bincount / np.take: ambos convierten los índices a
+# intp internamente, y por bloques ese temporal se queda en caché
+_LUT_BLOCK = 2**20
+
+
+def lut_supported(dtype):
+    """True si el dtype admite histograma exacto y LUT (uint8/uint16)."""
+    return np.dtype(dtype) in (np.dtype(np.uint8), np.dtype(np.uint16))
+
+
+def integer_histogram(data, hist=None):
+    """
+    Histograma exacto de un array uint8/uint16 (un contador por valor posible).
+    Con hist se acumula sobre él (p. ej. bloque a bloque en streaming).
+    """
+    n_values = np.iinfo(data.dtype).max + 1
+    if hist is None:
+        hist = np.zeros(n_values, dtype=np.int64)
+    flat = data.reshape(-1)
+    for start in range(0, flat.size, _LUT_BLOCK):
+        hist += np.bincount(flat[start:start + _LUT_BLOCK], minlength=n_values)
+    return hist
+
+
+def apply_lut(lut, data, out=None):
+    """out[...] = lut[data] por bloques (data uint8/uint16, siempre dentro de la tabla)."""
+    if out is None:
+        out = np.empty(data.shape, dtype=lut.dtype)
+    flat, flat_out = data.reshape(-1), out.reshape(-1)
+    for start in range(0, flat.size, _LUT_BLOCK):
+        np.take(lut, flat[start:start + _LUT_BLOCK], out=flat_out[start:start + _LUT_BLOCK], mode="clip")
+    return out
+
+
+def histogram_percentiles(hist, percentiles):
+    """
+    Percentiles exactos a partir del histograma, con la misma interpolación
+    lineal que np.percentile (método por defecto).
+    """
+    cumulative = np.cumsum(hist)
+    n = int(cumulative[-1])
+    if n == 0:
+        return tuple(0.0 for _ in percentiles)
+    values = []
+    for p in percentiles:
+        rank = p / 100 * (n - 1)
+        lower = int(np.floor(rank))
+        upper = min(lower + 1, n - 1)
+        # Valor en la posición k de los datos ordenados
+        v_lower, v_upper = np.searchsorted(cumulative, [lower, upper], side="right")
+        values.append(float(v_lower) + (rank - lower) * float(v_upper - v_lower))
+    return tuple(values)
+
+
+def stack_percentiles(data, percentiles):
+    """Percentiles de un stack: histograma exacto para uint8/uint16, np.percentile en otro caso."""
+    if lut_supported(data.dtype):
+        return histogram_percentiles(integer_histogram(data), percentiles)
+    finite = np.nan_to_num(np.asarray(data, dtype=np.float32), nan=0.0, posinf=0.0, neginf=0.0)
+    return tuple(float(v) for v in np.percentile(finite, percentiles))
+
+
+def percentile_lut(low, high, in_dtype, out_dtype):
+    """
+    LUT que mapea cada valor de in_dtype (uint8/uint16) a [0, 1] según
+    (x - low) / (high - low), recortado, y luego a out_dtype: float32 deja
+    [0, 1] (para CLAHE); un entero se escala a su máximo y se trunca como astype.
+    """
+    values = np.arange(np.iinfo(in_dtype).max + 1, dtype=np.float64)
+    if high > low:
+        unit = np.clip((values - low) / (high - low), 0.0, 1.0)
+    else:
+        unit = np.zeros_like(values)
+    if np.issubdtype(out_dtype, np.floating):
+        return unit.astype(out_dtype)
+    return (unit * np.iinfo(out_dtype).max).astype(out_dtype)
+
+
+def minmax_lut(in_dtype, save_dtype, normalize=True, value_range=None, float32_kernel=True):
+    """
+    LUT de la normalización Min/Max + conversión a save_dtype para cada valor
+    posible de in_dtype (uint8/uint16), con value_range=(min, max) crudos.
+    Se calcula con las mismas operaciones elemento a elemento que el camino
+    float32 (o el float64 original con float32_kernel=False), así que aplicar
+    la tabla da exactamente el mismo resultado, sin img_as_float ni temporales
+    float del tamaño del stack.
+    """
+    values = np.arange(np.iinfo(in_dtype).max + 1, dtype=in_dtype)
+    if float32_kernel:
+        unit = normalize_float32(values, normalize, out=np.empty(values.shape, dtype=np.float32),
+                                 value_range=value_range)
+        return to_output_dtype(unit, save_dtype)
+
+    data_float = img_as_float(values)
+    if normalize:
+        min_val, max_val = img_as_float(np.asarray(value_range, dtype=in_dtype))
+        data_float = (data_float - min_val) / (max_val - min_val + 1e-8)
+    return (np.nan_to_num(data_float) * np.iinfo(save_dtype).max).astype(save_dtype)
+
+
+def normalize_percentile(data, low, high, out_dtype, out=None):
+    """
+    Normaliza data a [low, high] (percentiles ya calculados) en out_dtype.
+    uint8/uint16: un np.take sobre la LUT. Otros tipos: camino float32.
+    """
+    if lut_supported(data.dtype):
+        lut = percentile_lut(low, high, data.dtype, out_dtype)
+        if out is None and lut.dtype == np.float32:
+            out = get_work_buffer(data.shape)
+        return apply_lut(lut, data, out)
+
+    if out is None:
+        out = get_work_buffer(data.shape)
+    np.copyto(out, data, casting="unsafe")
+    np.nan_to_num(out, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+    np.subtract(out, np.float32(low), out=out)
+    np.multiply(out, np.float32(1.0 / (high - low) if high > low else 0.0), out=out)
+    np.clip(out, 0.0, 1.0, out=out)
+    if np.issubdtype(out_dtype, np.floating):
+        return out
+    return to_output_dtype(out, out_dtype)
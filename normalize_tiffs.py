@@ -1,12 +1,36 @@
 import os
 import sys
+import time
+import threading
 import numpy as np
 import json
-import napari
 from tqdm import tqdm
-from tifffile import imread, imwrite
-from skimage import exposure, img_as_float 
-from napari.utils.colormaps import Colormap # Importación compatible
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from tifffile import imread, TiffFile, memmap
+from skimage import img_as_float
+from normalization_kernels import (normalize_float32, to_output_dtype, data_range, lut_supported, integer_histogram,
+                                   histogram_percentiles, stack_percentiles, normalize_percentile, minmax_lut,
+                                   apply_lut)
+from fast_clahe import get_clahe_backend, PER_SLICE_BACKENDS
+from nd2_reader import is_nd2, group_nd2_files, nd2_channel_info, read_nd2_channel, iter_nd2_zchunks
+from batch_manifest import (load_manifest, save_manifest, group_inputs, group_is_current, record_group, output_size,
+                            partial_manifest_name, merge_manifests)
+from output_writers import (output_file_name, write_chunks, write_stack, open_output, output_description,
+                            hyperstack_file_name, create_hyperstack, write_hyperstack_channel, finish_hyperstack,
+                            open_metadata_output, HYPERSTACK_LAYOUTS)
+from napari_qc import napari_colormap, run_batch_with_live_qc
+from qc_thumbnails import (stack_mip, update_mip, output_mip, save_channel_mip, write_group_montage,
+                           write_contact_sheet)
+from run_report import RUN_REPORT_NAME, StageRecorder, report_rows, write_run_report, format_summary
+from cluster_shards import (CLAIMS_DIR_NAME, WorkClaims, default_worker_id, parse_shard, shard_groups,
+                            claim_key)
+from io_pipeline import run_io_pipeline
+from batch_config import load_config_file, parse_overrides, apply_config
+from file_index import load_file_index, index_file_groups, incomplete_groups
+from result_cache import (load_hash_index, save_hash_index, result_key, lookup_result, restore_result, store_result,
+                          store_result_array, evict_results)
+from stats_index import (STATS_INDEX_NAME, load_stats_index, save_stats_index, partial_stats_index_name,
+                         merge_stats_indexes, cached_file_hash, stats_key, encode_stats, shared_value_ranges)
 
 # ====================================================================
 # ---------- CONFIGURACIÓN CLAVE (AJUSTAR RUTAS Y CANALES) ----------
@@ -16,11 +40,121 @@ from napari.utils.colormaps import Colormap # Importación compatible
 input_dir_tiff = r"C:\Users\ThinkStation\Desktop\USUARIOS\AaronCastillo\Imagenesprueba\imagenes_tiff_raw"
 output_dir_final = r"C:\Users\ThinkStation\Desktop\USUARIOS\AaronCastillo\Imagenesprueba\imagenes_tiff_normalized"
 
+# Entrada: "tiff" (canales separados por la macro de Fiji) o "nd2" (lectura
+# directa de los hyperstacks, sin TIFF intermedios ni Fiji)
+input_format = "tiff"
+input_dir_nd2 = r"C:\Users\ThinkStation\Desktop\USUARIOS\AaronCastillo\Imagenesprueba\imagenes_nd2"
+
 # Ajustes de Procesamiento
 normalize = True       
 enhance_contrast = True # Aplicar CLAHE por defecto
 save_dtype = np.uint16 
+# Normalización: "minmax" (original) o "percentile" (recorta a los percentiles
+# percentile_range: un píxel caliente ya no aplasta el rango dinámico). Con
+# datos uint8/uint16 los percentiles salen de un histograma exacto y el
+# mapeo es una tabla (LUT), sin pasar por float.
+normalization_mode = "minmax"
+percentile_range = (0.1, 99.9)
+# Normalización compartida: un mismo rango por canal para todo el experimento
+# (intensidades comparables entre tiempos y raíces). Las estadísticas de cada
+# archivo se guardan en <salida>/_stats_index.json (clave: hash del contenido)
+# y se reutilizan en ejecuciones posteriores (ver stats_index.py).
+shared_normalization = False
 show_napari_preview = True 
+# "blocking": un visor por grupo que detiene el lote hasta cerrarlo (original).
+# "live": un único visor que recibe los grupos mientras el lote sigue corriendo.
+preview_mode = "live"
+
+# QC sin pantalla (nodos sin display): MIP por canal, montaje RGB por grupo y
+# hoja de contactos del lote en <salida>/_qc/ (ver qc_thumbnails.py)
+qc_thumbnails = True
+qc_thumbnail_size = 256
+
+# Informe de ejecución: tiempos, CPU, bytes y pico de memoria por etapa, canal
+# y grupo en <salida>/_run_report.json y .csv, más una tabla resumen al final.
+# trace_memory=True añade el pico de tracemalloc por etapa (más lento) y
+# cprofile_output guarda un perfil cProfile del proceso principal. Ambos se
+# pueden activar también con --tracemalloc y --cprofile [ARCHIVO].
+run_report = True
+trace_memory = False
+cprofile_output = None
+
+# Paralelismo: número de procesos (1 = secuencial) y memoria máxima (GB)
+# para los stacks en vuelo (None = sin límite, solo n_workers)
+n_workers = 1
+max_memory_gb = None
+
+# E/S solapada (con n_workers = 1 y sin streaming): mientras un stack se
+# normaliza, el siguiente se lee y el anterior se escribe, en hilos con colas
+# acotadas (contrapresión) y el límite de max_memory_gb (ver io_pipeline.py).
+pipelined_io = False
+io_threads = 2        # hilos lectores (y otros tantos escritores)
+compute_threads = 1   # hilos de normalización/CLAHE
+io_queue_size = 2     # stacks en espera entre etapas
+
+# Clúster: varios procesos/nodos con la misma salida en un sistema de archivos
+# compartido. n_shards > 1 reparte los grupos de forma fija (este proceso hace
+# el shard shard_index; también --shard i/N); work_queue=True los reparte bajo
+# demanda con archivos de claim (también --work-queue). Al terminar todos,
+# --merge combina los manifiestos parciales (ver cluster_shards.py).
+n_shards = 1
+shard_index = 0
+work_queue = False
+claim_stale_s = None  # segundos sin renovar tras los que un claim se da por abandonado
+
+# Modo streaming (fuera de memoria): procesa el stack en bloques de chunk_z planos
+# en lugar de cargarlo entero. Con CLAHE requiere un motor por planos
+# ("fast_slices" o "skimage_slices"): el CLAHE 3D por bloques crea bandas en Z.
+streaming = False
+chunk_z = 16
+
+# Núcleo de normalización en float32 in-place (menos memoria y copias).
+# Puede diferir en 1 unidad de uint16 respecto al camino float64 original.
+float32_kernel = True
+
+# Camino rápido por tabla (LUT) para entradas uint8/uint16 en canales sin CLAHE
+# (p. ej. CANAL_PARED_SATURADO): la normalización + conversión se precalcula
+# para los 256/65536 valores posibles y se aplica con np.take. Mismo resultado
+# exacto que el camino float; con CLAHE se usa siempre el camino float.
+lut_fast_path = True
+
+# Lotes incrementales: _manifest.json en la salida registra entradas, parámetros
+# y salidas de cada grupo; los grupos sin cambios se omiten y un lote
+# interrumpido se reanuda. manifest_hash=True compara el contenido (más lento)
+# en lugar de tamaño + fecha de modificación.
+incremental = True
+manifest_hash = False
+
+# Formato de salida: "tiff" (sin comprimir, original), "tiled_tiff" (teselas
+# comprimidas + predictor) u "ome_zarr" (bloques comprimidos con Blosc).
+# zstd requiere imagecodecs para "tiled_tiff"; "zlib" (deflate) no.
+output_format = "tiff"
+compression = "zstd"
+compression_level = None          # None = nivel por defecto del compresor
+output_chunks = (16, 256, 256)    # (Z, Y, X); en TIFF solo se usan (Y, X)
+compression_threads = os.cpu_count()
+
+# Hyperstack multicanal: None = un archivo por canal; "ZCYX" o "CZYX" = un
+# único OME-TIFF por grupo (<base>_normalized.ome.tif) con todos los canales
+# (solo con output_format = "tiff"; se escribe sin comprimir)
+hyperstack_layout = None
+
+# Caché de resultados por canal (barridos de parámetros, ver result_cache.py):
+# los canales con el mismo archivo crudo y los mismos parámetros efectivos se
+# enlazan/copian desde la caché en lugar de recalcularse. Puede compartirse
+# entre carpetas de salida. None = desactivada.
+result_cache_dir = None   # p. ej. r"D:\cache_normalizacion"
+result_cache_gb = 50      # tamaño máximo; se eliminan las entradas usadas hace más tiempo
+
+# Motor de CLAHE: "skimage" (original), "fast" (vectorizado, teselas 3D),
+# "fast_slices" o "skimage_slices" (CLAHE 2D plano a plano). Ver fast_clahe.py
+clahe_backend = "fast"
+
+# Grupos incompletos (falta un canal o hay archivos vacíos): se avisan al
+# inicio y, con skip_incomplete_groups, se omiten hasta que estén completos.
+# expected_channels = None espera todos los canales vistos en el lote.
+expected_channels = None   # p. ej. ("C00", "C01", "C02")
+skip_incomplete_groups = True
 
 # !!! IDENTIFICADOR DEL CANAL DE PARED CELULAR SATURADO !!!
 # Esto desactiva el CLAHE solo para este canal (para evitar saturación).
@@ -45,145 +179,1342 @@ CHANNEL_COLORS = {
     "SINGLECHANNEL": "gray",
 }
 
+# Variables que se pueden ajustar con --config (TOML/YAML) y --set clave=valor
+# sin editar este archivo (ver batch_config.py)
+CONFIG_KEYS = (
+    "input_dir_tiff", "output_dir_final", "input_format", "input_dir_nd2",
+    "normalize", "enhance_contrast", "save_dtype", "normalization_mode", "percentile_range",
+    "shared_normalization", "show_napari_preview", "preview_mode", "qc_thumbnails", "qc_thumbnail_size",
+    "run_report", "trace_memory", "cprofile_output", "n_workers", "max_memory_gb",
+    "pipelined_io", "io_threads", "compute_threads", "io_queue_size", "n_shards", "shard_index",
+    "work_queue", "claim_stale_s", "streaming", "chunk_z",
+    "float32_kernel", "lut_fast_path", "incremental", "manifest_hash", "output_format", "compression",
+    "compression_level", "output_chunks", "compression_threads", "hyperstack_layout", "clahe_backend",
+    "result_cache_dir", "result_cache_gb", "expected_channels",
+    "skip_incomplete_groups",
+    "CANAL_PARED_SATURADO", "COLOR_MAP_VECTORS", "CHANNEL_COLORS",
+)
+
 # ====================================================================
 
-def process_tiff_batch(input_dir, output_dir, color_config, normalize, enhance_contrast, save_dtype, show_preview):
+def stack_info(file_path, channel_name=None):
+    """(forma, dtype) de un canal leyendo solo la cabecera (TIFF o ND2)."""
+    if is_nd2(file_path):
+        return nd2_channel_info(file_path, channel_name)
+    with TiffFile(file_path) as tif:
+        return tuple(tif.series[0].shape), tif.series[0].dtype
+
+
+def read_channel(file_path, channel_name=None):
+    """Lee un canal completo: un TIFF por canal o el canal de un hyperstack ND2."""
+    if is_nd2(file_path):
+        return read_nd2_channel(file_path, channel_name)
+    return imread(file_path)
+
+
+def estimate_stack_memory(file_path, enhance, chunk_z=None, channel_name=None):
+    """
+    Estima el pico de memoria (bytes) que requiere procesar un stack.
+    Lee solo la cabecera del TIFF; si falla, usa el tamaño en disco.
+    Con chunk_z (modo streaming) solo cuenta un bloque de planos.
+    """
+    try:
+        shape, _ = stack_info(file_path, channel_name)
+        if chunk_z and len(shape) > 2:
+            shape = (min(chunk_z, shape[0]),) + tuple(shape[1:])
+        n_voxels = int(np.prod(shape))
+    except Exception:
+        n_voxels = os.path.getsize(file_path) // 2
+    # float64 (imagen + normalizada + temporales) y el resultado en uint16
+    factor = 8 * 3 + 2
+    if enhance:
+        factor += 8 * 2  # CLAHE trabaja con copias float adicionales
+    return n_voxels * factor
+
+
+def iter_zchunks(file_path, chunk_z, channel_name=None):
+    """
+    Itera sobre un TIFF en bloques de chunk_z planos sin cargarlo entero.
+    Usa memmap si los datos son contiguos y sin comprimir (caso de Fiji);
+    si no, lee página a página. Un TIFF 2D se devuelve como un único bloque.
+    Los .nd2 se leen por bloques del canal pedido.
+    """
+    if is_nd2(file_path):
+        yield from iter_nd2_zchunks(file_path, channel_name, chunk_z)
+        return
+
+    try:
+        data = memmap(file_path, mode='r')
+    except ValueError:
+        data = None
+
+    if data is not None:
+        if data.ndim < 3:
+            yield np.asarray(data)
+            return
+        for z in range(0, data.shape[0], chunk_z):
+            yield np.array(data[z:z + chunk_z])
+        return
+
+    with TiffFile(file_path) as tif:
+        series = tif.series[0]
+        if len(series.shape) < 3:
+            yield series.asarray()
+            return
+        pages = series.pages
+        for z in range(0, len(pages), chunk_z):
+            yield np.stack([page.asarray() for page in pages[z:z + chunk_z]])
+
+
+def check_streaming_clahe(clahe_backend):
+    """El CLAHE 3D no se puede aplicar por bloques en Z (cada bloque se reescala por su cuenta)."""
+    if clahe_backend not in PER_SLICE_BACKENDS:
+        raise ValueError(f"El modo streaming con CLAHE requiere un motor por planos "
+                         f"({', '.join(PER_SLICE_BACKENDS)}); recibido {clahe_backend!r}. "
+                         f"Usa uno de ellos o el modo en memoria.")
+
+
+def normalize_stack_streaming(file_path, save_path, normalize, should_enhance, save_dtype, chunk_z,
+                              float32_kernel=False, clahe_backend="skimage", channel_name=None,
+                              output_format="tiff", output_options=None, qc_mip=False, recorder=None,
+                              normalization_mode="minmax", percentiles=(0.1, 99.9), lut_fast_path=False,
+                              value_range=None, hyperstack=None):
+    """
+    Normalización Min/Max fuera de memoria en dos pasadas:
+    1) min/max global recorriendo los bloques, 2) normalizar y escribir cada
+    bloque directamente en la salida (memmap del TIFF, teselas o bloques
+    OME-Zarr). El resultado es idéntico al del modo en memoria; con CLAHE
+    solo se admiten los motores por planos (ver check_streaming_clahe).
+    Con qc_mip=True devuelve la MIP en Z de la salida, acumulada por bloques.
+    recorder (StageRecorder) recibe los tiempos de cada etapa.
+    Con normalization_mode="percentile" la primera pasada acumula el
+    histograma exacto (solo uint8/uint16) y la segunda aplica la LUT.
+    Con lut_fast_path=True, sin CLAHE y con datos uint8/uint16, el Min/Max
+    también se aplica con una LUT (mismo resultado que el camino float).
+    value_range=(bajo, alto) en unidades crudas (p. ej. compartido por todo el
+    lote) sustituye a la primera pasada.
+    """
+    recorder = recorder or StageRecorder()
+    if should_enhance:
+        check_streaming_clahe(clahe_backend)
+    shape, in_dtype = stack_info(file_path, channel_name)
+    percentile_mode = normalize and normalization_mode == "percentile"
+    if percentile_mode and not lut_supported(in_dtype):
+        raise ValueError(f"La normalización por percentiles en streaming requiere datos uint8/uint16 "
+                         f"(recibido {np.dtype(in_dtype).name}); usa el modo en memoria.")
+
+    # 1. Primera pasada (barata): min/max (o histograma) sobre los datos crudos
+    min_val = max_val = None
+    if normalize and value_range is not None:
+        if percentile_mode:
+            low, high = value_range
+        else:
+            raw_range = tuple(value_range)
+            min_val, max_val = img_as_float(np.array(raw_range, dtype=in_dtype))
+    elif percentile_mode:
+        with recorder.stage("histogram"):
+            hist = None
+            for chunk in recorder.timed_iter("read", iter_zchunks(file_path, chunk_z, channel_name)):
+                hist = integer_histogram(chunk, hist)
+            low, high = histogram_percentiles(hist, percentiles)
+    elif normalize:
+        with recorder.stage("stats_pass"):
+            for chunk in recorder.timed_iter("read", iter_zchunks(file_path, chunk_z, channel_name)):
+                chunk_min, chunk_max = data_range(chunk) if float32_kernel else (chunk.min(), chunk.max())
+                min_val = chunk_min if min_val is None else np.minimum(min_val, chunk_min)
+                max_val = chunk_max if max_val is None else np.maximum(max_val, chunk_max)
+            raw_range = (min_val, max_val)
+            # Misma escala que img_as_float sobre el stack completo
+            min_val, max_val = img_as_float(np.array([min_val, max_val], dtype=in_dtype))
+
+    lut = None
+    if lut_fast_path and not should_enhance and not percentile_mode and lut_supported(in_dtype):
+        lut = minmax_lut(in_dtype, save_dtype, normalize, raw_range if normalize else None, float32_kernel)
+
+    # 2. Segunda pasada: normalizar y escribir bloque a bloque
+    mip = None
+
+    def normalized_chunks():
+        nonlocal mip
+        for chunk in recorder.timed_iter("read", iter_zchunks(file_path, chunk_z, channel_name)):
+            if percentile_mode:
+                # Sin CLAHE la LUT ya da el dtype de salida
+                with recorder.stage("normalize"):
+                    chunk_norm = normalize_percentile(chunk, low, high, np.float32 if should_enhance else save_dtype)
+            elif lut is not None:
+                with recorder.stage("normalize"):
+                    chunk_norm = apply_lut(lut, chunk)
+            elif float32_kernel:
+                with recorder.stage("normalize"):
+                    chunk_norm = normalize_float32(chunk, normalize, value_range=raw_range if normalize else None)
+            else:
+                with recorder.stage("img_as_float"):
+                    chunk_norm = img_as_float(chunk)
+                with recorder.stage("normalize"):
+                    if normalize:
+                        chunk_norm = (chunk_norm - min_val) / (max_val - min_val + 1e-8)
+                    chunk_norm = np.nan_to_num(chunk_norm)
+
+            if should_enhance:
+                # CLAHE por planos: mismo resultado que sobre el stack completo
+                with recorder.stage("clahe"):
+                    chunk_norm = get_clahe_backend(clahe_backend)(chunk_norm)
+
+            if (percentile_mode and not should_enhance) or lut is not None:
+                chunk_final = chunk_norm
+            else:
+                with recorder.stage("convert"):
+                    if float32_kernel:
+                        chunk_final = to_output_dtype(chunk_norm, save_dtype)
+                    else:
+                        chunk_final = (chunk_norm * np.iinfo(save_dtype).max).astype(save_dtype)
+            if qc_mip:
+                with recorder.stage("qc_mip"):
+                    mip = update_mip(mip, chunk_final)
+            yield chunk_final
+
+    # (escritura atómica: una salida a medias nunca tiene el nombre final)
+    # El tiempo de "write" excluye el de las etapas que se ejecutan al pedir cada bloque
+    with recorder.stage("write") as write_stage:
+        if hyperstack is not None:
+            # (ruta del temporal, disposición, índice): el canal va a su sitio del hyperstack del grupo
+            write_hyperstack_channel(*hyperstack, normalized_chunks())
+            write_stage["bytes_written"] = int(np.prod(shape)) * np.dtype(save_dtype).itemsize
+        else:
+            write_chunks(save_path, shape, save_dtype, normalized_chunks(), output_format, **(output_options or {}))
+            write_stage["bytes_written"] = output_size(save_path)
+    return mip
+
+
+def process_channel(input_dir, output_dir, base_name, file_name, original_channel_name,
+                    color_config, normalize, enhance_contrast, save_dtype, return_data=False,
+                    streaming=False, chunk_z=16, float32_kernel=False, clahe_backend="skimage",
+                    output_format="tiff", compression="zstd", compression_level=None,
+                    output_chunks=(16, 256, 256), compression_threads=None, qc_thumbnails=False,
+                    trace_memory=False, normalization_mode="minmax", percentiles=(0.1, 99.9),
+                    lut_fast_path=False, value_ranges=None, hyperstack_layout=None, channel_index=None,
+                    result_cache_dir=None, cache_key=None):
+    """
+    Procesa un único canal (lectura, Min/Max, CLAHE selectivo, conversión y guardado).
+    Es una función de nivel de módulo para poder ejecutarse en un pool de procesos.
+    Con streaming=True el stack se procesa por bloques de chunk_z planos.
+    Con float32_kernel=True se usa el núcleo in-place de normalization_kernels.
+    clahe_backend elige el motor de CLAHE registrado en fast_clahe.CLAHE_BACKENDS.
+    output_format y los parámetros de compresión eligen el artefacto de salida
+    (ver output_writers.py).
+    Con qc_thumbnails=True guarda la MIP en Z del canal en <salida>/_qc/.
+    normalization_mode="percentile" normaliza entre los percentiles dados
+    (histograma exacto + LUT para uint8/uint16) en lugar de Min/Max.
+    Con lut_fast_path=True los canales uint8/uint16 sin CLAHE se normalizan
+    con una LUT (mismo resultado, sin img_as_float ni temporales float).
+    value_ranges={canal: (bajo, alto)} fija el rango de normalización del
+    canal (normalización compartida por todo el lote) en lugar de calcularlo.
+    Con hyperstack_layout ("ZCYX"/"CZYX") el canal se escribe en la posición
+    channel_index del hyperstack del grupo, ya preasignado (ver output_writers.py).
+    Con cache_key, si result_cache_dir ya tiene el resultado se reutiliza sin
+    recalcular y, si no, se añade al terminar (ver result_cache.py).
+    Devuelve la entrada de metadatos, la capa para Napari (si se pide) y las
+    etapas medidas para el informe de ejecución (ver run_report.py).
+    """
+    recorder = StageRecorder(trace_memory)
+    value_range = value_ranges.get(original_channel_name) if value_ranges else None
+    color = color_config.get(original_channel_name, 'gray')
+    file_path = os.path.join(input_dir, file_name)
+    metadata = channel_metadata(base_name, original_channel_name, color_config, output_format, compression,
+                                compression_level, output_chunks, hyperstack_layout, channel_index)
+    save_path_tiff = os.path.join(output_dir, metadata["file_name"])
+    hyperstack = (f"{save_path_tiff}.partial", hyperstack_layout, channel_index) if hyperstack_layout else None
+    output_options = dict(compression=compression, compression_level=compression_level,
+                          output_chunks=output_chunks, compression_threads=compression_threads)
+
+    # 0. Resultado ya calculado (mismo archivo crudo y mismos parámetros efectivos)
+    if cache_key and restore_cached_channel(result_cache_dir, cache_key, output_dir, base_name, metadata,
+                                            recorder, qc_thumbnails):
+        return metadata, output_layer_info(output_dir, metadata, return_data), recorder.records
+
+    if streaming:
+        should_enhance = enhance_contrast and original_channel_name != CANAL_PARED_SATURADO
+        if enhance_contrast and not should_enhance:
+            print(f"   [INFO] Saltando CLAHE para el canal {CANAL_PARED_SATURADO} (Pared Celular) para evitar saturación.")
+        mip = normalize_stack_streaming(file_path, save_path_tiff, normalize, should_enhance, save_dtype, chunk_z,
+                                        float32_kernel, clahe_backend, original_channel_name,
+                                        output_format, dict(output_options, channel_name=original_channel_name,
+                                                            color=color), qc_mip=qc_thumbnails,
+                                        recorder=recorder, normalization_mode=normalization_mode,
+                                        percentiles=percentiles, lut_fast_path=lut_fast_path,
+                                        value_range=value_range, hyperstack=hyperstack)
+        if qc_thumbnails:
+            with recorder.stage("qc_mip"):
+                save_channel_mip(output_dir, base_name, original_channel_name, mip)
+        if cache_key:
+            store_cached_channel(result_cache_dir, cache_key, output_dir, metadata, recorder)
+        return metadata, output_layer_info(output_dir, metadata, return_data), recorder.records
+
+    with recorder.stage("read") as read_stage:
+        data = read_channel(file_path, original_channel_name) # Leer el Stack 3D completo
+        read_stage["bytes_read"] = data.nbytes
+
+    should_enhance = channel_should_enhance(original_channel_name, enhance_contrast)
+    data_norm, is_final = normalize_channel_data(data, normalize, save_dtype, should_enhance, recorder,
+                                                 float32_kernel, normalization_mode, percentiles,
+                                                 lut_fast_path, value_range)
+    del data
+    data_final = finish_channel_data(data_norm, is_final, should_enhance, save_dtype, recorder,
+                                     float32_kernel, clahe_backend)
+    del data_norm
+
+    metadata = save_channel_output(output_dir, base_name, original_channel_name, color_config, data_final,
+                                   recorder, output_format, compression, compression_level, output_chunks,
+                                   compression_threads, qc_thumbnails, hyperstack_layout, channel_index)
+    if cache_key:
+        store_cached_channel(result_cache_dir, cache_key, output_dir, metadata, recorder)
+
+    # 3. Almacenar para Napari (solo si se va a previsualizar)
+    layer_info = (data_final, f"{original_channel_name} (Norm)", color) if return_data else None
+    return metadata, layer_info, recorder.records
+
+
+def channel_should_enhance(original_channel_name, enhance_contrast):
+    """LÓGICA CONDICIONAL DE MEJORA DE CONTRASTE (CLAHE): nunca en el canal de pared saturado."""
+    should_enhance = enhance_contrast
+
+    if original_channel_name == CANAL_PARED_SATURADO:
+        should_enhance = False
+        print(f"   [INFO] Saltando CLAHE para el canal {CANAL_PARED_SATURADO} (Pared Celular) para evitar saturación.")
+    return should_enhance
+
+
+def normalize_channel_data(data, normalize, save_dtype, should_enhance, recorder, float32_kernel=False,
+                           normalization_mode="minmax", percentiles=(0.1, 99.9), lut_fast_path=False,
+                           value_range=None):
+    """
+    Normalización de un stack en memoria (Min/Max, percentiles o LUT).
+    Devuelve (data_norm, is_final): is_final indica que data_norm ya está en
+    save_dtype (caminos LUT sin CLAHE). El llamador debe soltar data después
+    para no mantener el stack crudo durante el CLAHE.
+    """
+    percentile_mode = normalize and normalization_mode == "percentile"
+    lut_path = lut_fast_path and not should_enhance and not percentile_mode and lut_supported(data.dtype)
+    if percentile_mode:
+        # Percentiles exactos desde el histograma de los datos crudos (sin float ni ordenar)
+        if value_range is not None:
+            low, high = value_range
+        else:
+            with recorder.stage("histogram"):
+                low, high = stack_percentiles(data, percentiles)
+        # Sin CLAHE la LUT ya da el dtype de salida; con CLAHE, float32 en [0, 1]
+        with recorder.stage("normalize"):
+            data_norm = normalize_percentile(data, low, high, np.float32 if should_enhance else save_dtype)
+        return data_norm, not should_enhance
+
+    if lut_path:
+        # Min/Max + conversión precalculados para cada valor posible: un np.take
+        with recorder.stage("normalize"):
+            if normalize:
+                lut_range = value_range if value_range is not None else data_range(data)
+            else:
+                lut_range = None
+            lut = minmax_lut(data.dtype, save_dtype, normalize, lut_range, float32_kernel)
+            return apply_lut(lut, data), True
+
+    if float32_kernel:
+        # Min/Max + sanitización en float32 sobre un buffer reutilizado
+        with recorder.stage("normalize"):
+            return normalize_float32(data, normalize, value_range=value_range), False
+
+    # Convertir a float (0-1)
+    with recorder.stage("img_as_float"):
+        data_float = img_as_float(data)
+
+    with recorder.stage("normalize"):
+        # Normalización Min/Max
+        if normalize:
+            if value_range is not None:
+                min_val, max_val = img_as_float(np.asarray(value_range, dtype=data.dtype))
+            else:
+                min_val = data_float.min()
+                max_val = data_float.max()
+            data_norm = (data_float - min_val) / (max_val - min_val + 1e-8)
+        else:
+            data_norm = data_float
+
+        # ------------------------------------------------------------------
+        # CORRECCIÓN DE ERROR: Sanitización de datos (reemplazar NaN/Inf por 0)
+        # Esto evita el error 'invalid syntax' en equalize_adapthist.
+        data_norm = np.nan_to_num(data_norm)
+        # ------------------------------------------------------------------
+    return data_norm, False
+
+
+def finish_channel_data(data_norm, is_final, should_enhance, save_dtype, recorder, float32_kernel=False,
+                        clahe_backend="skimage"):
+    """CLAHE (si corresponde) y conversión al tipo de salida de un stack normalizado."""
+    if should_enhance:
+        # CLAHE aplicado al stack 3D (teselas 3D o plano a plano según el motor)
+        with recorder.stage("clahe"):
+            data_norm = get_clahe_backend(clahe_backend)(data_norm)
+
+    # Convertir de vuelta al tipo de dato de salida (uint16)
+    if is_final:
+        return data_norm
+    with recorder.stage("convert"):
+        if float32_kernel:
+            return to_output_dtype(data_norm, save_dtype)
+        return (data_norm * np.iinfo(save_dtype).max).astype(save_dtype)
+
+
+def save_channel_output(output_dir, base_name, original_channel_name, color_config, data_final, recorder,
+                        output_format="tiff", compression="zstd", compression_level=None,
+                        output_chunks=(16, 256, 256), compression_threads=None, qc_thumbnails=False,
+                        hyperstack_layout=None, channel_index=None):
+    """
+    Guarda el stack final de un canal (y su MIP de QC) y devuelve su entrada de metadatos.
+    Con hyperstack_layout lo escribe en la posición channel_index del hyperstack del grupo.
+    """
+    metadata = channel_metadata(base_name, original_channel_name, color_config, output_format, compression,
+                                compression_level, output_chunks, hyperstack_layout, channel_index)
+    color = metadata["colormap"]
+    save_path_tiff = os.path.join(output_dir, metadata["file_name"])
+
+    # 2. Guardar el TIFF 3D procesado (o el formato por bloques elegido)
+    # (escritura atómica: temporal + renombrado, para detectar salidas a medias)
+    with recorder.stage("write") as write_stage:
+        if hyperstack_layout:
+            # El hyperstack se renombra al terminar el grupo (finish_hyperstack)
+            write_hyperstack_channel(f"{save_path_tiff}.partial", hyperstack_layout, channel_index, [data_final])
+            write_stage["bytes_written"] = data_final.nbytes
+        else:
+            write_stack(save_path_tiff, data_final, output_format, compression=compression,
+                        compression_level=compression_level, output_chunks=output_chunks,
+                        compression_threads=compression_threads, channel_name=original_channel_name, color=color)
+            write_stage["bytes_written"] = output_size(save_path_tiff)
+    if qc_thumbnails:
+        # MIP desde el stack que ya está en memoria
+        with recorder.stage("qc_mip"):
+            save_channel_mip(output_dir, base_name, original_channel_name, stack_mip(data_final))
+    return metadata
+
+
+def channel_metadata(base_name, original_channel_name, color_config, output_format="tiff", compression="zstd",
+                     compression_level=None, output_chunks=(16, 256, 256), hyperstack_layout=None,
+                     channel_index=None):
+    """Entrada de _metadata.json de un canal: su archivo de salida, color y cómo está escrito."""
+    if hyperstack_layout:
+        file_name_tiff = hyperstack_file_name(base_name)
+    else:
+        file_name_tiff = output_file_name(base_name, original_channel_name, output_format)
+    return {
+        "file_name": file_name_tiff,
+        "original_channel_id": original_channel_name,
+        "colormap": color_config.get(original_channel_name, 'gray'),
+        **output_description(output_format, compression, compression_level, output_chunks,
+                             hyperstack_layout, channel_index)
+    }
+
+
+def output_layer_info(output_dir, metadata, return_data):
+    """
+    Capa para Napari abierta desde disco (sin cargarla si es posible). Un
+    canal de un hyperstack se abre al cerrar el grupo, cuando ya tiene su
+    nombre final (aquí queda None).
+    """
+    if not return_data:
+        return None
+    data = None if "layout" in metadata else open_metadata_output(output_dir, metadata)
+    return data, f"{metadata['original_channel_id']} (Norm)", metadata["colormap"]
+
+
+def restore_cached_channel(result_cache_dir, cache_key, output_dir, base_name, metadata, recorder,
+                           qc_thumbnails=False):
+    """
+    Si la caché de resultados tiene el canal, crea su salida desde ella
+    (enlace duro o copia; en un hyperstack, escritura en su sitio) y su MIP
+    de QC. Devuelve True si se reutilizó.
+    """
+    with recorder.stage("cache_lookup"):
+        entry_path = lookup_result(result_cache_dir, cache_key)
+    if entry_path is None:
+        return False
+    save_path = os.path.join(output_dir, metadata["file_name"])
+    layout = metadata.get("layout")
+    with recorder.stage("cache_restore") as restore_stage:
+        if layout:
+            data = open_output(entry_path)
+            write_hyperstack_channel(f"{save_path}.partial", layout, metadata["channel_index"], [data])
+            restore_stage["bytes_written"] = data.nbytes
+        else:
+            restore_result(entry_path, save_path)
+    if qc_thumbnails:
+        with recorder.stage("qc_mip"):
+            data = open_output(entry_path, "tiff" if layout else metadata.get("format", "tiff"))
+            save_channel_mip(output_dir, base_name, metadata["original_channel_id"], output_mip(data))
+    return True
+
+
+def store_cached_channel(result_cache_dir, cache_key, output_dir, metadata, recorder):
+    """Añade a la caché de resultados la salida recién escrita de un canal."""
+    save_path = os.path.join(output_dir, metadata["file_name"])
+    with recorder.stage("cache_store"):
+        if "layout" in metadata:
+            store_result_array(result_cache_dir, cache_key,
+                               open_output(f"{save_path}.partial", layout=metadata["layout"],
+                                           channel_index=metadata["channel_index"]))
+        else:
+            store_result(result_cache_dir, cache_key, save_path)
+
+
+def write_group_metadata(output_dir, base_name, metadata_list):
+    """Guarda el archivo de metadatos JSON de un grupo."""
+    metadata_file_name = f"{base_name}_metadata.json"
+    metadata_save_path = os.path.join(output_dir, metadata_file_name)
+    with open(f"{metadata_save_path}.partial", 'w') as f:
+        json.dump(metadata_list, f, indent=4)
+    os.replace(f"{metadata_save_path}.partial", metadata_save_path)
+    return metadata_file_name
+
+
+def preview_group_napari(base_name, napari_layers_info, save_dtype):
+    """Previsualización con Napari 3D (bloqueante) de un grupo ya procesado."""
+    import napari  # importación tardía: los lotes sin previsualización no cargan Qt/napari
+
+    viewer = napari.Viewer()
+    viewer.title = f"QC Final 3D: {base_name}"
+
+    for d, name, color_str in napari_layers_info:
+
+        # Creación de Colormap explícito para compatibilidad
+        custom_colormap = napari_colormap(color_str, COLOR_MAP_VECTORS)
+
+        vmin = d.min()
+        vmax = d.max()
+        contrast_limits = [vmin, vmax] if vmin != vmax else [0, np.iinfo(save_dtype).max]
+
+        # Se agrega como imagen 3D automáticamente
+        viewer.add_image(d,
+                         name=name,
+                         colormap=custom_colormap,
+                         contrast_limits=contrast_limits,
+                         blending='additive')
+
+    viewer.reset_view()
+    napari.run()
+
+
+def _set_saturated_channel(channel_name):
+    global CANAL_PARED_SATURADO
+    CANAL_PARED_SATURADO = channel_name
+
+
+def _run_groups_parallel(file_groups, input_dir, output_dir, color_config, normalize,
+                         enhance_contrast, save_dtype, show_preview, n_workers, max_memory_gb,
+                         finish_group, start_group=None, cache_keys=None, **channel_options):
+    """
+    Reparte los canales de todos los grupos en un pool de procesos.
+    Limita los stacks simultáneos con un presupuesto de memoria estimado y
+    cierra cada grupo en cuanto terminan todos sus canales:
+    finish_group(base_name, files_list, results) con los resultados de
+    process_channel en el orden de canales del modo secuencial.
+    start_group(base_name, files_list), si se da, se llama antes de enviar
+    el primer canal de cada grupo (p. ej. para preasignar el hyperstack).
+    cache_keys {(archivo, canal): clave} activa la caché de resultados.
+    file_groups también puede ser un iterador de (grupo, archivos) que se
+    consume solo cuando queda un worker libre (con la cola de trabajo, cada
+    grupo se reclama justo antes de enviarlo y el pool es el mismo para toda
+    la cola); quien lo genera puede ir añadiendo sus claves a cache_keys.
+    """
+    budget = max_memory_gb * 1024**3 if max_memory_gb else None
+    group_files = {}  # grupo -> archivos, a medida que se leen de file_groups
+    pending_channels = {}
+    results = {}
+
+    def channel_tasks():
+        # Tareas en el mismo orden que el modo secuencial
+        pairs = file_groups.items() if isinstance(file_groups, dict) else file_groups
+        for base_name, files_list in pairs:
+            group_files[base_name] = files_list
+            pending_channels[base_name] = len(files_list)
+            results[base_name] = {}
+            for channel_index, (file_name, original_channel_name) in enumerate(sorted(files_list)):
+                should_enhance = enhance_contrast and original_channel_name != CANAL_PARED_SATURADO
+                chunk = channel_options.get('chunk_z') if channel_options.get('streaming') else None
+                cost = estimate_stack_memory(os.path.join(input_dir, file_name), should_enhance, chunk,
+                                             original_channel_name) if budget else 0
+                yield base_name, file_name, original_channel_name, channel_index, cost
+
+    tasks = channel_tasks()
+
+    # Los workers (spawn en Windows) reimportan el módulo: se les pasa el canal
+    # de pared por si se cambió con --config/--set
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_set_saturated_channel,
+                             initargs=(CANAL_PARED_SATURADO,)) as executor, \
+         tqdm(total=len(file_groups) if isinstance(file_groups, dict) else None,
+              desc="Procesando grupos de TIFF 3D") as pbar:
+        in_flight = {}
+        memory_in_use = 0
+        next_task = None
+
+        while True:
+            # Enviar tareas mientras haya workers libres y memoria disponible.
+            # Siempre se permite al menos un stack en vuelo para no bloquearse.
+            # La siguiente tarea se pide solo con un worker libre.
+            while len(in_flight) < n_workers:
+                if next_task is None:
+                    next_task = next(tasks, None)
+                    if next_task is None:
+                        break
+                base_name, file_name, original_channel_name, channel_index, cost = next_task
+                if budget and in_flight and memory_in_use + cost > budget:
+                    break
+                if start_group and channel_index == 0:
+                    start_group(base_name, group_files[base_name])
+                future = executor.submit(
+                    process_channel, input_dir, output_dir, base_name, file_name,
+                    original_channel_name, color_config, normalize, enhance_contrast,
+                    save_dtype, show_preview, channel_index=channel_index,
+                    cache_key=cache_keys.get((file_name, original_channel_name)) if cache_keys else None,
+                    **channel_options
+                )
+                in_flight[future] = (base_name, file_name, cost)
+                memory_in_use += cost
+                next_task = None
+
+            if not in_flight:
+                break  # sin tareas pendientes
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                base_name, file_name, cost = in_flight.pop(future)
+                memory_in_use -= cost
+                results[base_name][file_name] = future.result()
+                pending_channels[base_name] -= 1
+
+                if pending_channels[base_name] == 0:
+                    # Reordenar según el orden de canales del modo secuencial
+                    files_list = sorted(group_files.pop(base_name))
+                    ordered = [results[base_name][f] for f, _ in files_list]
+                    del results[base_name], pending_channels[base_name]
+                    finish_group(base_name, files_list, ordered)
+                    pbar.update(1)
+
+
+def _run_groups_pipelined(file_groups, input_dir, output_dir, color_config, normalize,
+                          enhance_contrast, save_dtype, show_preview, max_memory_gb, finish_group,
+                          start_group=None, cache_keys=None, io_threads=2, compute_threads=1, io_queue_size=2, trace_memory=False,
+                          float32_kernel=False, clahe_backend="skimage", output_format="tiff",
+                          compression="zstd", compression_level=None, output_chunks=(16, 256, 256),
+                          compression_threads=None, qc_thumbnails=False, normalization_mode="minmax",
+                          percentiles=(0.1, 99.9), lut_fast_path=False, value_ranges=None,
+                          hyperstack_layout=None, result_cache_dir=None, **_):
+    """
+    Procesa los canales en un único proceso con lectura, cálculo y escritura
+    solapados en hilos (ver io_pipeline.py): io_threads lectores y escritores,
+    compute_threads hilos de normalización/CLAHE y colas de io_queue_size
+    stacks. max_memory_gb limita los stacks en vuelo (estimación del pico).
+    Mismo resultado que el modo secuencial; cada grupo se cierra en el hilo
+    principal con finish_group(base_name, files_list, results) en cuanto
+    terminan todos sus canales; start_group(base_name, files_list), si se da,
+    se llama (una vez por grupo) antes de leer su primer canal. Los canales
+    que ya están en la caché de resultados (cache_keys) se restauran en la
+    etapa de lectura y no pasan por el cálculo. En el
+    informe, el tiempo de CPU por etapa es el del proceso entero (incluye el
+    de los otros hilos).
+    """
+    budget = max_memory_gb * 1024**3 if max_memory_gb else None
+    tasks = [(base_name, file_name, original_channel_name, channel_index)
+             for base_name, files_list in file_groups.items()
+             for channel_index, (file_name, original_channel_name) in enumerate(sorted(files_list))]
+    recorders = {}
+    restored = {}
+    started_groups = set()
+    start_lock = threading.Lock()
+
+    def stack_cost(task):
+        _, file_name, original_channel_name, _ = task
+        should_enhance = enhance_contrast and original_channel_name != CANAL_PARED_SATURADO
+        return estimate_stack_memory(os.path.join(input_dir, file_name), should_enhance,
+                                     channel_name=original_channel_name)
+
+    def read(task):
+        base_name, file_name, original_channel_name, _ = task
+        if start_group:
+            with start_lock:
+                if base_name not in started_groups:
+                    started_groups.add(base_name)
+                    start_group(base_name, file_groups[base_name])
+        recorder = recorders[task] = StageRecorder(trace_memory)
+        cache_key = cache_keys.get((file_name, original_channel_name)) if cache_keys else None
+        if cache_key:
+            metadata = channel_metadata(base_name, original_channel_name, color_config, output_format, compression,
+                                        compression_level, output_chunks, hyperstack_layout, task[3])
+            if restore_cached_channel(result_cache_dir, cache_key, output_dir, base_name, metadata, recorder,
+                                      qc_thumbnails):
+                restored[task] = (metadata, output_layer_info(output_dir, metadata, show_preview),
+                                  recorder.records)
+                return None  # sin datos: el canal no pasa por el cálculo
+        with recorder.stage("read") as read_stage:
+            data = read_channel(os.path.join(input_dir, file_name), original_channel_name)
+            read_stage["bytes_read"] = data.nbytes
+        return data
+
+    def compute(task, payload):
+        _, _, original_channel_name, _ = task
+        recorder = recorders[task]
+        value_range = value_ranges.get(original_channel_name) if value_ranges else None
+        data = payload.pop()  # el stack crudo solo lo referencia este hilo
+        if data is None:
+            return None  # restaurado desde la caché de resultados
+        should_enhance = channel_should_enhance(original_channel_name, enhance_contrast)
+        data_norm, is_final = normalize_channel_data(data, normalize, save_dtype, should_enhance, recorder,
+                                                     float32_kernel, normalization_mode, percentiles,
+                                                     lut_fast_path, value_range)
+        del data
+        return finish_channel_data(data_norm, is_final, should_enhance, save_dtype, recorder,
+                                   float32_kernel, clahe_backend)
+
+    def write(task, data_final):
+        base_name, file_name, original_channel_name, channel_index = task
+        recorder = recorders.pop(task)
+        if data_final is None:
+            return restored.pop(task)
+        metadata = save_channel_output(output_dir, base_name, original_channel_name, color_config, data_final,
+                                       recorder, output_format, compression, compression_level, output_chunks,
+                                       compression_threads, qc_thumbnails, hyperstack_layout, channel_index)
+        cache_key = cache_keys.get((file_name, original_channel_name)) if cache_keys else None
+        if cache_key:
+            store_cached_channel(result_cache_dir, cache_key, output_dir, metadata, recorder)
+        color = color_config.get(original_channel_name, 'gray')
+        layer_info = (data_final, f"{original_channel_name} (Norm)", color) if show_preview else None
+        return metadata, layer_info, recorder.records
+
+    pending_channels = {base_name: len(files_list) for base_name, files_list in file_groups.items()}
+    results = {base_name: {} for base_name in file_groups}
+
+    with tqdm(total=len(file_groups), desc="Procesando grupos de TIFF 3D") as pbar:
+        for (base_name, file_name, _, _), result in run_io_pipeline(
+                tasks, read, compute, write, n_readers=io_threads, n_compute=compute_threads,
+                n_writers=io_threads, queue_size=io_queue_size, max_bytes=budget,
+                cost=stack_cost if budget else None):
+            results[base_name][file_name] = result
+            pending_channels[base_name] -= 1
+
+            if pending_channels[base_name] == 0:
+                # Reordenar según el orden de canales del modo secuencial
+                files_list = sorted(file_groups[base_name])
+                ordered = [results[base_name][f] for f, _ in files_list]
+                del results[base_name]
+                finish_group(base_name, files_list, ordered)
+                pbar.update(1)
+
+
+def compute_channel_stats(file_path, channel_name=None, chunk_z=16):
+    """Min, max e histograma exacto (uint8/uint16) de un canal, leído por bloques."""
+    min_val = max_val = hist = dtype = None
+    for chunk in iter_zchunks(file_path, chunk_z, channel_name):
+        dtype = chunk.dtype
+        chunk_min, chunk_max = data_range(chunk)
+        min_val = chunk_min if min_val is None else min(min_val, chunk_min)
+        max_val = chunk_max if max_val is None else max(max_val, chunk_max)
+        if lut_supported(dtype):
+            hist = integer_histogram(chunk, hist)
+    return encode_stats(min_val, max_val, dtype, hist)
+
+
+def collect_shared_stats(input_dir, output_dir, file_groups, n_workers=1, chunk_z=16,
+                         normalization_mode="minmax", percentiles=(0.1, 99.9), compute_missing=True,
+                         index_name=STATS_INDEX_NAME):
+    """
+    Primera pasada de la normalización compartida: estadísticas de cada canal
+    de cada archivo (en paralelo, solo las que no están en el índice) y rango
+    común por canal para todo el lote: {canal: [bajo, alto]}.
+    Con compute_missing=False (workers del clúster) no se lee ningún archivo:
+    todas las estadísticas deben estar ya en el índice (o en los parciales de
+    la pasada --stats-only). index_name es el índice en el que se guardan.
+    """
+    index = load_stats_index(output_dir, include_partials=True)
+    keys = {}
+    missing = {}
+    unknown = 0  # archivos sin hash en el índice (solo con compute_missing=False)
+    for files_list in file_groups.values():
+        for file_name, original_channel_name in files_list:
+            file_path = os.path.join(input_dir, file_name)
+            file_hash = cached_file_hash(index, file_path, compute=compute_missing)
+            if file_hash is None:
+                unknown += 1
+                continue
+            key = stats_key(file_hash, original_channel_name)
+            keys[(file_name, original_channel_name)] = key
+            if key not in index["stats"]:
+                missing[key] = (file_path, original_channel_name)
+    if (missing or unknown) and not compute_missing:
+        raise ValueError(f"Faltan las estadísticas compartidas de {len(missing) + unknown} canales: en el "
+                         f"clúster se calculan antes con --stats-only (ver cluster_shards.py).")
+    print(f"Estadísticas compartidas: {len(keys) - len(missing)} canales en caché, {len(missing)} por calcular.")
+
+    if n_workers > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {key: executor.submit(compute_channel_stats, file_path, channel_name, chunk_z)
+                       for key, (file_path, channel_name) in missing.items()}
+            for key, future in tqdm(futures.items(), desc="Estadísticas por canal"):
+                index["stats"][key] = future.result()
+    else:
+        for key, (file_path, channel_name) in tqdm(missing.items(), desc="Estadísticas por canal"):
+            index["stats"][key] = compute_channel_stats(file_path, channel_name, chunk_z)
+    if compute_missing:
+        save_stats_index(output_dir, index, index_name)
+
+    channel_entries = {}
+    for (_, original_channel_name), key in keys.items():
+        channel_entries.setdefault(original_channel_name, []).append(index["stats"][key])
+    return shared_value_ranges(channel_entries, normalization_mode, percentiles)
+
+
+def result_cache_keys(input_dir, file_groups, normalize, enhance_contrast, save_dtype, color_config,
+                      result_cache_dir, streaming=False, chunk_z=16, float32_kernel=False, clahe_backend="skimage",
+                      output_format="tiff", compression="zstd", compression_level=None,
+                      output_chunks=(16, 256, 256), normalization_mode="minmax", percentiles=(0.1, 99.9),
+                      value_ranges=None, hyperstack_layout=None, **_):
+    """
+    Claves de la caché de resultados {(archivo, canal): clave}: hash del
+    archivo crudo y parámetros efectivos de cada canal (p. ej. sin CLAHE en
+    el canal de pared, con el rango compartido de su canal...).
+    """
+    hash_index = load_hash_index(result_cache_dir)
+    keys = {}
+    for files_list in file_groups.values():
+        for file_name, original_channel_name in files_list:
+            file_hash = cached_file_hash(hash_index, os.path.join(input_dir, file_name))
+            should_enhance = enhance_contrast and original_channel_name != CANAL_PARED_SATURADO
+            params = {"normalize": normalize, "enhance": should_enhance, "save_dtype": np.dtype(save_dtype).name,
+                      "float32_kernel": float32_kernel, "streaming": streaming}
+            if should_enhance:
+                params["clahe_backend"] = clahe_backend
+            if streaming:
+                params["chunk_z"] = chunk_z
+            if normalize:
+                params["normalization_mode"] = normalization_mode
+                if normalization_mode == "percentile":
+                    params["percentiles"] = list(percentiles)
+                if value_ranges:
+                    params["value_range"] = value_ranges.get(original_channel_name)
+            if hyperstack_layout:
+                params["output"] = "hyperstack"  # la entrada es el canal como TIFF sin comprimir
+            else:
+                params["output"] = output_description(output_format, compression, compression_level, output_chunks)
+                if output_format == "ome_zarr":
+                    params["color"] = color_config.get(original_channel_name, 'gray')  # va en los metadatos
+            keys[(file_name, original_channel_name)] = result_key(file_hash, original_channel_name, params)
+    save_hash_index(result_cache_dir, hash_index)
+    return keys
+
+
+def merge_shards(output_dir, qc_thumbnails=False, qc_thumbnail_size=256):
+    """
+    Cierre de un lote repartido en el clúster: combina los manifiestos
+    parciales de los workers en _manifest.json (y los índices de estadísticas
+    en _stats_index.json) y genera la hoja de contactos.
+    """
+    manifest = merge_manifests(output_dir)
+    merge_stats_indexes(output_dir)
+    print(f"Manifiesto combinado: {len(manifest['groups'])} grupos en {output_dir}")
+    if qc_thumbnails:
+        qc_index = write_contact_sheet(output_dir, COLOR_MAP_VECTORS, qc_thumbnail_size)
+        if qc_index:
+            print(f"QC sin pantalla: {qc_index}")
+
+
+def process_tiff_batch(input_dir, output_dir, color_config, normalize, enhance_contrast, save_dtype, show_preview,
+                       n_workers=1, max_memory_gb=None, streaming=False, chunk_z=16, float32_kernel=False,
+                       clahe_backend="skimage", input_format="tiff", incremental=False, manifest_hash=False,
+                       output_format="tiff", compression="zstd", compression_level=None,
+                       output_chunks=(16, 256, 256), compression_threads=None, preview_mode="blocking",
+                       on_group_done=None, qc_thumbnails=False, qc_thumbnail_size=256, run_report=False,
+                       trace_memory=False, normalization_mode="minmax", percentiles=(0.1, 99.9),
+                       lut_fast_path=False, shared_normalization=False, pipelined_io=False, io_threads=2,
+                       compute_threads=1, io_queue_size=2, n_shards=1, shard_index=0, work_queue=False,
+                       worker_id=None, claim_stale_s=None, expected_channels=None, skip_incomplete=True,
+                       hyperstack_layout=None, result_cache_dir=None, result_cache_gb=None, stats_only=False):
     """
     Lee archivos TIFF 3D (separados por canal), aplica procesamiento condicional 
     (Min/Max y CLAHE selectivo), y agrupa para guardar y previsualizar en 3D.
+    Con input_format="nd2" lee directamente los hyperstacks .nd2 de input_dir
+    (un grupo por archivo, canales C00, C01, ...) sin TIFF intermedios.
+    Con n_workers > 1 los canales se procesan en paralelo en un pool de procesos,
+    limitados opcionalmente por max_memory_gb (estimación del pico por stack).
+    Con streaming=True cada stack se procesa por bloques de chunk_z planos (con
+    CLAHE, solo con los motores por planos "fast_slices" y "skimage_slices").
+    Con float32_kernel=True la normalización usa el núcleo float32 in-place.
+    clahe_backend selecciona el motor de CLAHE (ver fast_clahe.py).
+    Con incremental=True se omiten los grupos cuyas entradas, parámetros y
+    salidas no han cambiado según el manifiesto (ver batch_manifest.py).
+    output_format ("tiff", "tiled_tiff", "ome_zarr"), compression, compression_level,
+    output_chunks y compression_threads controlan el artefacto de salida.
+    Con hyperstack_layout ("ZCYX" o "CZYX", solo con output_format="tiff")
+    cada grupo se guarda en un único OME-TIFF multicanal que se preasigna al
+    empezar el grupo y en el que cada canal se escribe en su sitio.
+    Con result_cache_dir los canales ya calculados con el mismo archivo crudo
+    y los mismos parámetros efectivos se enlazan o copian desde esa caché
+    (limitada a result_cache_gb, LRU; ver result_cache.py).
+    Con show_preview y preview_mode="live" el lote corre en segundo plano y un
+    único visor de Napari recibe cada grupo terminado (ver napari_qc.py).
+    on_group_done(base_name, metadata_list) se llama al terminar cada grupo.
+    Con qc_thumbnails=True se genera el QC sin pantalla en <salida>/_qc/
+    (montaje por grupo y hoja de contactos del lote, ver qc_thumbnails.py).
+    Con run_report=True se escribe el informe de tiempos y memoria por etapa
+    (_run_report.json/.csv) y se imprime el resumen; trace_memory=True añade
+    el pico de tracemalloc por etapa (ver run_report.py).
+    normalization_mode ("minmax" o "percentile") y percentiles eligen la normalización.
+    lut_fast_path=True aplica el Min/Max por LUT en los canales enteros sin CLAHE.
+    Con shared_normalization=True todos los archivos de un mismo canal se
+    normalizan con el rango común del lote (ver stats_index.py).
+    Con pipelined_io=True (y n_workers=1, sin streaming) la lectura, el cálculo
+    y la escritura de canales consecutivos se solapan en hilos con colas
+    acotadas (io_threads, compute_threads, io_queue_size; ver io_pipeline.py).
+    Reparto en clúster (ver cluster_shards.py): con n_shards > 1 este proceso
+    solo procesa el shard shard_index; con work_queue=True los grupos se
+    reclaman uno a uno en <salida>/_claims/ entre todos los workers que
+    comparten la salida (claim_stale_s: segundos tras los que un claim sin
+    renovar se considera abandonado). En ambos casos el manifiesto y el
+    informe son parciales por worker (worker_id, por defecto <host>-<pid>) y
+    la hoja de contactos se genera al combinarlos con merge_shards().
+    Con normalización compartida, los workers no leen los archivos para las
+    estadísticas: se calculan antes con stats_only=True (solo la primera
+    pasada, repartida por n_shards/shard_index en índices parciales).
+    Los grupos TIFF incompletos (falta algún canal de expected_channels, por
+    defecto los vistos en el lote, o hay archivos vacíos) se avisan antes de
+    empezar y, con skip_incomplete=True, no se procesan (ver file_index.py).
     """
+    batch_args = dict(locals())  # argumentos de la llamada, para relanzar el lote en modo live
+    if hyperstack_layout is not None:
+        if hyperstack_layout not in HYPERSTACK_LAYOUTS:
+            raise ValueError(f"hyperstack_layout no válido: {hyperstack_layout!r} "
+                             f"(opciones: {', '.join(HYPERSTACK_LAYOUTS)})")
+        if output_format != "tiff":
+            raise ValueError("hyperstack_layout solo es compatible con output_format='tiff'.")
+
+    if streaming and enhance_contrast:
+        check_streaming_clahe(clahe_backend)  # antes de empezar el lote, no a mitad
+
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    all_tiff_files = [f for f in os.listdir(input_dir) if f.lower().endswith(".tif") or f.lower().endswith(".tiff")]
-    
-    # Agrupar archivos por nombre base
-    file_groups = {}
-    for f in all_tiff_files:
-        # Asume el formato 'nombre_base_C00.tif'
-        parts = f.rsplit('_C', 1) 
-        if len(parts) > 1:
-            base_name = parts[0]
-            # Extrae la parte de canal (ej. C00)
-            channel_info = f.split(base_name)[-1].split('.', 1)[0].split('_')[-1].upper() 
+    if show_preview and preview_mode == "live":
+        def run_batch(live_callback):
+            def callback(base_name, metadata_list):
+                if on_group_done is not None:
+                    on_group_done(base_name, metadata_list)
+                live_callback(base_name, metadata_list)
+
+            # Mismo lote con los mismos argumentos, sin previsualización y con el callback del visor
+            process_tiff_batch(**dict(batch_args, show_preview=False, on_group_done=callback))
+
+        run_batch_with_live_qc(run_batch, output_dir, COLOR_MAP_VECTORS, save_dtype)
+        return
+
+    batch_start = time.perf_counter()
+    batch_recorder = StageRecorder(trace_memory)
+    report = []
+    sharded = n_shards > 1 or work_queue
+    if (sharded or stats_only) and worker_id is None:
+        worker_id = default_worker_id()
+
+    incomplete = {}
+    with batch_recorder.stage("discovery"):
+        if input_format == "nd2":
+            # Lectura directa de los .nd2 (sustituye a la macro de Fiji)
+            file_groups = group_nd2_files(input_dir)
         else:
-            base_name = os.path.splitext(f)[0]
-            channel_info = "SINGLECHANNEL"
-            
-        if base_name not in file_groups:
-            file_groups[base_name] = []
-        file_groups[base_name].append((f, channel_info))
+            # Índice guardado en la salida: si el directorio no cambió no se vuelve a listar
+            file_index = load_file_index(input_dir, output_dir)
+            file_groups = index_file_groups(file_index)
+            incomplete = incomplete_groups(file_index, expected_channels, input_dir)
 
     print(f"\nDetectados {len(file_groups)} grupos de imágenes 3D para procesar.")
+    if incomplete:
+        # Avisar antes de empezar en lugar de fallar (o registrar un grupo a medias) en mitad del lote
+        print(f"⚠️  {len(incomplete)} grupos incompletos"
+              f"{' (se omiten)' if skip_incomplete else ''}:")
+        for base_name, reason in sorted(incomplete.items())[:20]:
+            print(f"   - {base_name}: {reason}")
+        if len(incomplete) > 20:
+            print(f"   ... y {len(incomplete) - 20} más")
+        if skip_incomplete:
+            file_groups = {base_name: files_list for base_name, files_list in file_groups.items()
+                           if base_name not in incomplete}
 
-    for base_name, files_list in tqdm(file_groups.items(), desc="Procesando grupos de TIFF 3D"):
-        
-        napari_layers_info = []
-        metadata_list = []
-        
-        # Procesar cada canal en el grupo
-        for file_name, original_channel_name in sorted(files_list):
-            
-            color = color_config.get(original_channel_name, 'gray')
-            file_path = os.path.join(input_dir, file_name)
-            data = imread(file_path) # Leer el Stack 3D completo
-            
-            # Convertir a float (0-1)
-            data_float = img_as_float(data)
-            
-            # Normalización Min/Max
-            if normalize:
-                min_val = data_float.min()
-                max_val = data_float.max()
-                data_norm = (data_float - min_val) / (max_val - min_val + 1e-8)
+    if stats_only:
+        # Pasada previa del clúster: cada shard calcula las estadísticas de sus
+        # archivos en su índice parcial (los workers luego solo las combinan)
+        if n_shards > 1:
+            file_groups = shard_groups(file_groups, shard_index, n_shards)
+        index_name = partial_stats_index_name(worker_id) if n_shards > 1 else STATS_INDEX_NAME
+        collect_shared_stats(input_dir, output_dir, file_groups, n_workers, chunk_z, normalization_mode,
+                             percentiles, index_name=index_name)
+        print(f"Estadísticas de {len(file_groups)} grupos guardadas en {os.path.join(output_dir, index_name)}")
+        return
+
+    # Rango común por canal para todo el experimento (antes de omitir grupos).
+    # En el clúster cada nodo leería el lote entero: se usan las estadísticas de --stats-only
+    value_ranges = None
+    if shared_normalization and normalize:
+        with batch_recorder.stage("shared_stats"):
+            value_ranges = collect_shared_stats(input_dir, output_dir, file_groups, n_workers, chunk_z,
+                                                normalization_mode, percentiles, compute_missing=not sharded)
+
+    if n_shards > 1:
+        # Después de las estadísticas compartidas: el rango común es el de todo el lote
+        file_groups = shard_groups(file_groups, shard_index, n_shards)
+        print(f"Shard {shard_index}/{n_shards}: {len(file_groups)} grupos.")
+
+    channel_options = dict(streaming=streaming, chunk_z=chunk_z, float32_kernel=float32_kernel,
+                           clahe_backend=clahe_backend, output_format=output_format, compression=compression,
+                           compression_level=compression_level, output_chunks=output_chunks,
+                           compression_threads=compression_threads, qc_thumbnails=qc_thumbnails,
+                           trace_memory=trace_memory, normalization_mode=normalization_mode,
+                           percentiles=percentiles, lut_fast_path=lut_fast_path, value_ranges=value_ranges,
+                           hyperstack_layout=hyperstack_layout, result_cache_dir=result_cache_dir)
+
+    group_callbacks = [("on_group_done", on_group_done)] if on_group_done is not None else []
+    # Parámetros que afectan a las salidas (si cambian, se reprocesa; también
+    # forman parte de la clave de los claims de la cola de trabajo)
+    params = dict(channel_options, normalize=normalize, enhance_contrast=enhance_contrast,
+                  save_dtype=np.dtype(save_dtype).name, canal_pared_saturado=CANAL_PARED_SATURADO,
+                  color_config=color_config)
+    params.pop("compression_threads")
+    params.pop("qc_thumbnails")  # el QC de grupos omitidos se calcula desde sus salidas
+    params.pop("trace_memory")
+    params.pop("lut_fast_path")  # mismo resultado que el camino float
+    params.pop("result_cache_dir")
+    if value_ranges is None:
+        params.pop("value_ranges")  # si el rango común cambia, se reprocesa todo el lote
+    if normalize and normalization_mode == "percentile":
+        params["percentiles"] = list(percentiles)
+    else:
+        params.pop("normalization_mode")
+        params.pop("percentiles")
+    if not streaming:
+        params.pop("chunk_z")
+    if hyperstack_layout is None:
+        params.pop("hyperstack_layout")
+    if output_format == "tiff":
+        for key in ("compression", "compression_level", "output_chunks"):
+            params.pop(key)
+    else:
+        params["output_chunks"] = list(output_chunks)  # igual que al releerlo del JSON
+
+    if incremental or work_queue:
+        with batch_recorder.stage("manifest_check"):
+            inputs = {base_name: group_inputs(input_dir, files_list, manifest_hash)
+                      for base_name, files_list in file_groups.items()}
+
+    if incremental:
+        with batch_recorder.stage("manifest_check"):
+            # En el clúster se tienen en cuenta los grupos que ya terminaron otros workers
+            manifest = load_manifest(output_dir, include_partials=sharded)
+            if sharded:
+                own_manifest = load_manifest(output_dir, file_name=partial_manifest_name(worker_id))
+            pending_groups = {base_name: files_list for base_name, files_list in file_groups.items()
+                              if not group_is_current(manifest, base_name, inputs[base_name], params, output_dir)}
+        print(f"Omitidos {len(file_groups) - len(pending_groups)} grupos sin cambios; "
+              f"{len(pending_groups)} pendientes.")
+        file_groups = pending_groups
+
+        def record_in_manifest(base_name, metadata_list):
+            output_files = [m["file_name"] for m in metadata_list] + [f"{base_name}_metadata.json"]
+            record_group(manifest, base_name, inputs[base_name], params, output_dir, output_files)
+            if sharded:
+                # Manifiesto parcial del worker (solo sus grupos); se combinan con merge_shards()
+                own_manifest["groups"][base_name] = manifest["groups"][base_name]
+                save_manifest(output_dir, own_manifest, partial_manifest_name(worker_id))
             else:
-                data_norm = data_float
-            
-            # ------------------------------------------------------------------
-            # CORRECCIÓN DE ERROR: Sanitización de datos (reemplazar NaN/Inf por 0)
-            # Esto evita el error 'invalid syntax' en equalize_adapthist.
-            data_norm = np.nan_to_num(data_norm)
-            # ------------------------------------------------------------------
-            
-            # LÓGICA CONDICIONAL DE MEJORA DE CONTRASTE (CLAHE)
-            should_enhance = enhance_contrast
-            
-            if original_channel_name == CANAL_PARED_SATURADO:
-                should_enhance = False
-                print(f"   [INFO] Saltando CLAHE para el canal {CANAL_PARED_SATURADO} (Pared Celular) para evitar saturación.")
+                save_manifest(output_dir, manifest)
+
+        # El manifiesto se actualiza antes que cualquier otro aviso de grupo terminado
+        group_callbacks.insert(0, ("manifest", record_in_manifest))
+
+    claims = None
+    if work_queue:
+        queue_started = time.time()
+
+        def redo_done(base_name, done_path):
+            # El .done puede ser de una ejecución anterior: con incremental se
+            # rehace si el grupo sigue sin estar al día en el manifiesto (con
+            # los parciales de los demás workers); sin incremental, si es
+            # anterior a esta ejecución
+            if not incremental:
+                return os.path.getmtime(done_path) < queue_started
+            current = load_manifest(output_dir, include_partials=True)
+            return not group_is_current(current, base_name, inputs[base_name], params, output_dir)
+
+        claims = WorkClaims(os.path.join(output_dir, CLAIMS_DIR_NAME), worker_id, claim_stale_s, redo_done)
+        claim_keys = {base_name: claim_key(inputs[base_name], params) for base_name in file_groups}
+
+        def mark_claim_done(base_name, metadata_list):
+            claims.finish(base_name)
+
+        # El claim pasa a .done justo después de registrar el grupo en el manifiesto
+        group_callbacks.insert(1 if incremental else 0, ("claim", mark_claim_done))
+
+    if qc_thumbnails:
+        def write_qc_montage(base_name, metadata_list):
+            write_group_montage(output_dir, base_name, metadata_list, COLOR_MAP_VECTORS, qc_thumbnail_size)
+
+        group_callbacks.append(("qc_montage", write_qc_montage))
+
+    cache_hits = 0
+
+    def start_group(base_name, files_list):
+        """Preasigna el hyperstack del grupo (todos sus canales deben tener la misma forma)."""
+        files_list = sorted(files_list)
+        infos = [stack_info(os.path.join(input_dir, file_name), original_channel_name)
+                 for file_name, original_channel_name in files_list]
+        shapes = sorted({tuple(shape) for shape, _ in infos})
+        if len(shapes) > 1:
+            raise ValueError(f"No se puede crear el hyperstack de {base_name}: "
+                             f"los canales tienen formas distintas {shapes}.")
+        channel_names = [original_channel_name for _, original_channel_name in files_list]
+        create_hyperstack(os.path.join(output_dir, hyperstack_file_name(base_name)), shapes[0], save_dtype,
+                          hyperstack_layout, channel_names,
+                          [color_config.get(name, 'gray') for name in channel_names])
+
+    def finish_group(base_name, files_list, results):
+        """Metadatos, avisos de grupo terminado y previsualización de un grupo, con sus etapas medidas."""
+        nonlocal cache_hits
+        group_recorder = StageRecorder(trace_memory)
+        metadata_list = [metadata for metadata, _, _ in results]
+        for (file_name, original_channel_name), (_, _, stages) in zip(files_list, results):
+            report.extend(report_rows(stages, base_name, original_channel_name, file_name))
+            cache_hits += any(record["stage"] == "cache_restore" for record in stages)
+
+        if hyperstack_layout:
+            # Todos los canales ya están escritos: el hyperstack pasa a su nombre final
+            with group_recorder.stage("hyperstack"):
+                finish_hyperstack(os.path.join(output_dir, hyperstack_file_name(base_name)))
+        napari_layers_info = []
+        for metadata, layer_info, _ in results:
+            if layer_info is not None:
+                data, name, color = layer_info
+                if data is None:
+                    # Canal del hyperstack (escrito por bloques o desde la caché): se abre del archivo final
+                    data = open_metadata_output(output_dir, metadata)
+                napari_layers_info.append((data, name, color))
 
-            if should_enhance:
-                # CLAHE aplicado al stack 3D (slice por slice)
-                data_norm = exposure.equalize_adapthist(data_norm)
-                
-            # Convertir de vuelta al tipo de dato de salida (uint16)
-            data_final = (data_norm * np.iinfo(save_dtype).max).astype(save_dtype)
-            
-            # 2. Guardar el TIFF 3D procesado
-            file_name_tiff = f"{base_name}_{original_channel_name}_normalized.tiff"
-            save_path_tiff = os.path.join(output_dir, file_name_tiff)
-            imwrite(save_path_tiff, data_final)
-            
-            # 3. Almacenar para Napari
-            napari_layers_info.append((data_final, f"{original_channel_name} (Norm)", color))
-            
-            metadata_list.append({
-                "file_name": file_name_tiff,
-                "original_channel_id": original_channel_name,
-                "colormap": color
-            })
-            
         # 4. Guardar archivo de metadatos JSON (sin cambios)
-        metadata_file_name = f"{base_name}_metadata.json"
-        metadata_save_path = os.path.join(output_dir, metadata_file_name)
-        with open(metadata_save_path, 'w') as f:
-            json.dump(metadata_list, f, indent=4)
+        with group_recorder.stage("metadata"):
+            write_group_metadata(output_dir, base_name, metadata_list)
+        for stage_name, callback in group_callbacks:
+            with group_recorder.stage(stage_name):
+                callback(base_name, metadata_list)
 
         # 5. Previsualización con Napari 3D
         if show_preview and napari_layers_info:
-            viewer = napari.Viewer()
-            viewer.title = f"QC Final 3D: {base_name}"
-
-            for d, name, color_str in napari_layers_info:
-                
-                # Creación de Colormap explícito para compatibilidad
-                if color_str.lower() in ('gray', 'gris'):
-                    custom_colormap = 'gray'
-                else:
-                    color_vector = COLOR_MAP_VECTORS.get(color_str.lower(), COLOR_MAP_VECTORS['gray'])
-                    colors = np.array([[0, 0, 0, 0], color_vector])
-                    custom_colormap = Colormap(colors, name=f"{color_str}_direct")
-
-                vmin = d.min()
-                vmax = d.max()
-                contrast_limits = [vmin, vmax] if vmin != vmax else [0, np.iinfo(save_dtype).max]
-                
-                # Se agrega como imagen 3D automáticamente
-                viewer.add_image(d, 
-                                 name=name, 
-                                 colormap=custom_colormap, 
-                                 contrast_limits=contrast_limits,
-                                 blending='additive') 
-
-            viewer.reset_view()
-            napari.run()
+            with group_recorder.stage("preview"):
+                preview_group_napari(base_name, napari_layers_info, save_dtype)
+        report.extend(report_rows(group_recorder.records, base_name))
+
+    def group_cache_keys(file_groups):
+        # Claves de caché solo de estos grupos (con la cola de trabajo, los ya reclamados)
+        if not result_cache_dir:
+            return None
+        with batch_recorder.stage("cache_keys"):
+            return result_cache_keys(input_dir, file_groups, normalize, enhance_contrast, save_dtype,
+                                     color_config, **channel_options)
+
+    def run_groups(file_groups, cache_keys=None):
+        # Con n_workers > 1, file_groups puede ser un iterador de (grupo, archivos)
+        # cuyas claves de caché añade a cache_keys quien lo genera
+        if isinstance(file_groups, dict):
+            cache_keys = group_cache_keys(file_groups)
+        if n_workers > 1:
+            _run_groups_parallel(file_groups, input_dir, output_dir, color_config, normalize,
+                                 enhance_contrast, save_dtype, show_preview, n_workers, max_memory_gb,
+                                 finish_group, start_group if hyperstack_layout else None, cache_keys,
+                                 **channel_options)
+        elif pipelined_io and not streaming:
+            # El streaming ya solapa por bloques dentro de cada canal; aquí se solapan canales enteros
+            _run_groups_pipelined(file_groups, input_dir, output_dir, color_config, normalize,
+                                  enhance_contrast, save_dtype, show_preview, max_memory_gb, finish_group,
+                                  start_group if hyperstack_layout else None, cache_keys, io_threads=io_threads,
+                                  compute_threads=compute_threads,
+                                  io_queue_size=io_queue_size, **channel_options)
+        else:
+            for base_name, files_list in tqdm(file_groups.items(), desc="Procesando grupos de TIFF 3D"):
+            
+                # Procesar cada canal en el grupo
+                files_list = sorted(files_list)
+                if hyperstack_layout:
+                    start_group(base_name, files_list)
+                results = [
+                    process_channel(
+                        input_dir, output_dir, base_name, file_name, original_channel_name,
+                        color_config, normalize, enhance_contrast, save_dtype, show_preview,
+                        channel_index=channel_index,
+                        cache_key=cache_keys.get((file_name, original_channel_name)) if cache_keys else None,
+                        **channel_options
+                    )
+                    for channel_index, (file_name, original_channel_name) in enumerate(files_list)
+                ]
+                finish_group(base_name, files_list, results)
+
+    if claims is not None:
+        # Cola de trabajo: se reclama un grupo cada vez que queda libre un proceso
+        # local (un único pool para toda la cola) hasta que no quede ninguno libre
+        try:
+            if n_workers > 1:
+                claimed_keys = {} if result_cache_dir else None
+
+                def claimed_groups():
+                    for base_name, files_list in claims.claim_groups(file_groups, claim_keys):
+                        if claimed_keys is not None:
+                            claimed_keys.update(group_cache_keys({base_name: files_list}))
+                        yield base_name, files_list
+
+                run_groups(claimed_groups(), claimed_keys)
+            else:
+                for base_name, files_list in claims.claim_groups(file_groups, claim_keys):
+                    run_groups({base_name: files_list})
+        finally:
+            claims.close()
+    else:
+        run_groups(file_groups)
+
+    if result_cache_dir:
+        evicted = (0, 0)
+        if result_cache_gb:
+            with batch_recorder.stage("cache_evict"):
+                evicted = evict_results(result_cache_dir, result_cache_gb * 1024**3)
+        message = f"Caché de resultados: {cache_hits} canales reutilizados"
+        if evicted[0]:
+            message += f"; eliminadas {evicted[0]} entradas antiguas ({evicted[1] / 1024**3:.2f} GB)"
+        print(f"{message}.")
+
+    if qc_thumbnails and not sharded:
+        with batch_recorder.stage("contact_sheet"):
+            qc_index = write_contact_sheet(output_dir, COLOR_MAP_VECTORS, qc_thumbnail_size)
+        if qc_index:
+            print(f"QC sin pantalla: {qc_index}")
+
+    if run_report:
+        report.extend(report_rows(batch_recorder.records, ""))
+        run_info = dict(channel_options, input_dir=input_dir, output_dir=output_dir, input_format=input_format,
+                        n_groups=len(file_groups), n_workers=n_workers, normalize=normalize,
+                        enhance_contrast=enhance_contrast, save_dtype=np.dtype(save_dtype).name,
+                        wall_s=time.perf_counter() - batch_start, output_chunks=list(output_chunks))
+        report_name = f"{RUN_REPORT_NAME}.{worker_id}" if sharded else RUN_REPORT_NAME
+        report_path = write_run_report(output_dir, report, run_info, report_name)
+        print(f"\n⏱️  Resumen por etapa (informe completo en {report_path}):")
+        print(format_summary(report))
 
     print("\n🎯 Procesamiento y Normalización de TIFFs 3D completada.")
-    print(f"Archivos finales 3D listos para PlantSeg en: {output_dir_final}")
+    print(f"Archivos finales 3D listos para PlantSeg en: {output_dir}")
 
 # -------------------- MAIN --------------------
-if __name__ == "__main__":
-    
+def main(argv=None):
+    """
+    Punto de entrada de línea de comandos: la configuración del inicio del
+    script, sobrescrita por --config (TOML/YAML) y después por --set.
+    """
+    import argparse
+    import cProfile
+    import pstats
+
+    parser = argparse.ArgumentParser(description="Normalización y CLAHE de TIFFs 3D (configuración al inicio del "
+                                                 "script, en un archivo --config o con --set).")
+    parser.add_argument("--config", metavar="ARCHIVO", help="Configuración TOML o YAML (ver batch_config.py).")
+    parser.add_argument("--set", action="append", default=[], metavar="CLAVE=VALOR", dest="overrides",
+                        help="Ajuste para esta ejecución (repetible; se aplica después de --config).")
+    parser.add_argument("--shard", metavar="i/N", help="Procesar solo el shard i de N (reparto fijo por índice).")
+    parser.add_argument("--work-queue", action="store_true",
+                        help="Reclamar grupos en <salida>/_claims/ junto con otros workers (reparto bajo demanda).")
+    parser.add_argument("--worker-id", help="Nombre del worker para claims, manifiesto e informe (por defecto host-pid).")
+    parser.add_argument("--stats-only", action="store_true",
+                        help="No procesar: solo las estadísticas de la normalización compartida (de este --shard).")
+    parser.add_argument("--merge", action="store_true",
+                        help="No procesar: combinar los manifiestos parciales de los workers y generar el QC del lote.")
+    parser.add_argument("--tracemalloc", action="store_true", help="Pico de memoria por etapa con tracemalloc (más lento).")
+    parser.add_argument("--cprofile", nargs="?", const="_run_profile.prof", default=None, metavar="ARCHIVO",
+                        help="Perfil cProfile del proceso principal (relativo a la carpeta de salida).")
+    args = parser.parse_args(argv)
+
+    try:
+        config = load_config_file(args.config) if args.config else {}
+        config.update(parse_overrides(args.overrides))
+        apply_config(globals(), config, CONFIG_KEYS)
+        shard = parse_shard(args.shard) if args.shard else (shard_index, n_shards)
+    except (OSError, ImportError, ValueError) as e:
+        parser.error(str(e))
+
+    if args.merge:
+        merge_shards(output_dir_final, qc_thumbnails, qc_thumbnail_size)
+        return
+    cprofile_path = args.cprofile or cprofile_output
+
+    # Con n_workers > 1, cProfile solo ve el proceso principal (los canales se
+    # procesan en los workers); el informe de etapas sí cubre los workers.
+    profiler = cProfile.Profile() if cprofile_path else None
+
     # 1. Ejecutar el procesamiento
     try:
+        if profiler:
+            profiler.enable()
         process_tiff_batch(
-            input_dir_tiff, 
+            input_dir_nd2 if input_format == "nd2" else input_dir_tiff, 
             output_dir_final, 
             CHANNEL_COLORS, 
             normalize, 
             enhance_contrast, 
             save_dtype, 
-            show_napari_preview
+            show_napari_preview,
+            preview_mode=preview_mode,
+            qc_thumbnails=qc_thumbnails,
+            qc_thumbnail_size=qc_thumbnail_size,
+            n_workers=n_workers,
+            max_memory_gb=max_memory_gb,
+            streaming=streaming,
+            chunk_z=chunk_z,
+            float32_kernel=float32_kernel,
+            clahe_backend=clahe_backend,
+            input_format=input_format,
+            incremental=incremental,
+            manifest_hash=manifest_hash,
+            output_format=output_format,
+            compression=compression,
+            compression_level=compression_level,
+            output_chunks=output_chunks,
+            compression_threads=compression_threads,
+            run_report=run_report,
+            trace_memory=trace_memory or args.tracemalloc,
+            normalization_mode=normalization_mode,
+            percentiles=percentile_range,
+            lut_fast_path=lut_fast_path,
+            shared_normalization=shared_normalization,
+            pipelined_io=pipelined_io,
+            io_threads=io_threads,
+            compute_threads=compute_threads,
+            io_queue_size=io_queue_size,
+            shard_index=shard[0],
+            n_shards=shard[1],
+            work_queue=work_queue or args.work_queue,
+            worker_id=args.worker_id,
+            claim_stale_s=claim_stale_s,
+            expected_channels=expected_channels,
+            skip_incomplete=skip_incomplete_groups,
+            hyperstack_layout=hyperstack_layout,
+            result_cache_dir=result_cache_dir,
+            result_cache_gb=result_cache_gb,
+            stats_only=args.stats_only
         )
     except Exception as e:
-        print(f"\n❌ Error fatal durante el procesamiento: {e}")
\ No newline at end of file
+        print(f"\n❌ Error fatal durante el procesamiento: {e}")
+        # Código de salida distinto de 0: el planificador del clúster marca el trabajo como fallido
+        sys.exit(1)
+    finally:
+        if profiler:
+            profiler.disable()
+            profile_path = os.path.join(output_dir_final, cprofile_path)
+            profiler.dump_stats(profile_path)
+            print(f"\nPerfil cProfile guardado en {profile_path}")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+
+
+if __name__ == "__main__":
+    main()
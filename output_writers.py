@@ -0,0 +1,321 @@
+import os
+import shutil
+import numpy as np
+from tifffile import imwrite, memmap, imread, TiffFile
+
+# ====================================================================
+# Formatos de salida de los stacks normalizados
+# ====================================================================
+#
+#   "tiff"       TIFF sin comprimir de un solo bloque (formato original).
+#   "tiled_tiff" TIFF en teselas (Y, X) de output_chunks, comprimido
+#                (zstd/zlib...) con predictor horizontal.
+#   "ome_zarr"   Directorio OME-Zarr (NGFF 0.4, zarr v2 en disco) con
+#                bloques output_chunks comprimidos con Blosc.
+#
+# La compresión usa varios hilos (maxworkers de tifffile / hilos de Blosc)
+# y los formatos por bloques permiten a PlantSeg/napari leer subvolúmenes
+# sin cargar el stack entero. Toda escritura es atómica: se escribe en
+# "<nombre>.partial" y se renombra al terminar.
+#
+# Hyperstack multicanal (con "tiff"): en lugar de un archivo por canal se
+# escribe un único OME-TIFF por grupo, "<base>_normalized.ome.tif", con ejes
+# ZCYX o CZYX y los nombres y colores de los canales en los metadatos OME.
+# El archivo se crea sin comprimir y contiguo al empezar el grupo
+# (preasignado, sin escribir datos) y cada canal se escribe en su sitio por
+# memoria mapeada en cuanto termina; al completarse el grupo se renombra.
+
+OUTPUT_FORMATS = ("tiff", "tiled_tiff", "ome_zarr")
+HYPERSTACK_LAYOUTS = ("ZCYX", "CZYX")
+
+# Nombres de compresión aceptados -> nombre del compresor Blosc (OME-Zarr)
+_BLOSC_CNAMES = {"zstd": "zstd", "zlib": "zlib", "deflate": "zlib", "lz4": "lz4", "lz4hc": "lz4hc", "blosclz": "blosclz"}
+
+# Colores de los canales (hex RGB) para los metadatos "omero" de OME-Zarr
+_HEX_COLORS = {
+    "blue": "0000FF",
+    "green": "00FF00",
+    "red": "FF0000",
+    "yellow": "FFFF00",
+    "magenta": "FF00FF",
+    "cyan": "00FFFF",
+    "gray": "FFFFFF",
+}
+
+
+def output_file_name(base_name, channel_name, output_format="tiff"):
+    """Nombre del artefacto de salida de un canal según el formato."""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Formato de salida desconocido: {output_format!r} (opciones: {', '.join(OUTPUT_FORMATS)})")
+    suffix = ".ome.zarr" if output_format == "ome_zarr" else ".tiff"
+    return f"{base_name}_{channel_name}_normalized{suffix}"
+
+
+def hyperstack_file_name(base_name):
+    """Nombre del hyperstack multicanal de un grupo."""
+    return f"{base_name}_normalized.ome.tif"
+
+
+def _ome_color(color):
+    """Nombre de color -> entero RGBA con signo (tipo Color de OME)."""
+    rgba = (int(_HEX_COLORS.get((color or "gray").lower(), "FFFFFF"), 16) << 8) | 0xFF
+    return rgba - 2**32 if rgba >= 2**31 else rgba
+
+
+def _hyperstack_axes(layout, ndim):
+    """Ejes del hyperstack para stacks de ndim dimensiones por canal (2D: siempre CYX)."""
+    if layout not in HYPERSTACK_LAYOUTS:
+        raise ValueError(f"Disposición de hyperstack desconocida: {layout!r} (opciones: {', '.join(HYPERSTACK_LAYOUTS)})")
+    return layout if ndim == 3 else "CYX"
+
+
+def create_hyperstack(save_path, shape, dtype, layout, channel_names, colors):
+    """
+    Preasigna el hyperstack de un grupo en "<save_path>.partial": OME-TIFF
+    contiguo sin comprimir con len(channel_names) canales de forma shape
+    (Z, Y, X) o (Y, X). Devuelve la ruta del temporal.
+    """
+    tmp_path = f"{save_path}.partial"
+    axes = _hyperstack_axes(layout, len(shape))
+    full_shape = list(shape)
+    full_shape.insert(axes.index("C"), len(channel_names))
+    out = memmap(tmp_path, shape=tuple(full_shape), dtype=dtype, ome=True, photometric="minisblack",
+                 metadata={"axes": axes, "Channel": {"Name": list(channel_names),
+                                                     "Color": [_ome_color(c) for c in colors]}})
+    del out  # solo reserva: los datos los escribe cada canal
+    return tmp_path
+
+
+def _open_hyperstack(path, layout, mode="r"):
+    """
+    Abre el hyperstack mapeado en memoria siempre con su eje C: tifffile lo
+    omite al releer un hyperstack de un solo canal (p. ej. SINGLECHANNEL).
+    Devuelve (array, posición del eje C).
+    """
+    array = memmap(path, mode=mode)
+    with TiffFile(path) as tif:
+        axes = tif.series[0].axes
+    if "C" not in axes:
+        # Eje C de tamaño 1 eliminado: se vuelve a insertar (vista, sin copiar)
+        c_axis = _hyperstack_axes(layout, len(axes)).index("C")
+        return np.expand_dims(array, c_axis), c_axis
+    return array, axes.index("C")
+
+
+def _hyperstack_channel(array, c_axis, channel_index):
+    """Vista de un canal dentro del hyperstack (sin copiar)."""
+    index = [slice(None)] * array.ndim
+    index[c_axis] = channel_index
+    return array[tuple(index)]
+
+
+def write_hyperstack_channel(tmp_path, layout, channel_index, chunks):
+    """Escribe un canal (iterador de bloques en Z o un único bloque) en su sitio del hyperstack preasignado."""
+    out, c_axis = _open_hyperstack(tmp_path, layout, mode="r+")
+    view = _hyperstack_channel(out, c_axis, channel_index)
+    z = 0
+    for chunk in chunks:
+        if view.ndim < 3:
+            view[...] = chunk
+        else:
+            view[z:z + chunk.shape[0]] = chunk
+            z += chunk.shape[0]
+    out.flush()
+    del view, out
+
+
+def finish_hyperstack(save_path):
+    """Renombra el hyperstack completo a su nombre final."""
+    _replace(f"{save_path}.partial", save_path)
+
+
+def _fit_chunks(chunk_shape, shape):
+    """Adapta output_chunks (Z, Y, X) al número de dimensiones y tamaño del stack."""
+    chunk_shape = tuple(chunk_shape)[-len(shape):]
+    chunk_shape = (1,) * (len(shape) - len(chunk_shape)) + chunk_shape
+    return tuple(max(1, min(c, s)) for c, s in zip(chunk_shape, shape))
+
+
+def _iter_planes(chunks):
+    """Bloques (Z, Y, X) o planos (Y, X) -> planos 2D en orden."""
+    for chunk in chunks:
+        if chunk.ndim == 2:
+            yield chunk
+        else:
+            yield from chunk.reshape((-1,) + chunk.shape[-2:])
+
+
+def _iter_tiles(chunks, tile):
+    """Planos -> teselas en el orden que espera tifffile (fila a fila; bordes incompletos)."""
+    ty, tx = tile
+    for plane in _iter_planes(chunks):
+        for y in range(0, plane.shape[0], ty):
+            for x in range(0, plane.shape[1], tx):
+                yield plane[y:y + ty, x:x + tx]
+
+
+def _write_raw_tiff(path, shape, dtype, chunks):
+    # minisblack: un stack de 3 o 4 planos no es una imagen RGB
+    out = memmap(path, shape=shape, dtype=dtype, photometric="minisblack")
+    z = 0
+    for chunk in chunks:
+        if len(shape) < 3:
+            out[...] = chunk
+        else:
+            out[z:z + chunk.shape[0]] = chunk
+            z += chunk.shape[0]
+    out.flush()
+    del out
+
+
+def _write_tiled_tiff(path, shape, dtype, chunks, chunk_shape, compression, compression_level, threads):
+    tile = _fit_chunks(chunk_shape, shape)[-2:]
+    # tifffile exige teselas múltiplo de 16
+    tile = tuple(max(16, (t // 16) * 16) for t in tile)
+    level = {"level": compression_level} if compression and compression_level is not None else None
+    imwrite(
+        path,
+        _iter_tiles(chunks, tile),
+        shape=shape,
+        dtype=dtype,
+        tile=tile,
+        photometric="minisblack",
+        compression=compression,
+        compressionargs=level,
+        predictor=bool(compression),
+        maxworkers=threads,
+    )
+
+
+def _write_ome_zarr(path, shape, dtype, chunks, chunk_shape, compression, compression_level, threads,
+                    channel_name, color):
+    import zarr
+    import numcodecs
+    from numcodecs import Blosc
+
+    numcodecs.blosc.set_nthreads(threads or os.cpu_count() or 1)
+    compressor = Blosc(
+        cname=_BLOSC_CNAMES.get(compression or "zstd", "zstd"),
+        clevel=5 if compression_level is None else compression_level,
+        shuffle=Blosc.BITSHUFFLE,
+    )
+    zarr_chunks = _fit_chunks(chunk_shape, shape)
+
+    # OME-NGFF 0.4 usa zarr v2 en disco con separador "/"
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        root = zarr.open_group(path, mode="w", zarr_format=2)
+        array = root.create_array("0", shape=shape, chunks=zarr_chunks, dtype=dtype, compressors=compressor,
+                                  chunk_key_encoding={"name": "v2", "separator": "/"})
+    else:
+        root = zarr.open_group(path, mode="w")
+        array = root.create_dataset("0", shape=shape, chunks=zarr_chunks, dtype=dtype, compressor=compressor,
+                                    dimension_separator="/")
+
+    z = 0
+    for chunk in chunks:
+        if len(shape) < 3:
+            array[...] = chunk
+        else:
+            array[z:z + chunk.shape[0]] = chunk
+            z += chunk.shape[0]
+
+    axes_names = ["t", "z", "y", "x"][-len(shape):]
+    root.attrs["multiscales"] = [{
+        "version": "0.4",
+        "name": channel_name or "",
+        "axes": [{"name": a, "type": "time" if a == "t" else "space"} for a in axes_names],
+        "datasets": [{"path": "0", "coordinateTransformations": [{"type": "scale", "scale": [1.0] * len(shape)}]}],
+    }]
+    dtype_max = int(np.iinfo(dtype).max) if np.issubdtype(dtype, np.integer) else 1
+    root.attrs["omero"] = {
+        "channels": [{
+            "label": channel_name or "",
+            "color": _HEX_COLORS.get((color or "gray").lower(), "FFFFFF"),
+            "window": {"start": 0, "end": dtype_max, "min": 0, "max": dtype_max},
+            "active": True,
+        }],
+    }
+
+
+def _replace(tmp_path, save_path):
+    """Renombra el temporal al nombre final (borrando una salida anterior si es un directorio)."""
+    if os.path.isdir(save_path):
+        shutil.rmtree(save_path)
+    os.replace(tmp_path, save_path)
+
+
+def write_chunks(save_path, shape, dtype, chunks, output_format="tiff", compression="zstd",
+                 compression_level=None, output_chunks=(16, 256, 256), compression_threads=None,
+                 channel_name=None, color=None):
+    """
+    Escribe un stack recibido como iterador de bloques en Z (o un único
+    bloque) en el formato de salida pedido, con escritura atómica.
+    """
+    tmp_path = f"{save_path}.partial"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    dtype = np.dtype(dtype)
+    shape = tuple(shape)
+
+    if output_format == "tiff":
+        _write_raw_tiff(tmp_path, shape, dtype, chunks)
+    elif output_format == "tiled_tiff":
+        _write_tiled_tiff(tmp_path, shape, dtype, chunks, output_chunks, compression, compression_level,
+                          compression_threads)
+    elif output_format == "ome_zarr":
+        _write_ome_zarr(tmp_path, shape, dtype, chunks, output_chunks, compression, compression_level,
+                        compression_threads, channel_name, color)
+    else:
+        raise ValueError(f"Formato de salida desconocido: {output_format!r} (opciones: {', '.join(OUTPUT_FORMATS)})")
+    _replace(tmp_path, save_path)
+
+
+def write_stack(save_path, data, output_format="tiff", **options):
+    """Escribe un stack completo en memoria (equivalente a imwrite para "tiff")."""
+    if output_format == "tiff":
+        # Como el imwrite original, pero en escala de grises también con 3 o 4 planos
+        tmp_path = f"{save_path}.partial"
+        imwrite(tmp_path, data, photometric="minisblack")
+        _replace(tmp_path, save_path)
+        return
+    write_chunks(save_path, data.shape, data.dtype, [data], output_format, **options)
+
+
+def open_output(save_path, output_format="tiff", layout=None, channel_index=None):
+    """
+    Abre una salida sin cargarla entera (para la previsualización). Con
+    layout y channel_index devuelve solo ese canal de un hyperstack.
+    """
+    if layout is not None:
+        return _hyperstack_channel(*_open_hyperstack(save_path, layout), channel_index)
+    if output_format == "ome_zarr":
+        import zarr
+        return zarr.open_group(save_path, mode="r")["0"]
+    try:
+        return memmap(save_path, mode="r")
+    except ValueError:
+        # TIFF comprimido: no se puede mapear; se abre como array zarr que
+        # solo descomprime las teselas o tiras que se leen
+        import zarr
+        return zarr.open(imread(save_path, aszarr=True), mode="r")
+
+
+def open_metadata_output(output_dir, metadata):
+    """Abre la salida de un canal descrita por su entrada de _metadata.json."""
+    return open_output(os.path.join(output_dir, metadata["file_name"]), metadata.get("format", "tiff"),
+                       metadata.get("layout"), metadata.get("channel_index"))
+
+
+def output_description(output_format="tiff", compression="zstd", compression_level=None,
+                       output_chunks=(16, 256, 256), layout=None, channel_index=None):
+    """Campos extra para _metadata.json que describen el artefacto escrito."""
+    if layout is not None:
+        return {"layout": layout, "channel_index": channel_index}
+    if output_format == "tiff":
+        return {}
+    return {
+        "format": output_format,
+        "compression": compression,
+        "compression_level": compression_level,
+        "chunks": list(output_chunks),
+    }
@@ -0,0 +1,205 @@
+import os
+import html
+import json
+import zlib
+import struct
+import numpy as np
+from tifffile import imread, imwrite
+
+from output_writers import open_metadata_output
+
+# ====================================================================
+# QC sin pantalla: proyecciones, montajes RGB y hoja de contactos
+# ====================================================================
+#
+# Pensado para nodos de cálculo sin display, donde Napari no sirve. Por cada
+# canal se guarda su proyección de máxima intensidad (MIP) en _qc/, calculada
+# sobre el stack ya normalizado en memoria o acumulada bloque a bloque en el
+# modo streaming (un np.maximum por bloque). Con las MIP de un grupo se
+# compone un montaje PNG (un panel por canal + composición RGB aditiva con
+# los mismos colores que Napari) y al final del lote una hoja de contactos
+# (_qc/index.html y _qc/contact_sheet.png) con todos los grupos de la salida.
+
+QC_DIR_NAME = "_qc"
+
+# Percentiles para el contraste de cada MIP (evita que píxeles calientes
+# aplasten el resto de la imagen)
+CONTRAST_PERCENTILES = (0.1, 99.9)
+
+
+def qc_dir(output_dir):
+    return os.path.join(output_dir, QC_DIR_NAME)
+
+
+def mip_file_name(base_name, channel_name):
+    return f"{base_name}_{channel_name}_mip.tif"
+
+
+def stack_mip(data):
+    """MIP en Z (todos los ejes salvo Y, X) de un stack o de un bloque de planos."""
+    if data.ndim <= 2:
+        return np.asarray(data)
+    return np.asarray(data).max(axis=tuple(range(data.ndim - 2)))
+
+
+def update_mip(mip, chunk):
+    """Acumula la MIP de un bloque más (mip=None para el primer bloque)."""
+    chunk_mip = stack_mip(chunk)
+    return chunk_mip.copy() if mip is None else np.maximum(mip, chunk_mip, out=mip)
+
+
+def output_mip(data, chunk_z=16):
+    """MIP de una salida ya escrita (abierta sin cargar), leída por bloques de chunk_z planos."""
+    if data.ndim <= 2:
+        return np.asarray(data[...])
+    mip = None
+    for z in range(0, data.shape[0], chunk_z):
+        mip = update_mip(mip, np.asarray(data[z:z + chunk_z]))
+    return mip
+
+
+def save_channel_mip(output_dir, base_name, channel_name, mip):
+    """Guarda la MIP de un canal en _qc/ (escritura atómica)."""
+    os.makedirs(qc_dir(output_dir), exist_ok=True)
+    path = os.path.join(qc_dir(output_dir), mip_file_name(base_name, channel_name))
+    imwrite(f"{path}.partial", mip)
+    os.replace(f"{path}.partial", path)
+
+
+def load_channel_mip(output_dir, base_name, metadata):
+    """MIP de un canal desde _qc/, o calculada desde la salida si no existe (grupos de lotes anteriores)."""
+    path = os.path.join(qc_dir(output_dir), mip_file_name(base_name, metadata["original_channel_id"]))
+    if os.path.exists(path):
+        return imread(path)
+    mip = output_mip(open_metadata_output(output_dir, metadata))
+    save_channel_mip(output_dir, base_name, metadata["original_channel_id"], mip)
+    return mip
+
+
+def scale_to_unit(mip):
+    """MIP -> float32 en [0, 1] con contraste por percentiles."""
+    low, high = np.percentile(mip, CONTRAST_PERCENTILES)
+    if high <= low:
+        low, high = float(mip.min()), float(mip.max())
+    if high <= low:
+        return np.zeros(mip.shape, dtype=np.float32)
+    scaled = (mip.astype(np.float32) - low) / (high - low)
+    return np.clip(scaled, 0, 1, out=scaled)
+
+
+def colorize(unit_image, color_str, color_vectors):
+    """Imagen [0, 1] -> RGB float32 con el color del canal (como el colormap de Napari)."""
+    rgb = np.asarray(color_vectors.get(color_str.lower(), color_vectors['gray'])[:3], dtype=np.float32)
+    return unit_image[..., None] * rgb
+
+
+def to_rgb8(rgb):
+    return (np.clip(rgb, 0, 1) * 255 + 0.5).astype(np.uint8)
+
+
+def thumbnail(rgb, size):
+    """Reduce una imagen RGB para que su lado mayor sea como mucho size píxeles."""
+    h, w = rgb.shape[:2]
+    scale = size / max(h, w)
+    if scale >= 1:
+        return rgb
+    from skimage.transform import resize
+
+    shape = (max(1, round(h * scale)), max(1, round(w * scale)), rgb.shape[2])
+    return resize(rgb, shape, anti_aliasing=True, preserve_range=True).astype(rgb.dtype)
+
+
+def write_png(path, rgb8):
+    """PNG RGB de 8 bits sin dependencias extra (zlib), con escritura atómica."""
+    h, w = rgb8.shape[:2]
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    rows = np.zeros((h, w * 3 + 1), dtype=np.uint8)  # byte de filtro 0 por fila
+    rows[:, 1:] = np.ascontiguousarray(rgb8).reshape(h, w * 3)
+    png = (b"\x89PNG\r\n\x1a\n"
+           + chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 2, 0, 0, 0))
+           + chunk(b"IDAT", zlib.compress(rows.tobytes(), 6))
+           + chunk(b"IEND", b""))
+    with open(f"{path}.partial", "wb") as f:
+        f.write(png)
+    os.replace(f"{path}.partial", path)
+
+
+def group_composite(output_dir, base_name, metadata_list, color_vectors, size):
+    """(paneles por canal, composición RGB aditiva) de un grupo, ya reducidos a size."""
+    panels = []
+    composite = None
+    for metadata in metadata_list:
+        rgb = colorize(scale_to_unit(load_channel_mip(output_dir, base_name, metadata)),
+                       metadata["colormap"], color_vectors)
+        composite = rgb.copy() if composite is None else composite + rgb
+        panels.append(to_rgb8(thumbnail(rgb, size)))
+    return panels, to_rgb8(thumbnail(composite, size))
+
+
+def write_group_montage(output_dir, base_name, metadata_list, color_vectors, size=256):
+    """Montaje PNG de un grupo: un panel por canal seguido de la composición RGB."""
+    panels, composite = group_composite(output_dir, base_name, metadata_list, color_vectors, size)
+    panels.append(composite)
+    gap = np.zeros((composite.shape[0], 4, 3), dtype=np.uint8)
+    montage = np.concatenate([p for panel in panels for p in (panel, gap)][:-1], axis=1)
+    file_name = f"{base_name}_montage.png"
+    write_png(os.path.join(qc_dir(output_dir), file_name), montage)
+    return file_name
+
+
+def _output_groups(output_dir):
+    """{base_name: metadata_list} de todos los grupos con _metadata.json en la salida."""
+    groups = {}
+    for f in sorted(os.listdir(output_dir)):
+        if f.endswith("_metadata.json"):
+            with open(os.path.join(output_dir, f)) as fh:
+                groups[f[:-len("_metadata.json")]] = json.load(fh)
+    return groups
+
+
+def write_contact_sheet(output_dir, color_vectors, size=256):
+    """
+    Hoja de contactos del lote completo (incluye grupos de lotes anteriores):
+    _qc/contact_sheet.png con la composición de cada grupo en una rejilla y
+    _qc/index.html con el montaje de cada grupo y su nombre.
+    """
+    groups = _output_groups(output_dir)
+    if not groups:
+        return None
+    os.makedirs(qc_dir(output_dir), exist_ok=True)
+
+    composites = []
+    rows_html = []
+    for base_name, metadata_list in groups.items():
+        montage_name = f"{base_name}_montage.png"
+        if not os.path.exists(os.path.join(qc_dir(output_dir), montage_name)):
+            write_group_montage(output_dir, base_name, metadata_list, color_vectors, size)
+        composites.append(group_composite(output_dir, base_name, metadata_list, color_vectors, size)[1])
+        channels = ", ".join(f"{m['original_channel_id']} ({m['colormap']})" for m in metadata_list)
+        rows_html.append(f"<tr><td><b>{html.escape(base_name)}</b><br><small>{html.escape(channels)}</small></td>"
+                         f"<td><img src=\"{html.escape(montage_name)}\"></td></tr>")
+
+    # Rejilla casi cuadrada con celdas del tamaño de la composición mayor
+    n_cols = int(np.ceil(np.sqrt(len(composites))))
+    n_rows = int(np.ceil(len(composites) / n_cols))
+    cell_h = max(c.shape[0] for c in composites) + 4
+    cell_w = max(c.shape[1] for c in composites) + 4
+    sheet = np.zeros((n_rows * cell_h, n_cols * cell_w, 3), dtype=np.uint8)
+    for i, composite in enumerate(composites):
+        y, x = (i // n_cols) * cell_h, (i % n_cols) * cell_w
+        h, w = composite.shape[:2]
+        sheet[y:y + h, x:x + w] = composite
+    write_png(os.path.join(qc_dir(output_dir), "contact_sheet.png"), sheet)
+
+    index_path = os.path.join(qc_dir(output_dir), "index.html")
+    with open(f"{index_path}.partial", "w", encoding="utf-8") as f:
+        f.write("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>QC del lote</title></head>\n"
+                "<body style=\"background:#111;color:#ddd;font-family:sans-serif\">\n"
+                f"<h2>QC del lote ({len(groups)} grupos)</h2>\n"
+                "<p>MIP en Z por canal y composición RGB. <a href=\"contact_sheet.png\">Hoja de contactos</a></p>\n"
+                "<table>\n" + "\n".join(rows_html) + "\n</table>\n</body></html>\n")
+    os.replace(f"{index_path}.partial", index_path)
+    return index_path
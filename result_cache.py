@@ -0,0 +1,171 @@
+import os
+import json
+import shutil
+import socket
+import hashlib
+
+from batch_manifest import output_size
+from output_writers import write_stack
+
+# ====================================================================
+# Caché de resultados por canal (barridos de parámetros)
+# ====================================================================
+#
+# Al ajustar parámetros (CLAHE sí/no, CANAL_PARED_SATURADO, percentiles...)
+# se relanza el mismo lote muchas veces, a menudo con otra carpeta de
+# salida, y los canales a los que no les afecta el cambio se recalculaban
+# enteros. La caché guarda la salida de cada canal procesado en
+# result_cache_dir con una clave de contenido:
+#
+#   hash(contenido del archivo crudo, canal, parámetros que cambian el resultado)
+#
+# Los parámetros son los efectivos del canal: p. ej. en el canal de pared
+# "enhance" es False aunque enhance_contrast sea True, así que cambiar el
+# CLAHE de los demás canales no invalida sus entradas.
+#
+# Una entrada es "<clave>.data" (la salida tal cual: archivo TIFF o
+# directorio OME-Zarr) más "<clave>.json" (su tamaño); la fecha de
+# modificación del .json es la del último uso. Al acertar, la salida se crea
+# con un enlace duro a la entrada (sin copiar datos; si el sistema de
+# archivos no lo permite, con una copia). Como todas las escrituras son
+# atómicas (temporal + renombrado), una salida enlazada nunca se modifica
+# en el sitio. Al final del lote se eliminan las entradas usadas hace más
+# tiempo hasta que la caché cabe en su tamaño máximo (LRU).
+#
+# Los hashes de los archivos crudos se guardan en <caché>/_hashes.json con
+# su tamaño y mtime (como en stats_index.py), para no releerlos en cada
+# barrido.
+
+RESULT_CACHE_VERSION = 1
+HASH_INDEX_NAME = "_hashes.json"
+
+
+def load_hash_index(cache_dir):
+    """Índice {"files": {ruta: {size, mtime_ns, blake2b}}} de la caché (vacío si no existe)."""
+    try:
+        with open(os.path.join(cache_dir, HASH_INDEX_NAME)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    if index.get("version") != RESULT_CACHE_VERSION:
+        index = {"version": RESULT_CACHE_VERSION, "files": {}}
+    return index
+
+
+def save_hash_index(cache_dir, index):
+    """Guarda el índice de hashes (temporal por proceso: varios lotes pueden compartir la caché)."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, HASH_INDEX_NAME)
+    tmp_path = f"{path}.{socket.gethostname()}-{os.getpid()}.partial"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
+
+
+def result_key(file_hash, channel_name, params):
+    """Clave de contenido de la salida de un canal."""
+    text = json.dumps([RESULT_CACHE_VERSION, file_hash, channel_name, params], sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def _entry_paths(cache_dir, key):
+    return os.path.join(cache_dir, f"{key}.data"), os.path.join(cache_dir, f"{key}.json")
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _materialize(src, dst):
+    """Enlaza (o copia) src, archivo o directorio, en dst de forma atómica."""
+    tmp_path = f"{dst}.{socket.gethostname()}-{os.getpid()}.partial"
+    _remove(tmp_path)
+    if os.path.isdir(src):
+        shutil.copytree(src, tmp_path, copy_function=_link_or_copy)
+    else:
+        _link_or_copy(src, tmp_path)
+    if os.path.isdir(dst):
+        shutil.rmtree(dst)
+    os.replace(tmp_path, dst)
+
+
+def lookup_result(cache_dir, key):
+    """Ruta de la entrada de key (y la marca como usada), o None si no está en la caché."""
+    data_path, meta_path = _entry_paths(cache_dir, key)
+    if not os.path.exists(data_path):
+        return None
+    try:
+        os.utime(meta_path)
+    except OSError:
+        return None  # eliminada por otro proceso mientras tanto
+    return data_path
+
+
+def restore_result(entry_path, save_path):
+    """Crea la salida save_path a partir de una entrada de la caché."""
+    _materialize(entry_path, save_path)
+
+
+def _write_entry_meta(cache_dir, key, n_bytes):
+    # El .json se escribe antes que los datos: una entrada a medias se cuenta
+    # (y se elimina) igualmente en el LRU
+    os.makedirs(cache_dir, exist_ok=True)
+    meta_path = _entry_paths(cache_dir, key)[1]
+    with open(f"{meta_path}.partial", "w") as f:
+        json.dump({"bytes": n_bytes}, f)
+    os.replace(f"{meta_path}.partial", meta_path)
+
+
+def store_result(cache_dir, key, save_path):
+    """Añade a la caché una salida ya escrita (enlace duro o copia)."""
+    _write_entry_meta(cache_dir, key, output_size(save_path))
+    _materialize(save_path, _entry_paths(cache_dir, key)[0])
+
+
+def store_result_array(cache_dir, key, data):
+    """Añade a la caché un canal como TIFF sin comprimir (p. ej. un canal de un hyperstack)."""
+    _write_entry_meta(cache_dir, key, data.nbytes)
+    write_stack(_entry_paths(cache_dir, key)[0], data)
+
+
+def evict_results(cache_dir, max_bytes):
+    """
+    Elimina las entradas usadas hace más tiempo hasta que la caché ocupa como
+    mucho max_bytes. Devuelve (entradas eliminadas, bytes liberados).
+    """
+    entries = []
+    with os.scandir(cache_dir) as listing:
+        for entry in listing:
+            if not entry.name.endswith(".json") or entry.name == HASH_INDEX_NAME:
+                continue
+            try:
+                with open(entry.path) as f:
+                    n_bytes = json.load(f)["bytes"]
+                entries.append((entry.stat().st_mtime_ns, n_bytes, entry.name[:-len(".json")]))
+            except (OSError, ValueError, KeyError):
+                continue
+    total = sum(n_bytes for _, n_bytes, _ in entries)
+    removed, freed = 0, 0
+    for _, n_bytes, key in sorted(entries):
+        if total <= max_bytes:
+            break
+        data_path, meta_path = _entry_paths(cache_dir, key)
+        try:
+            _remove(data_path)
+            os.remove(meta_path)
+        except OSError:
+            continue  # ya eliminada por otro proceso
+        total -= n_bytes
+        removed += 1
+        freed += n_bytes
+    return removed, freed
@@ -0,0 +1,179 @@
+import os
+import csv
+import sys
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# ====================================================================
+# Instrumentación por etapa e informe de ejecución
+# ====================================================================
+#
+# Cada canal (y cada grupo) registra sus etapas: lectura, img_as_float,
+# normalización, CLAHE, conversión a uint16, escritura, QC, Napari... Por
+# etapa se guarda el tiempo real, el tiempo de CPU del proceso, los bytes
+# leídos/escritos y el pico de memoria. Los tiempos son exclusivos: si una
+# etapa contiene otras (p. ej. la escritura en streaming, que va pidiendo
+# bloques ya normalizados), el tiempo de las internas se descuenta de la
+# externa y cada segundo se cuenta una sola vez.
+#
+# Pico de memoria: "peak_rss_mb" es el máximo de memoria residente del
+# proceso hasta el final de la etapa (resource en Linux/macOS, psutil en
+# Windows si está instalado). Con trace_memory=True se usa además tracemalloc
+# y "traced_peak_mb" es el pico de memoria asignada durante la etapa
+# (NumPy registra sus buffers en tracemalloc); es más preciso pero más lento.
+#
+# El informe se escribe como _run_report.json y _run_report.csv junto a los
+# _metadata.json de la salida.
+
+RUN_REPORT_NAME = "_run_report"
+
+REPORT_FIELDS = ["base_name", "channel", "file_name", "stage", "wall_s", "cpu_s",
+                 "bytes_read", "bytes_written", "peak_rss_mb", "traced_peak_mb"]
+
+
+def peak_rss_bytes():
+    """Pico de memoria residente del proceso (bytes), o None si no se puede medir."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024  # Linux: KB
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset  # Windows
+    except (ImportError, AttributeError):
+        return None
+
+
+class StageRecorder:
+    """Registra etapas con tiempos exclusivos, bytes y pico de memoria."""
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.records = []
+        self._stack = []
+
+    @contextmanager
+    def stage(self, name, bytes_read=0, bytes_written=0):
+        """
+        Mide la etapa name. Devuelve un dict en el que la etapa puede
+        actualizar bytes_read/bytes_written cuando los conozca.
+        """
+        frame = {"children_wall": 0.0, "children_cpu": 0.0, "traced_peak": 0,
+                 "bytes_read": bytes_read, "bytes_written": bytes_written}
+        if self.trace_memory:
+            if self._stack:
+                parent = self._stack[-1]
+                parent["traced_peak"] = max(parent["traced_peak"], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._stack.append(frame)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield frame
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            self._stack.pop()
+            traced_peak = None
+            if self.trace_memory:
+                traced_peak = max(frame["traced_peak"], tracemalloc.get_traced_memory()[1])
+            if self._stack:
+                parent = self._stack[-1]
+                parent["children_wall"] += wall
+                parent["children_cpu"] += cpu
+                if traced_peak is not None:
+                    parent["traced_peak"] = max(parent["traced_peak"], traced_peak)
+            self.add(name, wall - frame["children_wall"], cpu - frame["children_cpu"],
+                     frame["bytes_read"], frame["bytes_written"], traced_peak)
+
+    def add(self, name, wall_s, cpu_s, bytes_read=0, bytes_written=0, traced_peak=None):
+        """Acumula una medición en la etapa name (una fila por etapa)."""
+        peak_rss = peak_rss_bytes()
+        for record in self.records:
+            if record["stage"] == name:
+                break
+        else:
+            record = {"stage": name, "wall_s": 0.0, "cpu_s": 0.0, "bytes_read": 0, "bytes_written": 0,
+                      "peak_rss_mb": None, "traced_peak_mb": None}
+            self.records.append(record)
+        record["wall_s"] += wall_s
+        record["cpu_s"] += cpu_s
+        record["bytes_read"] += bytes_read
+        record["bytes_written"] += bytes_written
+        if peak_rss is not None:
+            record["peak_rss_mb"] = max(record["peak_rss_mb"] or 0, peak_rss / 2**20)
+        if traced_peak is not None:
+            record["traced_peak_mb"] = max(record["traced_peak_mb"] or 0, traced_peak / 2**20)
+
+    def timed_iter(self, name, iterable):
+        """Itera sobre iterable midiendo cada next() como la etapa name (p. ej. lectura por bloques)."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as frame:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                frame["bytes_read"] += getattr(item, "nbytes", 0)
+            yield item
+
+
+def report_rows(records, base_name, channel="", file_name=""):
+    """Etapas de un recorder -> filas del informe con el grupo y el canal."""
+    return [dict(record, base_name=base_name, channel=channel, file_name=file_name) for record in records]
+
+
+def write_run_report(output_dir, rows, run_info, name=RUN_REPORT_NAME):
+    """
+    Escribe _run_report.json (información del lote + filas) y _run_report.csv
+    (filas); name cambia el nombre base (p. ej. un informe por worker).
+    """
+    json_path = os.path.join(output_dir, f"{name}.json")
+    with open(f"{json_path}.partial", "w") as f:
+        json.dump({"run": run_info, "stages": rows, "summary": summarize(rows)}, f, indent=4)
+    os.replace(f"{json_path}.partial", json_path)
+
+    csv_path = os.path.join(output_dir, f"{name}.csv")
+    with open(f"{csv_path}.partial", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: row.get(k) for k in REPORT_FIELDS})
+    os.replace(f"{csv_path}.partial", csv_path)
+    return json_path
+
+
+def summarize(rows):
+    """Totales por etapa, ordenados por tiempo real (mayor primero)."""
+    totals = {}
+    for row in rows:
+        total = totals.setdefault(row["stage"], {"stage": row["stage"], "count": 0, "wall_s": 0.0, "cpu_s": 0.0,
+                                                 "bytes_read": 0, "bytes_written": 0, "peak_rss_mb": None,
+                                                 "traced_peak_mb": None})
+        total["count"] += 1
+        for key in ("wall_s", "cpu_s", "bytes_read", "bytes_written"):
+            total[key] += row[key]
+        for key in ("peak_rss_mb", "traced_peak_mb"):
+            if row[key] is not None:
+                total[key] = max(total[key] or 0, row[key])
+    return sorted(totals.values(), key=lambda t: t["wall_s"], reverse=True)
+
+
+def format_summary(rows):
+    """Tabla de texto con el resumen por etapa."""
+    summary = summarize(rows)
+    total_wall = sum(t["wall_s"] for t in summary) or 1.0
+    header = (f"{'etapa':<14} {'n':>5} {'real (s)':>9} {'%':>6} {'CPU (s)':>9} "
+              f"{'leído (MB)':>11} {'escrito (MB)':>13} {'pico RSS (MB)':>14}")
+    lines = [header, "-" * len(header)]
+    for t in summary:
+        peak = f"{t['peak_rss_mb']:.0f}" if t["peak_rss_mb"] is not None else "-"
+        lines.append(f"{t['stage']:<14} {t['count']:>5} {t['wall_s']:>9.2f} {100 * t['wall_s'] / total_wall:>5.1f}% "
+                     f"{t['cpu_s']:>9.2f} {t['bytes_read'] / 2**20:>11.1f} {t['bytes_written'] / 2**20:>13.1f} "
+                     f"{peak:>14}")
+    return "\n".join(lines)
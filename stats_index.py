@@ -0,0 +1,161 @@
+import os
+import json
+import socket
+import numpy as np
+
+from batch_manifest import content_hash
+from normalization_kernels import histogram_percentiles
+
+# ====================================================================
+# Estadísticas compartidas entre archivos (normalización de todo el lote)
+# ====================================================================
+#
+# Normalizar cada stack por separado hace que las intensidades no sean
+# comparables entre tiempos o raíces. En el modo compartido se calculan
+# primero las estadísticas de cada canal de cada archivo (min, max e
+# histograma exacto si es uint8/uint16) y se combinan por canal: todos los
+# C00 del experimento usan el mismo rango, todos los C01 el suyo, etc.
+#
+# Las estadísticas se guardan en <salida>/_stats_index.json con clave
+# "<hash del contenido>/<canal>", de modo que un archivo renombrado o movido
+# no se vuelve a leer y añadir adquisiciones nuevas solo cuesta las
+# estadísticas de los archivos nuevos. Para no recalcular el hash en cada
+# ejecución se guarda junto a la huella (tamaño + mtime) del archivo.
+#
+# En el clúster las estadísticas se calculan en una pasada previa repartida
+# por shards ("--stats-only --shard i/N"): cada worker guarda las suyas en
+# un índice parcial _stats_index.<worker>.json, al cargar se combinan todos
+# y "--merge" los junta en _stats_index.json. Así cada archivo se lee una
+# sola vez en todo el clúster, no una vez por nodo.
+
+STATS_INDEX_NAME = "_stats_index.json"
+STATS_INDEX_VERSION = 1
+
+
+def partial_stats_index_name(worker_id):
+    """Nombre del índice de estadísticas parcial de un worker."""
+    return f"{STATS_INDEX_NAME[:-len('.json')]}.{worker_id}.json"
+
+
+def _read_stats_index(path):
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return index if index.get("version") == STATS_INDEX_VERSION else None
+
+
+def _partial_stats_paths(output_dir):
+    prefix = f"{STATS_INDEX_NAME[:-len('.json')]}."
+    if not os.path.isdir(output_dir):
+        return []
+    return [entry.path for entry in os.scandir(output_dir)
+            if entry.name != STATS_INDEX_NAME and entry.name.startswith(prefix) and entry.name.endswith(".json")]
+
+
+def load_stats_index(output_dir, include_partials=False):
+    """
+    Carga el índice de estadísticas (vacío si no existe o es de otra versión).
+    Con include_partials=True se combinan también los índices parciales de los workers.
+    """
+    index = {"version": STATS_INDEX_VERSION, "files": {}, "stats": {}}
+    paths = [os.path.join(output_dir, STATS_INDEX_NAME)]
+    if include_partials:
+        paths += _partial_stats_paths(output_dir)
+    for path in paths:
+        part = _read_stats_index(path)
+        if part is not None:
+            index["files"].update(part["files"])
+            index["stats"].update(part["stats"])
+    return index
+
+
+def merge_stats_indexes(output_dir):
+    """Combina los índices parciales en _stats_index.json y los borra."""
+    paths = _partial_stats_paths(output_dir)
+    if paths:
+        save_stats_index(output_dir, load_stats_index(output_dir, include_partials=True))
+        for path in paths:
+            os.remove(path)
+
+
+def save_stats_index(output_dir, index, file_name=STATS_INDEX_NAME):
+    """
+    Guarda el índice de forma atómica. El temporal lleva el host y el pid para que
+    varios workers del clúster puedan guardarlo a la vez (gana el último).
+    file_name permite guardar un índice parcial.
+    """
+    path = os.path.join(output_dir, file_name)
+    tmp_path = f"{path}.{socket.gethostname()}-{os.getpid()}.partial"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
+
+
+def cached_file_hash(index, file_path, compute=True):
+    """
+    Hash del contenido del archivo, reutilizado si su tamaño y mtime no
+    cambiaron. Con compute=False devuelve None en lugar de leer el archivo.
+    """
+    stat = os.stat(file_path)
+    entry = index["files"].get(os.path.abspath(file_path))
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["blake2b"]
+    if not compute:
+        return None
+    file_hash = content_hash(file_path)
+    index["files"][os.path.abspath(file_path)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                                                  "blake2b": file_hash}
+    return file_hash
+
+
+def stats_key(file_hash, channel_name):
+    return f"{file_hash}/{channel_name}"
+
+
+def encode_stats(min_val, max_val, dtype, hist=None):
+    """Estadísticas de un canal -> entrada JSON (histograma disperso: solo valores presentes)."""
+    entry = {"min": float(min_val), "max": float(max_val), "dtype": np.dtype(dtype).name}
+    if hist is not None:
+        values = np.flatnonzero(hist)
+        entry["hist_values"] = values.tolist()
+        entry["hist_counts"] = hist[values].tolist()
+    return entry
+
+
+def decode_histogram(entry, n_values):
+    """Histograma denso de n_values contadores a partir de una entrada del índice (o None)."""
+    if "hist_values" not in entry:
+        return None
+    hist = np.zeros(n_values, dtype=np.int64)
+    hist[np.asarray(entry["hist_values"], dtype=np.int64)] = entry["hist_counts"]
+    return hist
+
+
+def merge_channel_stats(entries):
+    """Combina las estadísticas de un canal de varios archivos: min, max e histograma sumado."""
+    merged = {"min": min(e["min"] for e in entries), "max": max(e["max"] for e in entries), "hist": None}
+    if all("hist_values" in e for e in entries):
+        n_values = max(np.iinfo(e["dtype"]).max + 1 for e in entries)
+        merged["hist"] = sum(decode_histogram(e, n_values) for e in entries)
+    return merged
+
+
+def shared_value_ranges(channel_entries, normalization_mode="minmax", percentiles=(0.1, 99.9)):
+    """
+    {canal: [entradas]} -> {canal: [bajo, alto]} en unidades crudas: min/max
+    de todo el lote o, en modo "percentile", los percentiles del histograma
+    combinado (exactos, como si todos los stacks fueran uno solo).
+    """
+    value_ranges = {}
+    for channel_name, entries in channel_entries.items():
+        merged = merge_channel_stats(entries)
+        if normalization_mode == "percentile":
+            if merged["hist"] is None:
+                raise ValueError(f"La normalización compartida por percentiles requiere datos uint8/uint16 "
+                                 f"(canal {channel_name}).")
+            value_ranges[channel_name] = list(histogram_percentiles(merged["hist"], percentiles))
+        else:
+            value_ranges[channel_name] = [merged["min"], merged["max"]]
+    return value_ranges
@@ -0,0 +1,40 @@
+import os
+
+import numpy as np
+import pytest
+from tifffile import imwrite
+
+from normalize_tiffs import CHANNEL_COLORS, process_tiff_batch
+
+# Cola de trabajo (work_queue): un .done de una ejecución anterior no debe
+# impedir rehacer un grupo cuya salida se ha borrado, también con varios
+# procesos locales (un único pool que reclama los grupos de uno en uno).
+
+
+@pytest.mark.parametrize("incremental", [True, False])
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_work_queue_rebuilds_deleted_output(tmp_path, incremental, n_workers):
+    input_dir, output_dir = tmp_path / "in", tmp_path / "out"
+    input_dir.mkdir()
+    rng = np.random.default_rng(0)
+    for group in ("rootA", "rootB"):
+        for channel in ("C00", "C01"):
+            imwrite(input_dir / f"{group}_{channel}.tif", rng.integers(0, 4000, (3, 20, 20), dtype=np.uint16),
+                    photometric="minisblack")
+
+    def run():
+        process_tiff_batch(str(input_dir), str(output_dir), CHANNEL_COLORS, True, False, np.uint16, False,
+                           n_workers=n_workers, incremental=incremental, work_queue=True, worker_id="w0")
+
+    run()
+    assert len(os.listdir(output_dir / "_claims")) == 2  # un .done por grupo
+    deleted = output_dir / "rootB_C00_normalized.tiff"
+    kept = output_dir / "rootA_C00_normalized.tiff"
+    assert deleted.exists() and kept.exists()
+    kept_mtime = os.path.getmtime(kept)
+    os.remove(deleted)
+
+    run()
+    assert deleted.exists()
+    if incremental:
+        assert os.path.getmtime(kept) == kept_mtime  # el grupo al día no se rehace
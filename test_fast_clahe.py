@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from benchmark_clahe import REFERENCES, TOLERANCE, synthetic_stack
+from fast_clahe import CLAHE_BACKENDS, PER_SLICE_BACKENDS
+
+# Equivalencia numérica de los motores rápidos de CLAHE con skimage (los
+# mismos casos que "python benchmark_clahe.py --check-only"): formas
+# impares, un solo plano, clip_limit 0 y 0.03, kernel_size/nbins propios, en
+# 3D y plano a plano.
+
+SHAPES = [(5, 33, 47), (8, 64, 64), (1, 96, 80)]
+KWARGS = [{}, {"clip_limit": 0.03}, {"clip_limit": 0}, {"kernel_size": 7, "nbins": 128},
+          {"kernel_size": (3, 9, 11)}]
+
+
+@pytest.mark.parametrize("fast, reference", sorted(REFERENCES.items()))
+@pytest.mark.parametrize("shape", SHAPES)
+@pytest.mark.parametrize("kwargs", KWARGS, ids=str)
+def test_fast_matches_skimage(fast, reference, shape, kwargs):
+    if fast == "fast_slices" and isinstance(kwargs.get("kernel_size"), tuple):
+        kwargs = dict(kwargs, kernel_size=kwargs["kernel_size"][1:])  # teselas 2D
+    data = synthetic_stack(shape)
+    expected = CLAHE_BACKENDS[reference](data, **kwargs)
+    result = CLAHE_BACKENDS[fast](data, **kwargs)
+    assert result.shape == expected.shape
+    assert np.abs(expected - result).max() <= TOLERANCE
+
+
+@pytest.mark.parametrize("name", ["fast", "fast_slices"])
+def test_fast_2d(name):
+    data = synthetic_stack((1, 61, 45))[0]
+    expected = CLAHE_BACKENDS["skimage"](data, clip_limit=0.02)
+    assert np.abs(expected - CLAHE_BACKENDS[name](data, clip_limit=0.02)).max() <= TOLERANCE
+
+
+@pytest.mark.parametrize("name", PER_SLICE_BACKENDS)
+def test_per_slice_backends_are_chunk_invariant(name):
+    # El modo streaming aplica el CLAHE por bloques en Z: con los motores por
+    # planos el resultado debe ser exactamente el del stack entero
+    data = synthetic_stack((7, 40, 36))
+    whole = CLAHE_BACKENDS[name](data)
+    chunked = np.concatenate([CLAHE_BACKENDS[name](data[z:z + 3]) for z in range(0, data.shape[0], 3)])
+    np.testing.assert_array_equal(whole, chunked)
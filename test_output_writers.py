@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from tifffile import TiffFile
+
+from output_writers import (HYPERSTACK_LAYOUTS, create_hyperstack, write_hyperstack_channel, finish_hyperstack,
+                            open_output, write_chunks, write_stack)
+
+# Hyperstack multicanal: cada canal se escribe en su sitio y se vuelve a leer
+# igual, también con un solo canal (tifffile omite el eje C de tamaño 1).
+
+
+@pytest.mark.parametrize("layout", HYPERSTACK_LAYOUTS)
+@pytest.mark.parametrize("n_channels", [1, 3])
+@pytest.mark.parametrize("shape", [(5, 17, 11), (17, 11)])
+def test_hyperstack_roundtrip(tmp_path, layout, n_channels, shape):
+    rng = np.random.default_rng(0)
+    channels = [rng.integers(0, 65535, shape, dtype=np.uint16) for _ in range(n_channels)]
+    save_path = str(tmp_path / "grupo_normalized.ome.tif")
+    names = [f"C{i:02d}" for i in range(n_channels)]
+
+    tmp = create_hyperstack(save_path, shape, np.uint16, layout, names, ["blue", "green", "red"][:n_channels])
+    for channel_index, data in enumerate(channels):
+        # Los stacks 3D se escriben por bloques en Z, como en streaming
+        chunks = [data[z:z + 2] for z in range(0, shape[0], 2)] if len(shape) == 3 else [data]
+        write_hyperstack_channel(tmp, layout, channel_index, chunks)
+    finish_hyperstack(save_path)
+
+    for channel_index, data in enumerate(channels):
+        result = open_output(save_path, layout=layout, channel_index=channel_index)
+        assert result.shape == data.shape
+        np.testing.assert_array_equal(result, data)
+
+
+# Un stack de 3 planos se guarda en escala de grises (no como RGB) y el
+# nivel de compresión se aplica también a los TIFF teselados.
+
+
+@pytest.mark.parametrize("output_format, options", [("tiff", {}), ("tiled_tiff", {"compression_level": 3})],
+                         ids=["tiff", "tiled_tiff"])
+def test_three_plane_stack_is_grayscale(tmp_path, output_format, options):
+    data = np.random.default_rng(0).integers(0, 65535, (3, 40, 36), dtype=np.uint16)
+    save_path = str(tmp_path / "grupo_C00_normalized.tiff")
+    write_chunks(save_path, data.shape, data.dtype, [data[:2], data[2:]], output_format,
+                 output_chunks=(2, 16, 16), **options)
+
+    with TiffFile(save_path) as tif:
+        assert "S" not in tif.series[0].axes
+        assert tif.pages[0].photometric.name == "MINISBLACK"
+    np.testing.assert_array_equal(open_output(save_path, output_format), data)
+
+
+def test_write_stack_three_planes_is_grayscale(tmp_path):
+    data = np.arange(3 * 8 * 8, dtype=np.uint16).reshape(3, 8, 8)
+    save_path = str(tmp_path / "grupo_C00_normalized.tiff")
+    write_stack(save_path, data)
+    with TiffFile(save_path) as tif:
+        assert "S" not in tif.series[0].axes
+        assert tif.pages[0].photometric.name == "MINISBLACK"
+
+
+def test_open_compressed_tiff_is_lazy(tmp_path):
+    # Un TIFF comprimido no se puede mapear: se abre como array zarr, sin leerlo entero
+    data = np.random.default_rng(0).integers(0, 65535, (4, 64, 48), dtype=np.uint16)
+    save_path = str(tmp_path / "grupo_C00_normalized.tiff")
+    write_chunks(save_path, data.shape, data.dtype, [data], "tiled_tiff", output_chunks=(1, 16, 16))
+    result = open_output(save_path, "tiled_tiff")
+    assert not isinstance(result, np.ndarray)
+    np.testing.assert_array_equal(result[1:3, 16:48], data[1:3, 16:48])